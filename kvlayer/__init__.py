@@ -61,6 +61,9 @@ dictionary and not persisted.  ``storage_addresses`` are not required.
     kvlayer:
       storage_type: local
 
+      # optional; number of serialized keys to cache (0 to disable)
+      joined_key_cache_size: 100000
+
 filestorage
 -----------
 
@@ -79,6 +82,66 @@ using the :mod:`shelve` module.  This does not require
       # If set, actually work on a copy of "filename" at this location.
       copy_to_filename: /tmp/kvlayer-copy.bin
 
+logfile
+-------
+
+Values are stored in a local append-only log file, with only the
+location of each value held in memory.  Writes cost time proportional
+to their own size, rather than to the size of the whole store as with
+``filestorage``.  Only one process may write to a given file.
+
+.. code-block:: yaml
+
+    kvlayer:
+      storage_type: logfile
+
+      # Name of the file to use for storage
+      filename: /tmp/kvlayer.log
+
+      # all of the following parameters are default values and are optional
+      # fsync after this many records (null to not count records)...
+      log_sync_ops: 1000
+      # ...or this many seconds since the last fsync (null to not time)
+      log_sync_seconds: 1.0
+      # rewrite the log when more than this fraction of it is dead...
+      log_compact_ratio: 0.5
+      # ...but only once it is at least this many bytes long
+      log_compact_min_bytes: 1048576
+
+Every write is handed to the operating system before the kvlayer call
+returns, but it is only forced to disk at the intervals above, or when
+the client is closed.
+
+sstable
+-------
+
+Values are stored in sorted, immutable, memory-mapped files on the
+local disk.  This is intended for read-mostly data, such as lookup
+tables built once and shipped to many workers: any number of
+processes can read the same files and share their pages, and opening
+a table does not read or parse its contents.  Only one process may
+write to a given table at a time.
+
+.. code-block:: yaml
+
+    kvlayer:
+      storage_type: sstable
+
+      # Directory holding one subdirectory per table
+      sstable_dir: /var/lib/kvlayer
+
+      # all of the following parameters are default values and are optional
+      # approximate size of the blocks found by the block index
+      sstable_block_size: 4096
+      # bloom filter size; about 1% false positives at 10 bits per key
+      sstable_bloom_bits_per_key: 10
+      # buffer this many writes in memory before writing a new file
+      sstable_memtable_size: 100000
+      # merge a table's files when it has more than this many
+      sstable_max_files: 8
+
+Buffered writes are also written out when the client is closed.
+
 redis
 -----
 
@@ -90,11 +153,31 @@ Uses the `Redis`_ in-memory database.
       storage_type: redis
 
       # host:port locations of Redis servers; only the first is used
+      # unless redis_sharded is set
       storage_addresses: [redis.example.com:6379]
 
+      # spread table data over all storage_addresses by consistent
+      # hashing; the first also holds the namespace (default: false)
+      redis_sharded: false
+
+      # points per server on the consistent hash ring (default: 100)
+      redis_shard_replicas: 100
+
       # Redis database number (default: 0)
       redis_db_num: 1
 
+      # keys fetched per round trip when scanning (default: 1000)
+      redis_scan_page_size: 1000
+
+:meth:`~kvlayer._abstract_storage.AbstractStorage.increment` on
+counter and accumulator tables runs as a single server-side script,
+so concurrent increments from several clients do not lose updates.
+
+When sharded, reads and writes go to each server in parallel and
+scans merge the servers' sorted results.  Changing the list of
+servers moves keys between them, so do not change it for a namespace
+that already holds data.
+
 accumulo
 --------
 
@@ -117,13 +200,69 @@ that proxy.
       accumulo_timeout_ms: 30000
       accumulo_threads: 10
       accumulo_latency_ms: 10
+      accumulo_flush_mutations: 10000
+      accumulo_parallel_scan: false
       thrift_framed_transport_size_in_mb: 15
 
 Each kvlayer table is instantiated as an Accumulo table named
 ``appname_namespace_table``.
 
+Each client keeps one Accumulo ``BatchWriter`` open per table, so
+writes are buffered rather than sent synchronously.  Buffered writes
+are sent to the tablet servers once ``accumulo_max_memory`` bytes are
+buffered, after ``accumulo_latency_ms``, or after
+``accumulo_flush_mutations`` mutations, and the same client always
+sees its own writes.  Call ``client.flush()`` to wait for all pending
+writes, and ``client.close()`` when done with the client.
+
+New tables can be pre-split across tablet servers by passing
+``num_splits`` to :meth:`~kvlayer.AbstractStorage.setup_namespace`.
+Split points are spread uniformly over the first key part when it is
+a UUID or integer; otherwise pass ``split_samples``, a dictionary
+mapping table name to a list of representative keys.
+
+With ``accumulo_parallel_scan``, each scan is split at tablet
+boundaries and the pieces are scanned concurrently on up to
+``accumulo_threads`` connections.  Results still come back in key
+order; pass ``ordered=False`` to ``scan()`` or ``scan_keys()`` to get
+them as soon as they arrive instead.  ``parallel=True`` or
+``parallel=False`` overrides the setting for one scan.
+
 .. _Accumulo: http://accumulo.apache.org/
 
+hbase
+-----
+
+Uses the Apache `HBase`_ distributed database through its Thrift
+server, with the :mod:`happybase` module.
+
+.. code-block:: yaml
+
+    kvlayer:
+      storage_type: hbase
+
+      # host:port locations of Thrift servers; one is chosen at random
+      storage_addresses: [hbase.example.com:9090]
+
+      # all of the following parameters are default values and are optional
+      pool_size: 10
+      max_batch_bytes: 10000000
+      parallel_scan: false
+      # rows per Thrift call for get()
+      get_batch_size: 100
+      # rows per Thrift call for scans ("caching")
+      scan_batch_size: 1000
+      # maximum cells per row per call, for very wide rows
+      scan_batching: null
+
+Each kvlayer table is instantiated as an HBase table named
+``appname_namespace_table``.  ``parallel_scan`` works like
+``accumulo_parallel_scan``, splitting scans at region boundaries and
+using up to ``pool_size`` extra connections of its own, so the pooled
+connections stay free for other calls made while the scan is read.
+
+.. _HBase: http://hbase.apache.org/
+
 postgrest
 ---------
 
@@ -154,6 +293,15 @@ This backend is newer than, less proven than, and incompatible with the
       min_connections: 2
       # never create more than this many connections
       max_connections: 16
+      # check that a pooled connection still works before using it
+      # if it has been idle for more than this many seconds
+      idle_check_seconds: 30
+      # write this many keys per INSERT statement
+      put_batch_size: 1000
+      # look up this many keys per SELECT statement
+      get_batch_size: 1000
+      # commit bulk_load() after every this many rows
+      bulk_load_batch_size: 1000000
 
 The backend assumes the user is able to run SQL ``CREATE TABLE`` and
 ``DROP TABLE`` statements.  Each kvlayer table is instantiated as an
@@ -162,7 +310,8 @@ SQL table named ``appname_namespace_table``.
 Within the system, the ``min_connections`` and ``max_connections``
 property apply per client object.  If ``min_connections`` is set to 0
 then the connection pool will never hold a connection alive, which
-typically adds a performance cost to reconnect.
+typically adds a performance cost to reconnect.  The connection pool
+is thread-safe, so one client object may be shared between threads.
 
 postgres
 --------
@@ -185,8 +334,28 @@ and must begin with a letter or underscore.
       min_connections: 2
       # never create more than this many connections
       max_connections: 16
-      # break large scans (using SQL) into chunks of this many
+      # check that a pooled connection still works before using it
+      # if it has been idle for more than this many seconds
+      idle_check_seconds: 30
+      # fetch this many rows per round trip when scanning
+      scan_itersize: 2000
+      # fetch the next rows in the background while the caller
+      # works through the current ones
+      scan_prefetch: true
+      # run a separate, LIMITed query for every scan_inner_limit
+      # rows, so long scans do not hold a transaction open
+      scan_keyset_pagination: false
       scan_inner_limit: 1000
+      # write this many keys per INSERT statement
+      put_batch_size: 1000
+      # look up this many keys per SELECT statement
+      get_batch_size: 1000
+      # upsert with INSERT ... ON CONFLICT (true), or with a stored
+      # procedure per key (false); if unset, ON CONFLICT is used on
+      # PostgreSQL 9.5 and later
+      # upsert_on_conflict: true
+      # commit bulk_load() after every this many rows
+      bulk_load_batch_size: 1000000
 
 The backend assumes the user is able to run SQL ``CREATE TABLE`` and
 ``DROP TABLE`` statements.  Each kvlayer namespace is instantiated as
@@ -196,7 +365,42 @@ collections of rows within the namespace table sharing a common field.
 Within the system, the ``min_connections`` and ``max_connections``
 property apply per client object.  If ``min_connections`` is set to 0
 then the connection pool will never hold a connection alive, which
-typically adds a performance cost to reconnect.
+typically adds a performance cost to reconnect.  The connection pool
+is thread-safe, so one client object may be shared between threads.
+
+sqlite
+------
+
+Uses an `SQLite`_ database file through the standard library
+:mod:`sqlite3` module.  This needs no server, and unlike
+``filestorage`` it is durable after every write and can be shared by
+several processes on one host: the database is put in write-ahead-log
+mode, so readers do not block the (single, at any moment) writer or
+each other.  The ``app_name`` and ``namespace`` can only consist of
+alphanumeric characters and underscores, and must begin with a letter
+or underscore.
+
+.. code-block:: yaml
+
+    kvlayer:
+      storage_type: sqlite
+
+      # Name of the database file
+      filename: /var/lib/kvlayer.db
+
+      # all of the following parameters are default values and are optional
+      # seconds to wait for another process's write to finish
+      sqlite_timeout: 30.0
+      # SQLite "PRAGMA synchronous" setting; FULL is safer but slower
+      sqlite_synchronous: NORMAL
+      # fetch this many keys per query in get()
+      sqlite_get_batch_size: 500
+
+Each kvlayer namespace is an SQL table named ``kv_appname_namespace``;
+kvlayer tables are collections of rows within the namespace table
+sharing a common field.
+
+.. _SQLite: http://www.sqlite.org
 
 .. _PostgreSQL: http://www.postgresql.org
 .. _PostgreSQL connection string: http://www.postgresql.org/docs/current/static/libpq-connect.html#LIBPQ-PARAMKEYWORDS
@@ -219,6 +423,8 @@ port numbers.  A typical setup will look like:
       # optional settings with their default values
       protocol: pbc # or http or https
       scan_limit: 100
+      vclock_reads: false
+      write_threads: 8
 
 The setup from the Riak "Five-Minute Install" runs five separate
 Riak nodes all on localhost, resulting in configuration like
@@ -249,9 +455,20 @@ the kvlayer scan API as well as calls to delete kvlayer tables, which
 are also Riak key scans.
 
 Your Riak cluster must be configured with secondary indexing enabled,
-and correspondingly, must be using the LevelDB backend.  The default
-bucket settings, and in particular setting ``allow_mult`` to
-``false``, are correct for :mod:`kvlayer`.
+and correspondingly, must be using the LevelDB backend.
+
+Writes and deletes are normally blind: they do not read the object's
+vector clock first, so each is a single round trip.  For this to be
+safe, :meth:`~kvlayer.AbstractStorage.setup_namespace` sets
+``allow_mult`` to ``false`` and ``last_write_wins`` to ``true`` on each
+table's bucket.  This applies to buckets that already exist as well,
+and so changes how every other client of those buckets resolves
+conflicting writes; each change is logged at info level.  Setting
+``vclock_reads`` makes every write and delete read the object first
+instead, and leaves the bucket settings alone; the default bucket
+settings, and in particular ``allow_mult`` set to ``false``, are
+correct for that mode.  Writes and deletes of several keys are sent
+concurrently from ``write_threads`` threads.
 
 split\_s3
 ---------
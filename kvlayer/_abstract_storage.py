@@ -234,6 +234,46 @@ class AbstractStorage(object):
                     .format(value_type, k))
             self._value_types[k] = value_type
 
+    def _split_points(self, table_name, num_splits, sample_keys=None):
+        '''Choose serialized keys that divide a table into pieces.
+
+        If `sample_keys` are given, the split points are evenly spaced
+        through the sorted sample.  Otherwise the first part of the
+        table's key must be a :class:`uuid.UUID`, :class:`int`, or
+        :class:`long`, and the split points are evenly spaced through
+        all possible values of that part.
+
+        :param str table_name: name of the table
+        :param int num_splits: number of pieces to divide the table into
+        :param sample_keys: optional key tuples typical of the table
+        :return: sorted list of at most `num_splits` - 1 byte strings
+        :raise kvlayer._exceptions.ProgrammerError: if there are no
+          `sample_keys` and the key type can't be split evenly
+
+        '''
+        key_spec = self._table_names[table_name]
+        if num_splits < 2:
+            return []
+        if sample_keys:
+            keys = sorted(set(self._encoder.serialize(k, key_spec)
+                              for k in sample_keys))
+            return sorted(set(keys[len(keys) * i // num_splits]
+                              for i in xrange(1, num_splits)))
+        typ = key_spec[0]
+        if typ is uuid.UUID:
+            (lo, hi, make) = (0, 2 ** 128, lambda n: uuid.UUID(int=n))
+        elif typ is int:
+            (lo, hi, make) = (-2 ** 31, 2 ** 31, int)
+        elif typ in (long, (int, long), (long, int)):
+            (lo, hi, make) = (-2 ** 63, 2 ** 63, long)
+        else:
+            raise ProgrammerError('cannot split table {0!r} with {1!r} keys '
+                                  'without sample keys'
+                                  .format(table_name, typ))
+        return [self._encoder.make_start_key(
+            (make(lo + (hi - lo) * i // num_splits),), key_spec)
+            for i in xrange(1, num_splits)]
+
     @abc.abstractmethod
     def delete_namespace(self):
         '''Deletes all data from namespace.'''
@@ -338,6 +378,13 @@ class AbstractStorage(object):
             self._log_stats.delete.add(table_name, start_time, end_time,
                                        num_keys, keys_size, 0, 0)
 
+    def log_bulk_load(self, table_name, start_time, end_time, num_keys,
+                      keys_size, num_values, values_size):
+        if self._log_stats is not None:
+            self._log_stats.bulk_load.add(
+                table_name, start_time, end_time,
+                num_keys, keys_size, num_values, values_size)
+
     @abc.abstractmethod
     def close(self):
         '''
@@ -516,6 +563,8 @@ class StorageStats(object):
         self.scan_keys = OpStats(self)
         self.get = OpStats(self)
         self.delete = OpStats(self)
+        self.bulk_load = OpStats(self)
+        self.caches = {}
 
         self._closed = False
         atexit.register(self.atexit)
@@ -537,6 +586,13 @@ class StorageStats(object):
         if self.delete.num_ops:
             outparts.append('delete:')
             outparts.append(str(self.delete))
+        if self.bulk_load.num_ops:
+            outparts.append('bulk_load:')
+            outparts.append(str(self.bulk_load))
+        for name, cache in sorted(self.caches.iteritems()):
+            if cache.num_lookups:
+                outparts.append('{0} cache:'.format(name))
+                outparts.append(str(cache))
         return '\n'.join(outparts) + '\n'
 
     def to_dict(self):
@@ -552,8 +608,26 @@ class StorageStats(object):
             out['get'] = self.get.to_dict()
         if self.delete.num_ops:
             out['delete'] = self.delete.to_dict()
+        if self.bulk_load.num_ops:
+            out['bulk_load'] = self.bulk_load.to_dict()
+        caches = dict((name, cache.to_dict())
+                      for name, cache in self.caches.iteritems()
+                      if cache.num_lookups)
+        if caches:
+            out['caches'] = caches
         return out
 
+    def cache(self, name):
+        '''Get the :class:`CacheStats` for the cache named `name`.
+
+        These are created on first use.  Cache lookups do not count as
+        operations for purposes of the flush interval.
+
+        '''
+        if name not in self.caches:
+            self.caches[name] = CacheStats()
+        return self.caches[name]
+
     def _out(self):
         if (self._f is None) and hasattr(self._config_str, 'write'):
             self._f = self._config_str
@@ -690,8 +764,9 @@ class OpStatsPerTable(object):
                 bpv=(1.0*self.values_size)/self.num_values
             )
         if self.total_time > 0:
-            out += ' {0:0.1f} (k+v)B/s'.format(
-                (1.0*(self.keys_size + self.values_size))/self.total_time)
+            out += ' {0:0.1f} (k+v)B/s {1:0.1f} keys/s'.format(
+                (1.0*(self.keys_size + self.values_size))/self.total_time,
+                self.num_keys/self.total_time)
         return out
 
     def to_dict(self):
@@ -708,6 +783,72 @@ class OpStatsPerTable(object):
         return out
 
 
+class CacheStats(object):
+    '''Hit and miss counts for some client-side cache, by table.'''
+
+    def __init__(self):
+        self.by_table = collections.defaultdict(CacheStatsPerTable)
+
+    def hit(self, table_name):
+        self.by_table[table_name].hits += 1
+
+    def miss(self, table_name):
+        self.by_table[table_name].misses += 1
+
+    def evict(self, table_name):
+        self.by_table[table_name].evictions += 1
+
+    @property
+    def num_lookups(self):
+        return sum(v.hits + v.misses for v in self.by_table.itervalues())
+
+    def __str__(self):
+        parts = []
+        total = CacheStatsPerTable()
+        for k, v in self.by_table.iteritems():
+            total += v
+            parts.append('{0:10s} {1}\n'.format(k, str(v)))
+        return ''.join(parts) + '           {0}\n'.format(str(total))
+
+    def to_dict(self):
+        "return a dict suitable for json.dump()"
+        out = {}
+        for k, v in self.by_table.iteritems():
+            out[k] = v.to_dict()
+        return out
+
+
+class CacheStatsPerTable(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __iadd__(self, b):
+        assert isinstance(b, CacheStatsPerTable)
+        self.hits += b.hits
+        self.misses += b.misses
+        self.evictions += b.evictions
+        return self
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return ('{h} hits, {m} misses ({r:0.1f}% hit), {e} evictions'.format(
+            h=self.hits,
+            m=self.misses,
+            r=lookups and (100.0*self.hits/lookups),
+            e=self.evictions,
+        ))
+
+    def to_dict(self):
+        "return a dict suitable for json.dump()"
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
 class StatRecord(object):
     '''Combined statistics record for a single action.'''
 
@@ -7,10 +7,14 @@ Accumulo Thrift Proxy that is available in Accumulo 1.4.4+
 '''
 
 from __future__ import absolute_import
+import contextlib
+import itertools
 import logging
+import Queue
 import random
 import re
 import struct
+import sys
 
 from pyaccumulo import Accumulo, Mutation, Range, BatchWriter
 from pyaccumulo.iterators import SummingCombiner
@@ -20,6 +24,7 @@ from pyaccumulo.proxy.ttypes import IteratorScope, \
 from kvlayer._abstract_storage import COUNTER, StringKeyedStorage
 from kvlayer._decorators import retry
 from kvlayer._exceptions import ProgrammerError
+from kvlayer._utils import parallel_scan, split_key_range
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +45,21 @@ class AStorage(StringKeyedStorage):
     makes two mutations to delete the old value and then start the new
     sum.
 
+    Writes go through one long-lived ``BatchWriter`` per table.  The
+    proxy sends buffered mutations on to the tablet servers when
+    ``accumulo_max_memory`` bytes are buffered or after
+    ``accumulo_latency_ms``; this client also waits for them to be
+    written after ``accumulo_flush_mutations`` mutations, before
+    reading a table it has written to, on :meth:`flush`, and on
+    :meth:`close`.
+
+    With ``accumulo_parallel_scan``, or if :meth:`scan` is called
+    with ``parallel=True``, scans are split at tablet boundaries and
+    the pieces are scanned concurrently on up to ``accumulo_threads``
+    extra connections.  Results still come back in key order, unless
+    :meth:`scan` is also called with ``ordered=False``, in which case
+    they are returned as soon as they arrive.
+
     '''
     def __init__(self, *args, **kwargs):
         super(AStorage, self).__init__(*args, **kwargs)
@@ -63,6 +83,10 @@ class AStorage(StringKeyedStorage):
         self._timeout_ms = self._config.get('accumulo_timeout_ms', 30000)
         self._threads = self._config.get('accumulo_threads', 10)
         self._latency_ms = self._config.get('accumulo_latency_ms', 10)
+        self._flush_mutations = self._config.get('accumulo_flush_mutations',
+                                                 10000)
+        self._parallel_scan = self._config.get('accumulo_parallel_scan',
+                                               False)
 
         # Acumulo storage requires a username and password
         self._user = self._config.get('username', None)
@@ -75,6 +99,14 @@ class AStorage(StringKeyedStorage):
             self._config['thrift_framed_transport_size_in_mb']
 
         self._conn = None
+        # kvlayer table name to BatchWriter
+        self._writers = {}
+        # kvlayer table name to number of mutations not yet flushed
+        self._unflushed = {}
+        # kvlayer tables with deletes sent since the last flush
+        self._unflushed_deletes = set()
+        # idle connections for parallel scan threads
+        self._scan_conns = Queue.LifoQueue()
 
     @property
     def conn(self):
@@ -87,6 +119,28 @@ class AStorage(StringKeyedStorage):
             self._connected = True
         return self._conn
 
+    @contextlib.contextmanager
+    def _scan_conn(self):
+        '''Borrow a connection for one parallel scan thread.
+
+        A Thrift connection cannot be shared between threads, so
+        each scan thread needs its own.  These are kept for later
+        scans, and closed by :meth:`close`.
+
+        '''
+        try:
+            conn = self._scan_conns.get_nowait()
+        except Queue.Empty:
+            host, port = random.choice(self._addresses)
+            conn = Accumulo(host, port, self._user, self._password)
+        try:
+            yield conn
+        except:
+            # don't reuse a connection in an unknown state
+            conn.close()
+            raise
+        self._scan_conns.put(conn)
+
     def _ns(self, table):
         '''
         accumulo does not have "namespaces" as a concept per se, so we
@@ -95,7 +149,7 @@ class AStorage(StringKeyedStorage):
         '''
         return '%s_%s_%s' % (self._app_name, self._namespace, table)
 
-    def _create_table(self, table):
+    def _create_table(self, table, splits=None):
         ns_table = self._ns(table)
         if self.conn.table_exists(ns_table):
             logger.debug('table %s exists, not modifying', ns_table)
@@ -103,6 +157,11 @@ class AStorage(StringKeyedStorage):
         logger.debug('creating %s', ns_table)
 
         self.conn.create_table(ns_table)
+        if splits:
+            logger.debug('splitting %s into %d tablets',
+                         ns_table, len(splits) + 1)
+            self.conn.client.addSplits(self.conn.login, ns_table,
+                                       set(splits))
         self.conn.client.setTableProperty(self.conn.login,
                                           ns_table,
                                           'table.bloom.enabled',
@@ -126,15 +185,25 @@ class AStorage(StringKeyedStorage):
             return struct.pack('>q', value)
         return super(AStorage, self).value_to_str(value, value_type)
 
-    def setup_namespace(self, table_names, value_types={}):
+    def setup_namespace(self, table_names, value_types={}, num_splits=0,
+                        split_samples={}):
         '''creates tables in the namespace.  Can be run multiple times with
         different table_names in order to expand the set of tables in
         the namespace.
+
+        If `num_splits` is given, newly created tables are split into
+        that many tablets, so that writes are spread across tablet
+        servers from the start.  If `split_samples` has an entry for
+        a table, a list of typical key tuples, the tablets divide
+        those keys evenly; otherwise they divide the space of the
+        first key part, which must be a UUID or integer.
         '''
         super(AStorage, self).setup_namespace(table_names, value_types)
         for table in table_names:
             if not self.conn.table_exists(self._ns(table)):
-                self._create_table(table)
+                splits = self._split_points(table, num_splits,
+                                            split_samples.get(table))
+                self._create_table(table, splits)
 
     def delete_namespace(self):
         '''
@@ -145,64 +214,134 @@ class AStorage(StringKeyedStorage):
         logger.debug('finding tables to delete from %s: %r',
                      self._ns(''), tables)
         tables_to_delete = [x for x in tables if re.search(self._ns(''), x)]
+        for table_name in self._writers.keys():
+            self._close_writer(table_name)
         for table in tables_to_delete:
             self.conn.delete_table(table)
 
     def clear_table(self, table_name):
-        self.conn.delete_table(self._ns(table_name))
-        self._create_table(table_name)
+        self._close_writer(table_name)
+        ns_table = self._ns(table_name)
+        # Keep the table split the way setup_namespace left it.  If
+        # it has grown more splits than this, Accumulo picks an
+        # evenly spaced subset.
+        splits = self.conn.client.getSplits(self.conn.login, ns_table, 1024)
+        self.conn.delete_table(ns_table)
+        self._create_table(table_name, splits)
+
+    def _writer(self, table_name):
+        '''Get the long-lived BatchWriter for a table.'''
+        writer = self._writers.get(table_name)
+        if writer is None:
+            writer = BatchWriter(conn=self.conn,
+                                 table=self._ns(table_name),
+                                 max_memory=self._max_memory,
+                                 latency_ms=self._latency_ms,
+                                 timeout_ms=self._timeout_ms,
+                                 threads=self._threads)
+            self._writers[table_name] = writer
+            self._unflushed[table_name] = 0
+        return writer
+
+    def _write(self, table_name, mutations):
+        '''Send mutations to a table's BatchWriter.
+
+        `mutations` is a list of pairs of :class:`Mutation` and its
+        approximate size.  These are sent in as few calls as the
+        Thrift frame size allows, but are not necessarily written to
+        Accumulo by the time this returns.
 
-    @retry([AccumuloSecurityException])
-    def _put(self, table_name, keys_and_values, counter_deletes=True):
-        cur_bytes = 0
-        max_bytes = self.thrift_framed_transport_size_in_mb * 2 ** 19
-        batch_writer = BatchWriter(conn=self.conn,
-                                   table=self._ns(table_name),
-                                   max_memory=self._max_memory,
-                                   latency_ms=self._latency_ms,
-                                   timeout_ms=self._timeout_ms,
-                                   threads=self._threads)
+        '''
+        writer = self._writer(table_name)
         try:
-            # Because COUNTER is implemented via a summing accumulator,
-            # to do a put we need to delete all of the old values before
-            # restarting the sum.
-            if ((self._value_types.get(table_name, str) is COUNTER and
-                 counter_deletes)):
-                for key, blob in keys_and_values:
-                    mut = Mutation(key)
-                    mut.put(cf='', cq='', is_delete=True)
-                    batch_writer.add_mutation(mut)
-                batch_writer.flush()
-
-            for key, blob in keys_and_values:
-                if len(key) + len(blob) + cur_bytes >= max_bytes:
-                    logger.debug(
-                        'len(key)=%d + len(blob)=%d + cur_bytes=%d >= '
-                        'thrift_framed_transport_size_in_mb/2 = %d',
-                        len(key), len(blob), cur_bytes, max_bytes)
-                    logger.debug(
-                        'pre-emptively sending only what has been '
-                        'batched, and will send this item in next '
-                        'batch.')
-                    batch_writer.flush()
+            max_bytes = self.thrift_framed_transport_size_in_mb * 2 ** 19
+            batch = []
+            cur_bytes = 0
+            for mut, size in mutations:
+                if batch and cur_bytes + size >= max_bytes:
+                    logger.debug('sending %d mutations of %d bytes, '
+                                 'thrift_framed_transport_size_in_mb/2 = %d',
+                                 len(batch), cur_bytes, max_bytes)
+                    writer.add_mutations(batch)
+                    batch = []
                     cur_bytes = 0
-                cur_bytes += len(key) + len(blob)
+                batch.append(mut)
+                cur_bytes += size
+            if batch:
+                writer.add_mutations(batch)
+            self._unflushed[table_name] += len(mutations)
+            if self._unflushed[table_name] >= self._flush_mutations:
+                self._flush_table(table_name)
+        except:
+            # Don't reuse a writer in an unknown state, but try to
+            # write out what earlier calls sent to it before dropping it.
+            exc_info = sys.exc_info()
+            try:
+                self._close_writer(table_name)
+            except Exception:
+                logger.error('failed to close BatchWriter for %s; earlier '
+                             'writes may be lost', self._ns(table_name),
+                             exc_info=True)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _flush_table(self, table_name):
+        '''Wait for all mutations sent to a table to be written.'''
+        if self._unflushed.get(table_name):
+            self._writers[table_name].flush()
+            self._unflushed[table_name] = 0
+        self._unflushed_deletes.discard(table_name)
+
+    def _close_writer(self, table_name):
+        '''Flush and close a table's BatchWriter, if it has one.'''
+        writer = self._writers.pop(table_name, None)
+        self._unflushed.pop(table_name, None)
+        self._unflushed_deletes.discard(table_name)
+        if writer is not None:
+            writer.close()
+
+    def flush(self):
+        '''Wait for all pending writes to be written to Accumulo.'''
+        for table_name in self._writers.keys():
+            self._flush_table(table_name)
 
+    @retry([AccumuloSecurityException])
+    def _put(self, table_name, keys_and_values, counter_deletes=True):
+        # Because COUNTER is implemented via a summing accumulator,
+        # to do a put we need to delete all of the old values before
+        # restarting the sum.
+        if ((self._value_types.get(table_name, str) is COUNTER and
+             counter_deletes)):
+            deletes = []
+            for key, blob in keys_and_values:
                 mut = Mutation(key)
-                mut.put(cf='', cq='', val=blob)
-                batch_writer.add_mutation(mut)
-        finally:
-            batch_writer.close()
-
-    def _scan(self, table_name, key_ranges):
-        for kv in self._do_scan(table_name, key_ranges, keys_only=False):
-            yield kv
-
-    def _scan_keys(self, table_name, key_ranges):
-        for kv in self._do_scan(table_name, key_ranges, keys_only=True):
-            yield kv
-
-    def _do_scan(self, table_name, key_ranges, keys_only):
+                mut.put(cf='', cq='', is_delete=True)
+                deletes.append((mut, len(key)))
+            self._write(table_name, deletes)
+            self._unflushed_deletes.add(table_name)
+
+        # Accumulo gives a whole batch one timestamp, and a delete
+        # hides a put with the same timestamp, so the puts must not
+        # land in the same batch as any deletes
+        if table_name in self._unflushed_deletes:
+            self._flush_table(table_name)
+
+        puts = []
+        for key, blob in keys_and_values:
+            mut = Mutation(key)
+            mut.put(cf='', cq='', val=blob)
+            puts.append((mut, len(key) + len(blob)))
+        self._write(table_name, puts)
+
+    def _scan(self, table_name, key_ranges, parallel=None, ordered=True):
+        return self._do_scan(table_name, key_ranges, False, parallel, ordered)
+
+    def _scan_keys(self, table_name, key_ranges, parallel=None,
+                   ordered=True):
+        return self._do_scan(table_name, key_ranges, True, parallel, ordered)
+
+    def _do_scan(self, table_name, key_ranges, keys_only, parallel=None,
+                 ordered=True):
+        self._flush_table(table_name)
         iterators = []
         if keys_only:
             iterators.append(IteratorSetting(
@@ -211,45 +350,69 @@ class AStorage(StringKeyedStorage):
                 'SortedKeyIterator', properties={}))
         if not key_ranges:
             key_ranges = [['', '']]
-        for start_key, stop_key in key_ranges:
-            specific_key_range = bool(start_key or stop_key)
-            if specific_key_range:
-                # Accumulo treats None as a negative-infinity or
-                # positive-infinity key as needed for starts and ends
-                # of ranges.
-                #
-                # pyaccumulo has a bug at present 20140228_171555
-                # which causes it to never do a '>=' scan, so we must
-                # decrement the start key to include the start key
-                # which necessary for a get() operation.
-                # https://github.com/accumulo/pyaccumulo/issues/14
-                if start_key:
-                    start_key = _string_decrement(start_key)
-                key_range = Range(srow=start_key, erow=stop_key,
-                                  sinclude=True, einclude=True)
-                scanner = self.conn.scan(self._ns(table_name),
-                                         scanrange=key_range,
-                                         iterators=iterators)
-            else:
-                scanner = self.conn.scan(self._ns(table_name),
-                                         iterators=iterators)
+        if parallel is None:
+            parallel = self._parallel_scan
 
-            for row in scanner:
+        def scan_piece(conn, key_range):
+            for row in conn.scan(self._ns(table_name), scanrange=key_range,
+                                 iterators=iterators):
                 if keys_only:
                     yield row.row
                 else:
                     yield (row.row, row.val)
 
+        if not parallel:
+            return itertools.chain.from_iterable(
+                scan_piece(self.conn, _range(start_key, stop_key))
+                for start_key, stop_key in key_ranges)
+
+        def scan_piece_in_thread(key_range):
+            with self._scan_conn() as conn:
+                for item in scan_piece(conn, key_range):
+                    yield item
+
+        # Ask for a few pieces per thread, so that one big tablet
+        # does not leave the other threads idle.
+        splits = sorted(self.conn.client.getSplits(
+            self.conn.login, self._ns(table_name), 4 * self._threads))
+        pieces = []
+        for start_key, stop_key in key_ranges:
+            # Tablets end at, and include, their split rows
+            for n, (start, stop) in enumerate(
+                    split_key_range(start_key, stop_key, splits)):
+                pieces.append(_range(start, stop, after_start=(n > 0)))
+        logger.debug('scanning %s in %d pieces', self._ns(table_name),
+                     len(pieces))
+        return parallel_scan(scan_piece_in_thread, pieces, self._threads,
+                             ordered=ordered)
+
     def _get(self, table_name, keys):
+        if not keys:
+            return
+        self._flush_table(table_name)
+        # One batch scanner looks up all of the keys, in parallel
+        # across tablet servers; it returns rows in no particular
+        # order.  Decrement the start keys as in _do_scan().
+        wanted = set(keys)
+        ranges = [Range(srow=_string_decrement(key), erow=key,
+                        sinclude=True, einclude=True)
+                  for key in wanted]
+        found = {}
+        for row in self.conn.batch_scan(self._ns(table_name),
+                                        scanranges=ranges,
+                                        numthreads=self._threads):
+            if row.row in wanted:
+                found[row.row] = row.val
         for key in keys:
-            gen = self._do_scan(table_name, [(key, key)], keys_only=False)
-            v = None
-            for kk, vv in gen:
-                if kk == key:
-                    v = vv
-            yield key, v
+            yield key, found.get(key)
 
     def close(self):
+        '''Write out any pending mutations and close all writers.'''
+        for table_name in getattr(self, '_writers', {}).keys():
+            self._close_writer(table_name)
+        scan_conns = getattr(self, '_scan_conns', None)
+        while scan_conns is not None and not scan_conns.empty():
+            scan_conns.get_nowait().close()
         self._connected = False
         if hasattr(self, 'pool') and self.pool:
             self.pool.dispose()
@@ -257,20 +420,16 @@ class AStorage(StringKeyedStorage):
     def __del__(self):
         self.close()
 
+    @retry([AccumuloSecurityException])
     def _delete(self, table_name, keys):
-        batch_writer = BatchWriter(conn=self.conn,
-                                   table=self._ns(table_name),
-                                   max_memory=self._max_memory,
-                                   latency_ms=self._latency_ms,
-                                   timeout_ms=self._timeout_ms,
-                                   threads=self._threads)
-        try:
-            for key in keys:
-                mut = Mutation(key)
-                mut.put(cf='', cq='', is_delete=True)
-                batch_writer.add_mutation(mut)
-        finally:
-            batch_writer.close()
+        deletes = []
+        for key in keys:
+            mut = Mutation(key)
+            mut.put(cf='', cq='', is_delete=True)
+            deletes.append((mut, len(key)))
+        self._write(table_name, deletes)
+        # the next put to this table flushes these first
+        self._unflushed_deletes.add(table_name)
 
     def increment(self, table_name, *keys_and_values):
         '''Add values to a counter-type table.
@@ -293,6 +452,34 @@ class AStorage(StringKeyedStorage):
             super(AStorage, self).increment(table_name, *keys_and_values)
 
 
+def _range(start_key, stop_key, after_start=False):
+    '''Get a :class:`Range` of rows from `start_key` to `stop_key`.
+
+    Both ends are included, unless `after_start` is set, and an empty
+    string leaves that end unbounded.  Returns :const:`None` to scan
+    the whole table.
+
+    '''
+    if not (start_key or stop_key):
+        return None
+    # Accumulo treats None as a negative-infinity or
+    # positive-infinity key as needed for starts and ends
+    # of ranges.
+    #
+    # pyaccumulo has a bug at present 20140228_171555
+    # which causes it to never do a '>=' scan, so we must
+    # decrement the start key to include the start key
+    # which necessary for a get() operation.
+    # https://github.com/accumulo/pyaccumulo/issues/14
+    if after_start:
+        return Range(srow=start_key, erow=stop_key,
+                     sinclude=False, einclude=True)
+    if start_key:
+        start_key = _string_decrement(start_key)
+    return Range(srow=start_key, erow=stop_key,
+                 sinclude=True, einclude=True)
+
+
 def _string_decrement(x):
     if len(x) < 1:
         return None  # None is before all keys, aka negative infinity
@@ -9,8 +9,10 @@ https://github.com/diffeo/kvlayer-java-proxy
 '''
 
 from __future__ import absolute_import
+import collections
 import json
 import logging
+import Queue
 import random
 import socket
 import struct
@@ -21,31 +23,134 @@ import cbor
 
 from kvlayer._abstract_storage import StringKeyedStorage, COUNTER
 from kvlayer._exceptions import ProgrammerError
+from kvlayer._utils import batches
 
 logger = logging.getLogger(__name__)
 
 
 class SocketReader(object):
     '''
-    Simple adapter from socket.recv to file-like-read
+    Buffered adapter from socket.recv to file-like-read
+
+    Data is received with ``recv_into`` into a preallocated buffer of
+    `buffer_size` bytes, so reading many small CBOR tokens costs one
+    system call per buffer rather than one per token.  Reads larger
+    than the buffer are received straight into a buffer of their own
+    size, so multi-megabyte values are not built up by repeated
+    string concatenation.
     '''
-    def __init__(self, sock):
+    def __init__(self, sock, buffer_size=65536):
         self.socket = sock
         self.timeout_seconds = 10.0
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        # unread data is self._buf[self._start:self._end]
+        self._start = 0
+        self._end = 0
 
-    def read(self, num):
+    def _recv_into(self, view, num):
+        '''Receive at least `num` bytes into `view`; return the count.
+
+        Takes as much as is available, up to the size of `view`, but
+        stops early at end of file, or if `num` bytes have not arrived
+        within :attr:`timeout_seconds`.
+
+        '''
         start = time.time()
-        data = self.socket.recv(num)
-        while len(data) < num:
-            now = time.time()
-            if now > (start + self.timeout_seconds):
+        got = 0
+        while got < num:
+            ngot = self.socket.recv_into(view[got:])
+            if not ngot:
+                # end of file; return the partial read
+                break
+            got += ngot
+            if got < num and time.time() > (start + self.timeout_seconds):
                 break
-            ndat = self.socket.recv(num - len(data))
-            if ndat:
-                data += ndat
+        return got
+
+    def read(self, num):
+        end = self._start + num
+        if end <= self._end:
+            data = self._view[self._start:end].tobytes()
+            self._start = end
+            return data
+
+        available = self._end - self._start
+        if num > len(self._buf):
+            data = bytearray(num)
+            view = memoryview(data)
+            view[:available] = self._view[self._start:self._end]
+            self._start = self._end = 0
+            got = available + self._recv_into(view[available:],
+                                              num - available)
+            if got < num:
+                return view[:got].tobytes()
+            return str(data)
+
+        if end > len(self._buf):
+            # move the unread data to the front to make room
+            self._buf[:available] = self._buf[self._start:self._end]
+            self._start, self._end = 0, available
+        self._end += self._recv_into(self._view[self._end:],
+                                     num - available)
+        num = min(num, self._end - self._start)
+        data = self._view[self._start:self._start + num].tobytes()
+        self._start += num
         return data
 
 
+class PendingCall(object):
+    '''A request that has been sent, whose response may not be back.
+
+    Returned by :meth:`CborRpcClient._rpc_async`.  Call
+    :meth:`result` to wait for the response.
+
+    '''
+    def __init__(self, method_name):
+        self.method_name = method_name
+        self._done = threading.Event()
+        self._response = None
+        self._error = None
+
+    def _finish(self, response=None, error=None):
+        self._response = response
+        self._error = error
+        self._done.set()
+
+    def response(self):
+        '''Wait for and return the raw response message.
+
+        :raise Exception: if the connection failed before the
+          response arrived
+
+        '''
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._response
+
+    def result(self):
+        '''Wait for and return the result of the call.
+
+        :raise Exception: if the connection failed, or if the server
+          response was a failure
+
+        '''
+        return _response_result(self.response())
+
+
+def _response_result(response):
+    '''Get the result from a response, or raise its error.'''
+    if 'result' in response:
+        return response['result']
+    errormessage = response.get('error')
+    if errormessage and hasattr(errormessage, 'get'):
+        errormessage = errormessage.get('message')
+    if not errormessage:
+        errormessage = repr(response)
+    raise Exception(errormessage)
+
+
 class CborRpcClient(object):
     '''Base class for all client objects.
 
@@ -59,8 +164,15 @@ class CborRpcClient(object):
     3; wait 4s; try 4; wait 8s; try 5; FAIL. Total time waited just
     under base_retry_seconds * (2 ** retries).
 
+    Requests are pipelined: any number of threads may send requests
+    on the same connection without waiting for earlier responses,
+    and a reader thread matches each response to its request by
+    message id.  If the connection fails, every request waiting on
+    it fails.  Requests made with :meth:`_rpc_async` are not retried.
+
     .. automethod:: __init__
     .. automethod:: _rpc
+    .. automethod:: _rpc_async
     .. automethod:: close
 
     '''
@@ -84,11 +196,18 @@ class CborRpcClient(object):
         self._rfile = None
         self._local_addr = None
         self._message_count = 0
+        # message id to PendingCall, for the current socket
+        self._pending = {}
+        # guards all of the above; never held while sending, so the
+        # reader thread can always dispatch responses
+        self._lock = threading.Lock()
+        # held while sending one whole message on the socket
+        self._send_lock = threading.Lock()
         self._retries = config.get('retries', 5)
         self._base_retry_seconds = float(config.get('base_retry_seconds', 0.5))
 
     def _conn(self):
-        # lazy socket opener
+        # lazy socket opener; call with self._lock held
         if self._socket is None:
             try:
                 self._socket = socket.create_connection(self._socket_addr)
@@ -97,30 +216,119 @@ class CborRpcClient(object):
                 logger.error('error connecting to %r:%r', self._socket_addr[0],
                              self._socket_addr[1], exc_info=True)
                 raise
+            self._rfile = SocketReader(self._socket)
+            self._pending = {}
+            reader = threading.Thread(
+                target=self._read_responses,
+                args=(self._socket, self._rfile, self._pending),
+                name='kvlayer-cborrpc-reader')
+            reader.daemon = True
+            reader.start()
         return self._socket
 
+    @property
+    def connected(self):
+        '''Whether the connection to the server is open.'''
+        return self._socket is not None
+
     def close(self):
         '''Close the connection to the server.
 
-        The next RPC call will reopen the connection.
+        The next RPC call will reopen the connection.  Any calls
+        still waiting for responses fail.
 
         '''
-        if self._socket is not None:
+        with self._lock:
+            sock = self._socket
+            self._socket = None
             self._rfile = None
+        if sock is not None:
             try:
-                self._socket.shutdown(socket.SHUT_RDWR)
-                self._socket.close()
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
             except socket.error:
                 logger.warn('error closing lockd client socket',
                             exc_info=True)
-            self._socket = None
 
     @property
     def rfile(self):
-        if self._rfile is None:
+        with self._lock:
+            self._conn()
+            return self._rfile
+
+    def _read_responses(self, sock, rfile, pending):
+        '''Dispatch responses from one socket until it fails.'''
+        ## it's really time and file-space consuming to log all the
+        ## rpc data, but there are times when a developer needs to.
+        mlog = None
+        #mlog = logging.getLogger('cborrpc')
+        try:
+            while True:
+                response = cbor.load(rfile)
+                if mlog is not None:
+                    mlog.debug('response %r', response)
+                with self._lock:
+                    call = pending.pop(response.get('id'), None)
+                if call is None:
+                    logger.warn('response to unknown request %r',
+                                response.get('id'))
+                    continue
+                call._finish(response=response)
+        except Exception as ex:
+            error = ex
+        with self._lock:
+            if self._socket is sock:
+                self._socket = None
+                self._rfile = None
+            failed = pending.values()
+            pending.clear()
+        if failed:
+            logger.debug('connection to %r failed with %d calls pending',
+                         self._socket_addr, len(failed), exc_info=True)
+        for call in failed:
+            call._finish(error=error)
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    def _rpc_async(self, method_name, params):
+        '''Send a request to the server without waiting for a response.
+
+        Calls ``method_name(*params)`` remotely.  Returns a
+        :class:`PendingCall` whose :meth:`~PendingCall.result` is the
+        result of that function call.
+
+        '''
+        ## it's really time and file-space consuming to log all the
+        ## rpc data, but there are times when a developer needs to.
+        mlog = None
+        #mlog = logging.getLogger('cborrpc')
+        call = PendingCall(method_name)
+        with self._lock:
             conn = self._conn()
-            self._rfile = SocketReader(conn)
-        return self._rfile
+            pending = self._pending
+            self._message_count += 1
+            message = {
+                'id': self._message_count,
+                'method': method_name,
+                'params': params
+            }
+            pending[message['id']] = call
+        if mlog is not None:
+            mlog.debug('request %r', message)
+        data = cbor.dumps(message)
+        try:
+            # The server may not read this request until we have read
+            # its earlier responses, so the reader thread must not be
+            # kept waiting on self._lock while this blocks.
+            with self._send_lock:
+                conn.sendall(data)
+        except:
+            with self._lock:
+                pending.pop(message['id'], None)
+            raise
+        return call
 
     def _rpc(self, method_name, params):
         '''Call a method on the server.
@@ -132,42 +340,11 @@ class CborRpcClient(object):
         :raise Exception: if the server response was a failure
 
         '''
-        ## it's really time and file-space consuming to log all the
-        ## rpc data, but there are times when a developer needs to.
-        mlog = None
-        #mlog = logging.getLogger('cborrpc')
         tryn = 0
         delay = self._base_retry_seconds
-        self._message_count += 1
-        message = {
-            'id': self._message_count,
-            'method': method_name,
-            'params': params
-        }
-        if mlog is not None:
-            mlog.debug('request %r', message)
-        buf = cbor.dumps(message)
-
-        errormessage = None
         while True:
             try:
-                conn = self._conn()
-                conn.send(buf)
-                response = cbor.load(self.rfile)
-                if mlog is not None:
-                    mlog.debug('response %r', response)
-                assert response['id'] == message['id']
-                if 'result' in response:
-                    return response['result']
-                # From here on out we got a response, the server
-                # didn't have some weird intermittent error or
-                # non-connectivity, it gave us an error message. We
-                # don't retry that, we raise it to the user.
-                errormessage = response.get('error')
-                if errormessage and hasattr(errormessage, 'get'):
-                    errormessage = errormessage.get('message')
-                if not errormessage:
-                    errormessage = repr(response)
+                response = self._rpc_async(method_name, params).response()
                 break
             except Exception as ex:
                 if tryn < self._retries:
@@ -181,7 +358,10 @@ class CborRpcClient(object):
                 logger.error('failed in rpc %r %r', method_name, params,
                              exc_info=True)
                 raise
-        raise Exception(errormessage)
+        # From here on out we got a response, the server didn't have
+        # some weird intermittent error or non-connectivity, it gave us
+        # an error message. We don't retry that, we raise it to the user.
+        return _response_result(response)
 
 
 class CborProxyPooledConnection(object):
@@ -189,6 +369,9 @@ class CborProxyPooledConnection(object):
     usage:
         with pooled_conn as conn:
            conn._rpc(...)
+
+    Since :class:`CborRpcClient` pipelines requests, several users
+    may share one pooled connection at the same time.
     """
 
     def __init__(self, zk_addresses, proxy_addresses, username, password, instance_name):
@@ -199,24 +382,29 @@ class CborProxyPooledConnection(object):
         self._instance_name = instance_name
         self._conn = None  # CborRpcClient instance
         self.lock = threading.Lock()
-        self.owned = False
+        self.users = 0  # number of callers currently using this
         self.lastused = None # time.time() when last used. close if unused 30s
 
     def conn(self):
-        if not self._conn:
-            host, port = random.choice(self._proxy_addresses)
-            logger.debug('connecting to cbor proxy %s:%s', host, port)
-            self._conn = CborRpcClient({'address': (host, port), 'retries': 0})
-            zk_addr = random.choice(self._zk_addresses)
-            ok, msg = self._conn._rpc(
-                u'connect',
-                [unicode(zk_addr),
-                 unicode(self._username),
-                 unicode(self._password),
-                 unicode(self._instance_name)])
-            if not ok:
-                raise Exception(msg)
-        return self._conn
+        with self.lock:
+            if not (self._conn and self._conn.connected):
+                # (re)connect, and tell the proxy which database to use
+                host, port = random.choice(self._proxy_addresses)
+                logger.debug('connecting to cbor proxy %s:%s', host, port)
+                self._conn = CborRpcClient({'address': (host, port),
+                                            'retries': 0})
+                zk_addr = random.choice(self._zk_addresses)
+                ok, msg = self._conn._rpc(
+                    u'connect',
+                    [unicode(zk_addr),
+                     unicode(self._username),
+                     unicode(self._password),
+                     unicode(self._instance_name)])
+                if not ok:
+                    self._conn.close()
+                    self._conn = None
+                    raise Exception(msg)
+            return self._conn
 
     def close(self):
         if self._conn:
@@ -227,13 +415,11 @@ class CborProxyPooledConnection(object):
         return self.conn()
 
     def __exit__(self, exc_type, exc_value, traceback):
-        # todo, detect broken connection in exc_*
+        # A broken connection is reopened by the next conn(); other
+        # errors leave it usable by the other users.
         with self.lock:
-            self.owned = False
+            self.users -= 1
             self.lastused = time.time()
-            if (exc_value is not None) and (self._conn is not None):
-                self._conn.close()
-                self._conn = None
 
 
 class CborProxyConnectionPool(object):
@@ -243,35 +429,33 @@ class CborProxyConnectionPool(object):
         self.lastgc = None
         self.lock = threading.Lock()
 
-    def connect(self, zk_addresses, proxy_addresses, username, password, instance_name):
+    def connect(self, zk_addresses, proxy_addresses, username, password,
+                instance_name, max_connections=1):
         """Returns a CborProxyPooledConnection. Use in a with stamement.
         with pooled_connection as conn:
           conn.foo()
+
+        Up to `max_connections` connections are opened for the same
+        parameters; after that, the least busy one is shared.
         """
         with self.lock:
             # drop stale connections _before_ we try to use them.
             self.maybegc()
-            out = self._connect(zk_addresses, proxy_addresses, username, password, instance_name)
+            out = self._connect(zk_addresses, proxy_addresses, username,
+                                password, instance_name, max_connections)
             return out
 
-    def _connect(self, zk_addresses, proxy_addresses, username, password, instance_name):
+    def _connect(self, zk_addresses, proxy_addresses, username, password,
+                 instance_name, max_connections=1):
         key = json.dumps((zk_addresses, proxy_addresses, username, password, instance_name))
-        cons = self.they.get(key)
-        if cons:
-            for con in cons:
-                if not con.owned:
-                    with con.lock:
-                        if not con.owned:
-                            con.owned = True
-                            return con
-        newpc = CborProxyPooledConnection(zk_addresses, proxy_addresses, username, password, instance_name)
-        newpc.owned = True
-        if cons is None:
-            cons = [newpc]
-            self.they[key] = cons
-        else:
-            cons.append(newpc)
-        return newpc
+        cons = self.they.setdefault(key, [])
+        con = min(cons, key=lambda c: c.users) if cons else None
+        if con is None or (con.users > 0 and len(cons) < max_connections):
+            con = CborProxyPooledConnection(zk_addresses, proxy_addresses, username, password, instance_name)
+            cons.append(con)
+        with con.lock:
+            con.users += 1
+        return con
 
     def maybegc(self):
         # garbage collect old connections, at most every 5s
@@ -285,15 +469,16 @@ class CborProxyConnectionPool(object):
         now = time.time()
         too_old = now - 30
         for k, cons in self.they.iteritems():
-            # keep if owned, or not unused yet, or used recently enough
+            # keep if in use, or not unused yet, or used recently enough
             pos = 0
             while pos < len(cons):
                 c = cons[pos]
-                if c.owned or (c.lastused is None) or (c.lastused > too_old):
+                if c.users or (c.lastused is None) or (c.lastused > too_old):
                     # keep, move on
                     pos += 1
                 else:
                     cons.pop(pos)
+                    c.close()
 
 
 class CborProxyStorage(StringKeyedStorage):
@@ -305,6 +490,22 @@ class CborProxyStorage(StringKeyedStorage):
     instance_name: 'accumulo' or 'instance' are common accumulo cluster names
     username: database credential
     password: database credential
+
+    Optional config terms:
+    proxy_connections: connections to share among all users (default 2)
+    get_batch_size: keys per get request (default 1000)
+    put_batch_size: keys per put or delete request (default 1000)
+    max_pending_batches: requests of one get, put or delete waiting
+      for responses at a time (default 8)
+    scan_prefetch_pages: scan pages to fetch ahead of the caller
+      (default 1; 0 to fetch each page only when it is needed)
+
+    Large gets, puts and deletes are sent as several requests, up to
+    ``max_pending_batches`` in flight at once, spread over the shared
+    proxy connections.
+
+    :mod:`kvlayer._cbor_proxy_server` is an in-memory stand-in for
+    the proxy, for tests and benchmarks.
     '''
     global_pool = CborProxyConnectionPool()
 
@@ -333,10 +534,57 @@ class CborProxyStorage(StringKeyedStorage):
         self._proxy_connected = False
 
         self._connection_pool = kwargs.get('pool') or CborProxyStorage.global_pool
+        self._max_connections = int(self._config.get('proxy_connections', 2))
+        self._get_batch_size = int(self._config.get('get_batch_size', 1000))
+        self._put_batch_size = int(self._config.get('put_batch_size', 1000))
+        self._max_pending_batches = max(1, int(self._config.get(
+            'max_pending_batches', 8)))
+        self._scan_prefetch_pages = int(self._config.get(
+            'scan_prefetch_pages', 1))
 
     def pooled_conn(self):
         # return a CborProxyConnectionPool, use in with
-        return self._connection_pool.connect(self._zk_addresses, self._proxy_addresses, self._config.get('username'), self._config.get('password'), self._config.get('instance_name'))
+        return self._connection_pool.connect(self._zk_addresses, self._proxy_addresses, self._config.get('username'), self._config.get('password'), self._config.get('instance_name'), self._max_connections)
+
+    def _rpc_batches(self, method_name, table_name, items, batch_size):
+        '''Call `method_name` on batches of `items`, several at once.
+
+        Each batch is a separate request, and the requests are spread
+        over the pooled connections without waiting for responses,
+        until ``max_pending_batches`` are waiting; then each new
+        request waits for the oldest response.  Returns a list of the
+        results, in order.
+
+        '''
+        results = []
+        # pairs of (CborProxyPooledConnection, PendingCall), oldest first
+        pending = collections.deque()
+
+        def finish_oldest():
+            pc, call = pending.popleft()
+            try:
+                results.append(call.result())
+            finally:
+                pc.__exit__(None, None, None)
+
+        try:
+            for batch in batches(items, batch_size):
+                if len(pending) >= self._max_pending_batches:
+                    finish_oldest()
+                pc = self.pooled_conn()
+                try:
+                    call = pc.conn()._rpc_async(method_name,
+                                                [unicode(table_name), batch])
+                except:
+                    pc.__exit__(None, None, None)
+                    raise
+                pending.append((pc, call))
+            while pending:
+                finish_oldest()
+            return results
+        finally:
+            for pc, call in pending:
+                pc.__exit__(None, None, None)
 
     def _ns(self, table):
         return '%s_%s_%s' % (self._app_name, self._namespace, table)
@@ -382,56 +630,87 @@ class CborProxyStorage(StringKeyedStorage):
             conn._rpc(u'clear_table', [unicode(table_name)])
 
     def _put(self, table_name, keys_and_values):
-        with self.pooled_conn() as conn:
-            conn._rpc(u'put',
-                       [unicode(self._ns(table_name)), keys_and_values])
+        self._rpc_batches(u'put', self._ns(table_name), keys_and_values,
+                          self._put_batch_size)
 
     def _scan(self, table_name, key_ranges):
-        table_name = self._ns(table_name)
-        if not key_ranges:
-            key_ranges = [(None, None)]
-        cmd = [unicode(table_name), key_ranges]
-        with self.pooled_conn() as conn:
-            while cmd is not None:
-                resultob =  conn._rpc(u'scan', cmd)
-                results = None
-                next_command = None
-                if isinstance(resultob, list):
-                    results = resultob
-                if isinstance(resultob, dict):
-                    results = resultob.get('out')
-                    next_command = resultob.get('next')
-                if results:
-                    for k,v in results:
-                        yield k,v
-                cmd = next_command
+        for results in self._scan_pages(u'scan', table_name, key_ranges):
+            for k, v in results:
+                yield k, v
 
     def _scan_keys(self, table_name, key_ranges):
+        for results in self._scan_pages(u'scan_keys', table_name,
+                                        key_ranges):
+            for k in results:
+                yield k
+
+    def _scan_pages(self, method_name, table_name, key_ranges):
+        '''Yield the list of results from each page of a scan.
+
+        The proxy returns one page per request, along with the command
+        to get the next page.  With ``scan_prefetch_pages``, a
+        background thread requests the next pages as soon as each
+        arrives, keeping up to that many pages ready while the caller
+        works through the current one.
+
+        '''
         table_name = self._ns(table_name)
         if not key_ranges:
             key_ranges = [(None, None)]
-        cmd = [unicode(table_name), key_ranges]
-        with self.pooled_conn() as conn:
-            while cmd is not None:
-                resultob = conn._rpc(u'scan_keys', cmd)
-                results = None
-                next_command = None
-                if isinstance(resultob, list):
-                    results = resultob
-                elif isinstance(resultob, dict):
-                    results = resultob.get('out')
-                    next_command = resultob.get('next')
-                else:
-                    raise Exception('bad result from scan_keys, got {}'.format(type(resultob)))
-                if results:
-                    for k in results:
-                        yield k
-                cmd = next_command
+        first_cmd = [unicode(table_name), key_ranges]
+
+        if not self._scan_prefetch_pages:
+            with self.pooled_conn() as conn:
+                cmd = first_cmd
+                while cmd is not None:
+                    results, cmd = _scan_page(method_name,
+                                              conn._rpc(method_name, cmd))
+                    yield results
+            return
+
+        pages = Queue.Queue(maxsize=self._scan_prefetch_pages)
+        stop = threading.Event()
+
+        def send(item):
+            # give up if the caller has stopped reading
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def fetch():
+            try:
+                with self.pooled_conn() as conn:
+                    cmd = first_cmd
+                    while cmd is not None and not stop.is_set():
+                        results, cmd = _scan_page(
+                            method_name, conn._rpc(method_name, cmd))
+                        send(results)
+                send(None)
+            except Exception, exc:
+                send(exc)
+        fetcher = threading.Thread(target=fetch, name='kvlayer-cbor-scan')
+        fetcher.daemon = True
+        fetcher.start()
+        try:
+            while True:
+                results = pages.get()
+                if results is None:
+                    return
+                if isinstance(results, Exception):
+                    raise results
+                yield results
+        finally:
+            stop.set()
+            fetcher.join()
 
     def _get(self, table_name, keys):
         table_name = self._ns(table_name)
-        with self.pooled_conn() as conn:
-            return conn._rpc(u'get', [unicode(table_name), keys])
+        results = self._rpc_batches(u'get', table_name, keys,
+                                    self._get_batch_size)
+        return [kv for result in results for kv in result]
 
     def close(self):
         # everything is taken care of at pooled_conn context scope
@@ -439,8 +718,7 @@ class CborProxyStorage(StringKeyedStorage):
 
     def _delete(self, table_name, keys, **kwargs):
         table_name = self._ns(table_name)
-        with self.pooled_conn() as conn:
-            conn._rpc(u'delete', [unicode(table_name), keys])
+        self._rpc_batches(u'delete', table_name, keys, self._put_batch_size)
 
     def increment(self, table_name, *keys_and_values):
         assert self._value_types[table_name] is COUNTER, 'attempting to increment non-COUNTER table {}'.format(table_name)
@@ -476,3 +754,13 @@ class CborProxyStorage(StringKeyedStorage):
         if value_type is COUNTER:
             return struct.pack('>q', value)
         return super(CborProxyStorage, self).value_to_str(value, value_type)
+
+
+def _scan_page(method_name, resultob):
+    '''Get the results and next command from a scan response.'''
+    if isinstance(resultob, list):
+        return resultob, None
+    elif isinstance(resultob, dict):
+        return resultob.get('out') or [], resultob.get('next')
+    raise Exception('bad result from {0}, got {1}'
+                    .format(method_name, type(resultob)))
@@ -0,0 +1,315 @@
+'''Pure-Python stand-in for the CBOR RPC kvlayer proxy server.
+
+The ``cborproxy`` backend normally talks to the Java
+`kvlayer-java-proxy`_, which needs Accumulo and ZooKeeper behind it.
+This module implements the same RPC methods over an in-memory store,
+so that :class:`~kvlayer._cbor_proxy.CborProxyStorage` can be tested
+and its client-side performance measured without any of that.  Every
+request can be delayed by a fixed latency, and scans return pages of
+a fixed size, to mimic a remote server.
+
+Run it as a program to serve on a port::
+
+    python -m kvlayer._cbor_proxy_server --port 7321 --latency 0.001
+
+or start one in the background of a test::
+
+    server = CborProxyServer(latency_seconds=0.001, page_size=100)
+    host, port = server.start()
+    ...
+    server.stop()
+
+.. _kvlayer-java-proxy: https://github.com/diffeo/kvlayer-java-proxy
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+'''
+
+from __future__ import absolute_import
+import argparse
+import bisect
+import logging
+import socket
+import struct
+import threading
+import time
+
+import cbor
+
+from kvlayer._cbor_proxy import SocketReader
+from kvlayer._local_memory import SortedKeyIndex
+
+logger = logging.getLogger(__name__)
+
+
+class ProxyStore(object):
+    '''In-memory tables behind :class:`CborProxyServer`.
+
+    Keys and values are the serialized byte strings the client sends,
+    and scans run in byte order of the keys, as with Accumulo.  Each
+    public method is one RPC method; its arguments are the request
+    parameters and it returns the response result.
+
+    '''
+    def __init__(self, page_size=1000):
+        #: Maximum number of results per scan response
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        # table name to dictionary of key to value
+        self._tables = {}
+        # table name to SortedKeyIndex over its dictionary
+        self._indexes = {}
+
+    def connect(self, zk_addresses, username, password, instance_name):
+        return [True, u'connected to in-memory store']
+
+    def setup_namespace(self, table_names, value_types=None):
+        with self._lock:
+            for table in table_names:
+                if table not in self._tables:
+                    self._new_table(table)
+
+    def _new_table(self, table):
+        self._tables[table] = {}
+        self._indexes[table] = SortedKeyIndex(self._tables[table], None, [])
+
+    def delete_namespace(self, table_names):
+        with self._lock:
+            for table in table_names:
+                self._tables.pop(table, None)
+                self._indexes.pop(table, None)
+
+    def clear_table(self, table):
+        with self._lock:
+            self._new_table(table)
+
+    def put(self, table, keys_and_values):
+        with self._lock:
+            data = self._tables[table]
+            for k, v in keys_and_values:
+                data[k] = v
+            self._indexes[table].add([(k, k) for k, v in keys_and_values])
+        return True
+
+    def get(self, table, keys):
+        with self._lock:
+            data = self._tables[table]
+            return [[k, data.get(k)] for k in keys]
+
+    def delete(self, table, keys):
+        with self._lock:
+            data = self._tables[table]
+            index = self._indexes[table]
+            for k in keys:
+                if data.pop(k, None) is not None:
+                    index.discard(k)
+        return True
+
+    def increment(self, table, keys_and_values):
+        # COUNTER values are 8-byte big-endian integers, as for Accumulo
+        with self._lock:
+            data = self._tables[table]
+            new_keys = []
+            for k, v in keys_and_values:
+                old = data.get(k)
+                if old is None:
+                    new_keys.append((k, k))
+                    total = 0
+                else:
+                    total = struct.unpack('>q', old)[0]
+                data[k] = struct.pack('>q', total + struct.unpack('>q', v)[0])
+            self._indexes[table].add(new_keys)
+        return True
+
+    def scan(self, table, key_ranges):
+        return self._scan(table, key_ranges, False)
+
+    def scan_keys(self, table, key_ranges):
+        return self._scan(table, key_ranges, True)
+
+    def _scan(self, table, key_ranges, keys_only):
+        '''Get one page of a scan, and the command for the next page.
+
+        Both ends of each range are inclusive, and an empty or
+        :const:`None` end is unbounded.  The next command repeats the
+        ranges not yet finished, starting just after the last key
+        returned.
+
+        '''
+        out = []
+        next_command = None
+        with self._lock:
+            data = self._tables[table]
+            joined = self._indexes[table].joined
+            for n, (start, end) in enumerate(key_ranges):
+                room = self.page_size - len(out)
+                lo = bisect.bisect_left(joined, start) if start else 0
+                hi = bisect.bisect_right(joined, end) if end else len(joined)
+                keys = joined[lo:min(hi, lo + room)]
+                if keys_only:
+                    out.extend(keys)
+                else:
+                    out.extend([k, data[k]] for k in keys)
+                if hi - lo >= room:
+                    rest = key_ranges[n + 1:]
+                    if hi - lo > room:
+                        rest = [[keys[-1] + '\x00', end]] + rest
+                    if rest:
+                        next_command = [table, rest]
+                    break
+        return {'out': out, 'next': next_command}
+
+
+class CborProxyServer(object):
+    '''CBOR RPC server over a :class:`ProxyStore`.
+
+    Each connection is served by its own thread.  Unless
+    `sequential` is set, each request on a connection is handled on a
+    thread of its own too, so that pipelined requests overlap and may
+    be answered out of order, as a busy real proxy might.
+
+    '''
+    def __init__(self, address=('127.0.0.1', 0), latency_seconds=0.0,
+                 page_size=1000, sequential=False):
+        #: ``(host, port)`` to listen on; port 0 picks a free port
+        self.address = address
+        #: Delay before handling each request
+        self.latency_seconds = latency_seconds
+        #: Handle each connection's requests one at a time, in order
+        self.sequential = sequential
+        #: The in-memory :class:`ProxyStore`
+        self.store = ProxyStore(page_size=page_size)
+        self._listener = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        '''Start serving in a background thread.
+
+        :return: the ``(host, port)`` actually listened on
+
+        '''
+        self._listen()
+        thread = threading.Thread(target=self._accept_loop,
+                                  name='kvlayer-cbor-server')
+        thread.daemon = True
+        thread.start()
+        return self.address
+
+    def serve_forever(self):
+        '''Serve in this thread until :meth:`stop` is called.'''
+        self._listen()
+        self._accept_loop()
+
+    def stop(self):
+        '''Stop accepting connections.'''
+        self._stopped.set()
+        if self._listener is not None:
+            try:
+                self._listener.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._listener.close()
+
+    def _listen(self):
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(self.address)
+        self._listener.listen(64)
+        self.address = self._listener.getsockname()
+        logger.info('CBOR proxy stand-in listening on %s:%d', *self.address)
+
+    def _accept_loop(self):
+        while not self._stopped.is_set():
+            try:
+                sock, addr = self._listener.accept()
+            except socket.error:
+                if self._stopped.is_set():
+                    return
+                raise
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self._serve_connection,
+                                      args=(sock,),
+                                      name='kvlayer-cbor-server-conn')
+            thread.daemon = True
+            thread.start()
+
+    def _serve_connection(self, sock):
+        reader = SocketReader(sock)
+        send_lock = threading.Lock()
+        try:
+            while True:
+                try:
+                    message = cbor.load(reader)
+                except EOFError:
+                    return
+                if message.get('method') == u'shutdown':
+                    # the client expects the connection to just close
+                    self.stop()
+                    return
+                if self.sequential:
+                    self._handle(sock, send_lock, message)
+                else:
+                    thread = threading.Thread(
+                        target=self._handle,
+                        args=(sock, send_lock, message),
+                        name='kvlayer-cbor-server-request')
+                    thread.daemon = True
+                    thread.start()
+        except Exception:
+            logger.error('error reading from %r', sock.getpeername(),
+                         exc_info=True)
+        finally:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    def _handle(self, sock, send_lock, message):
+        '''Run one request and send its response.'''
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        response = {'id': message.get('id')}
+        try:
+            method = getattr(self.store, message['method'])
+            if message['method'].startswith('_'):
+                raise AttributeError(message['method'])
+            response['result'] = method(*message.get('params', []))
+        except Exception, exc:
+            logger.debug('error in %r', message.get('method'), exc_info=True)
+            response['error'] = {'message': u'{0}: {1}'.format(
+                type(exc).__name__, exc)}
+        data = cbor.dumps(response)
+        try:
+            with send_lock:
+                sock.sendall(data)
+        except socket.error:
+            logger.debug('could not send response', exc_info=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='in-memory stand-in for the kvlayer CBOR RPC proxy')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7321)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds to wait before handling each request')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='maximum results per scan response')
+    parser.add_argument('--sequential', action='store_true',
+                        help='handle requests on a connection one at a time')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = CborProxyServer((args.host, args.port),
+                             latency_seconds=args.latency,
+                             page_size=args.page_size,
+                             sequential=args.sequential)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
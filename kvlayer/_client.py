@@ -20,7 +20,9 @@ from kvlayer._accumulo import AStorage
 from kvlayer._cassandra import CStorage
 from kvlayer._local_memory import LocalStorage
 from kvlayer._file_storage import FileStorage
+from kvlayer._log_storage import LogFileStorage
 from kvlayer._redis import RedisStorage
+from kvlayer._sstable import SSTableStorage
 import yakonfig
 from yakonfig import ConfigurationError
 from yakonfig.cmd import ArgParseCmd
@@ -36,6 +38,11 @@ try:
 except ImportError:
     PostgresTableStorage = None
 
+try:
+    from kvlayer._sqlite import SqliteStorage
+except ImportError:
+    SqliteStorage = None
+
 try:
     from kvlayer._riak import RiakStorage
 except ImportError:
@@ -65,13 +72,17 @@ STORAGE_CLIENTS = dict(
     accumulo=AStorage,
     local=LocalStorage,
     filestorage=FileStorage,
-    redis=RedisStorage
+    logfile=LogFileStorage,
+    redis=RedisStorage,
+    sstable=SSTableStorage,
 )
 
 if PGStorage:
     STORAGE_CLIENTS['postgres'] = PGStorage
 if PostgresTableStorage:
     STORAGE_CLIENTS[PostgresTableStorage.config_name] = PostgresTableStorage
+if SqliteStorage:
+    STORAGE_CLIENTS['sqlite'] = SqliteStorage
 if RiakStorage:
     STORAGE_CLIENTS['riak'] = RiakStorage
 if SplitS3Storage:
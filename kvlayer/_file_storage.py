@@ -27,6 +27,7 @@ class FileStorage(AbstractLocalStorage):
     '''
 
     _datas = {}
+    _index_datas = {}
 
     def __init__(self, *args, **kwargs):
         super(FileStorage, self).__init__(*args, **kwargs)
@@ -34,6 +35,7 @@ class FileStorage(AbstractLocalStorage):
         filename = self._config['filename']
         if filename in self._datas:
             self._data = self._datas[filename]
+            self._indexes = self._index_datas[filename]
         else:
             if self._config.get('copy_to_filename', False):
                 copy_to_filename = self._config['copy_to_filename']
@@ -46,11 +48,14 @@ class FileStorage(AbstractLocalStorage):
                                      protocol=cPickle.HIGHEST_PROTOCOL,
                                      writeback=True)
             self._datas[filename] = self._data
+            self._indexes = {}
+            self._index_datas[filename] = self._indexes
 
         self._table_names = {}
 
     def delete_namespace(self):
         self._data.clear()
+        self._indexes.clear()
 
     def put(self, table_name, *keys_and_values, **kwargs):
         super(FileStorage, self).put(table_name, *keys_and_values, **kwargs)
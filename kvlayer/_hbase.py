@@ -8,6 +8,7 @@ Copyright 2012-2015 Diffeo, Inc.
 
 import contextlib
 import logging
+import Queue
 import random
 import time
 
@@ -15,6 +16,7 @@ import happybase as hbase
 
 from kvlayer._exceptions import ProgrammerError
 from kvlayer._abstract_storage import StringKeyedStorage
+from kvlayer._utils import batches, parallel_scan, split_key_range
 
 logger = logging.getLogger(__name__)
 
@@ -23,12 +25,26 @@ class HBaseStorage(StringKeyedStorage):
     '''
     HBase storage implements kvlayer's AbstractStorage, which
     manages a set of tables as specified in setup_namespace
+
+    With ``parallel_scan``, or if :meth:`scan` is called with
+    ``parallel=True``, scans are split at region boundaries and the
+    pieces are scanned concurrently on up to ``pool_size`` extra
+    connections, kept apart from the connection pool so that other
+    calls can still be made while a parallel scan is in progress.
+    Results still come back in key order, unless :meth:`scan` is also
+    called with ``ordered=False``, in which case they are returned as
+    soon as they arrive.
+
+    :meth:`get` fetches ``get_batch_size`` rows per Thrift call.
+    Scans fetch ``scan_batch_size`` rows per call (the scanner
+    "caching"); if ``scan_batching`` is set, the region servers also
+    return at most that many cells per row at a time.
     '''
     def __init__(self, *args, **kwargs):
         super(HBaseStorage, self).__init__(*args, **kwargs)
 
         addresses = self._config.get('storage_addresses', [])
-        pool_size = self._config.get('pool_size', 10)
+        self._pool_size = self._config.get('pool_size', 10)
         if not addresses:
             raise ProgrammerError('config lacks storage_addresses')
 
@@ -41,17 +57,29 @@ class HBaseStorage(StringKeyedStorage):
         prefix_sep = '_'
         prefix = '%s%s%s' % (self._app_name, prefix_sep, self._namespace)
         self._host, self._port = addr_port(raddr, 9090)
-        self._pool = hbase.ConnectionPool(pool_size, host=self._host,
-                                          port=self._port,
-                                          table_prefix=prefix,
-                                          table_prefix_separator=prefix_sep)
+        self._connection_args = dict(host=self._host, port=self._port,
+                                     table_prefix=prefix,
+                                     table_prefix_separator=prefix_sep)
+        self._pool = hbase.ConnectionPool(self._pool_size,
+                                          **self._connection_args)
+        # idle connections for parallel scan threads
+        self._scan_conns = Queue.LifoQueue()
 
         self.max_batch_bytes = int(self._config.get('max_batch_bytes',
                                                     10000000))
+        self._parallel_scan = self._config.get('parallel_scan', False)
+        self._get_batch_size = int(self._config.get('get_batch_size', 100))
+        self._scan_batch_size = int(self._config.get('scan_batch_size',
+                                                     1000))
+        self._scan_batching = self._config.get('scan_batching', None)
 
     config_name = 'hbase'
     default_config = {
         'max_batch_bytes': 10000000,
+        'parallel_scan': False,
+        'get_batch_size': 100,
+        'scan_batch_size': 1000,
+        'scan_batching': None,
     }
 
     @contextlib.contextmanager
@@ -72,6 +100,29 @@ class HBaseStorage(StringKeyedStorage):
                 yield conn
                 break
 
+    @contextlib.contextmanager
+    def _scan_conn(self):
+        '''Borrow a connection for one parallel scan thread.
+
+        These do not come from the connection pool: a scan thread
+        holds its connection until the caller has consumed its whole
+        piece, and the caller may well want to use the pool in the
+        meantime.  They are kept for later scans, and closed by
+        :meth:`close`.
+
+        '''
+        try:
+            conn = self._scan_conns.get_nowait()
+        except Queue.Empty:
+            conn = hbase.Connection(**self._connection_args)
+        try:
+            yield conn
+        except:
+            # don't reuse a connection in an unknown state
+            conn.close()
+            raise
+        self._scan_conns.put(conn)
+
     def _create_table(self, table):
         # See http://goo.gl/X1Tlaf for available options for column families.
         # Explicitly not enabling bloom filters for now because I don't know
@@ -80,12 +131,21 @@ class HBaseStorage(StringKeyedStorage):
         with self._conn() as conn:
             conn.create_table(table, {'d': dict(max_versions=1)})
 
-    def setup_namespace(self, table_names, value_types={}):
+    def setup_namespace(self, table_names, value_types={}, num_splits=0,
+                        split_samples={}):
         '''creates tables in the namespace.  Can be run multiple times with
         different table_names in order to expand the set of tables in
         the namespace. This operation is idempotent.
+
+        `num_splits` and `split_samples` are accepted for
+        compatibility with the Accumulo backend, but the HBase Thrift
+        interface cannot create pre-split tables, so they only cause
+        a warning.  Split tables with the HBase shell if needed.
         '''
         super(HBaseStorage, self).setup_namespace(table_names, value_types)
+        if num_splits > 1:
+            logger.warning('HBase Thrift cannot pre-split tables, '
+                           'ignoring num_splits=%d', num_splits)
         with self._conn() as conn:
             existing_tables = conn.tables()
             for table in table_names:
@@ -135,58 +195,95 @@ class HBaseStorage(StringKeyedStorage):
             if cur_bytes > 0:
                 batch.send()
 
-    def _scan(self, table_name, key_ranges):
-        with self._conn() as conn:
-            if not key_ranges:
-                key_ranges = [['', '']]
+    def _scan(self, table_name, key_ranges, parallel=None, ordered=True):
+        def scan_piece(conn, (start_key, stop_key)):
             table = conn.table(table_name)
-            for start_key, stop_key in key_ranges:
-                # start_row is inclusive >=
-                # end_row is exclusive <
-                if start_key or stop_key:
-                    scanner = table.scan(row_start=start_key,
-                                         row_stop=stop_key)
-                else:
-                    scanner = table.scan()
-
-                for row in scanner:
-                    yield (row[0], row[1]['d:d'])
-
-    def _scan_keys(self, table_name, key_ranges):
-        with self._conn() as conn:
-            if not key_ranges:
-                key_ranges = [['', '']]
+            # start_row is inclusive >=
+            # end_row is exclusive <
+            if start_key or stop_key:
+                scanner = table.scan(row_start=start_key,
+                                     row_stop=stop_key,
+                                     batch_size=self._scan_batch_size,
+                                     scan_batching=self._scan_batching)
+            else:
+                scanner = table.scan(batch_size=self._scan_batch_size,
+                                     scan_batching=self._scan_batching)
+
+            for row in scanner:
+                yield (row[0], row[1]['d:d'])
+        return self._scan_pieces(table_name, key_ranges, scan_piece,
+                                 parallel, ordered)
+
+    def _scan_keys(self, table_name, key_ranges, parallel=None,
+                   ordered=True):
+        def scan_piece(conn, (start_key, stop_key)):
             table = conn.table(table_name)
             hfilter = 'KeyOnlyFilter()'
-            for start_key, stop_key in key_ranges:
-                # start_row is inclusive >=
-                # end_row is exclusive <
-                if start_key or stop_key:
-                    scanner = table.scan(row_start=start_key,
-                                         row_stop=stop_key,
-                                         columns=(), filter=hfilter)
-                else:
-                    scanner = table.scan(columns=(), filter=hfilter)
-
-                for row in scanner:
-                    yield row[0]
+            # start_row is inclusive >=
+            # end_row is exclusive <
+            if start_key or stop_key:
+                scanner = table.scan(row_start=start_key,
+                                     row_stop=stop_key,
+                                     columns=(), filter=hfilter,
+                                     batch_size=self._scan_batch_size,
+                                     scan_batching=self._scan_batching)
+            else:
+                scanner = table.scan(columns=(), filter=hfilter,
+                                     batch_size=self._scan_batch_size,
+                                     scan_batching=self._scan_batching)
+
+            for row in scanner:
+                yield row[0]
+        return self._scan_pieces(table_name, key_ranges, scan_piece,
+                                 parallel, ordered)
+
+    def _scan_pieces(self, table_name, key_ranges, scan_piece, parallel,
+                     ordered):
+        '''Run `scan_piece` over `key_ranges`, maybe in parallel.
+
+        `scan_piece` is called with a connection and one
+        ``(start_key, stop_key)`` pair.  If `parallel` (defaulting to
+        the ``parallel_scan`` setting), the ranges are split at region
+        boundaries and the pieces are scanned on up to ``pool_size``
+        threads, each with its own connection from :meth:`_scan_conn`.
+
+        '''
+        if not key_ranges:
+            key_ranges = [['', '']]
+        if parallel is None:
+            parallel = self._parallel_scan
+        if not parallel:
+            def scan_serial():
+                for key_range in key_ranges:
+                    with self._conn() as conn:
+                        for item in scan_piece(conn, key_range):
+                            yield item
+            return scan_serial()
+
+        def scan_piece_in_thread(key_range):
+            with self._scan_conn() as conn:
+                for item in scan_piece(conn, key_range):
+                    yield item
+
+        with self._conn() as conn:
+            # Regions start at, and include, their start keys
+            boundaries = sorted(region['start_key'] for region
+                                in conn.table(table_name).regions())
+        pieces = []
+        for start_key, stop_key in key_ranges:
+            pieces.extend(split_key_range(start_key, stop_key, boundaries))
+        logger.debug('scanning %s in %d pieces', table_name, len(pieces))
+        return parallel_scan(scan_piece_in_thread, pieces, self._pool_size,
+                             ordered=ordered)
 
     def _get(self, table_name, keys):
         with self._conn() as conn:
             table = conn.table(table_name)
-            for key in keys:
-                cf = table.row(key, columns=['d:d'])
-                val = cf.get('d:d', None)
-                yield key, val
-                # TODO: is .row or .cells faster?
-                # values = table.cells(skey, 'd:d', versions=1)
-                # if values:
-                #     val = values[0]
-                #     yield key, val
-                #     num_values += 1
-                #     values_size += len(val)
-                # else:
-                #     yield key, None
+            for batch in batches(keys, self._get_batch_size):
+                # rows() leaves out rows that do not exist
+                found = dict(table.rows(batch, columns=['d:d']))
+                for key in batch:
+                    yield key, found.get(key, {}).get('d:d', None)
 
     def _delete(self, table_name, keys):
         with self._conn() as conn:
@@ -198,7 +295,9 @@ class HBaseStorage(StringKeyedStorage):
 
     def close(self):
         # There is no way to close a happybase connection pool.
-        return
+        scan_conns = getattr(self, '_scan_conns', None)
+        while scan_conns is not None and not scan_conns.empty():
+            scan_conns.get_nowait().close()
 
     def __del__(self):
         self.close()
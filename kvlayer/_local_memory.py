@@ -14,20 +14,196 @@ it stores all :mod:`kvlayer` data in a Python dictionary.
 
 '''
 from __future__ import absolute_import
+import bisect
 import logging
 import time
 
-from kvlayer._abstract_storage import AbstractStorage
+from kvlayer._abstract_storage import AbstractStorage, CacheStats
 from kvlayer._utils import _requires_connection
 
 logger = logging.getLogger(__name__)
 
 
+class SortedKeyIndex(object):
+    '''Sorted index of serialized keys over one table dictionary.
+
+    This keeps the serialized form of every key in a table in sorted
+    order, along with the original key tuples in the same order, so
+    that a range scan is a pair of binary searches followed by a
+    slice.  The index remembers which dictionary and encoder it was
+    built from; :meth:`AbstractLocalStorage._sorted_index` rebuilds
+    it if either changes underneath it.
+
+    '''
+
+    #: Above this many keys, :meth:`add` re-sorts instead of inserting
+    bulk_add_threshold = 100
+
+    def __init__(self, table, encoder_name, joined_and_keys):
+        #: Table dictionary this indexes
+        self.table = table
+        #: :attr:`~kvlayer.encoders.base.Encoder.config_name` of the
+        #: encoder that produced the serialized keys
+        self.encoder_name = encoder_name
+        pairs = sorted(joined_and_keys)
+        #: Sorted list of serialized keys
+        self.joined = [jk for (jk, k) in pairs]
+        #: Key tuples, in the same order as :attr:`joined`
+        self.keys = [k for (jk, k) in pairs]
+
+    def add(self, joined_and_keys):
+        '''Add (or replace) some `(joined_key, key)` pairs.'''
+        if len(joined_and_keys) > self.bulk_add_threshold:
+            # cheaper to re-sort once than to shift the lists per key
+            merged = dict(zip(self.joined, self.keys))
+            merged.update(joined_and_keys)
+            pairs = sorted(merged.iteritems())
+            self.joined = [jk for (jk, k) in pairs]
+            self.keys = [k for (jk, k) in pairs]
+            return
+        for jk, k in joined_and_keys:
+            i = bisect.bisect_left(self.joined, jk)
+            if i < len(self.joined) and self.joined[i] == jk:
+                self.keys[i] = k
+            else:
+                self.joined.insert(i, jk)
+                self.keys.insert(i, k)
+
+    def discard(self, joined_key):
+        '''Remove a serialized key, if it is present.'''
+        i = bisect.bisect_left(self.joined, joined_key)
+        if i < len(self.joined) and self.joined[i] == joined_key:
+            del self.joined[i]
+            del self.keys[i]
+
+    def range(self, start, finish):
+        '''Get `(joined_key, key)` pairs between `start` and `finish`.
+
+        Either bound may be :const:`None` to mean the start or end of
+        the table; otherwise both are inclusive.  This returns a copy,
+        so the caller may modify the table while iterating.
+
+        '''
+        if start is None:
+            lo = 0
+        else:
+            lo = bisect.bisect_left(self.joined, start)
+        if finish is None:
+            hi = len(self.joined)
+        else:
+            hi = bisect.bisect_right(self.joined, finish)
+        return zip(self.joined[lo:hi], self.keys[lo:hi])
+
+
+class JoinedKeyCache(object):
+    '''Bounded least-recently-used cache of serialized keys.
+
+    Entries are kept per table, so that a single key or a whole table
+    can be dropped when it is deleted, but all tables share a single
+    size limit and a single recency order.  Hits, misses, and evictions
+    are counted per table in :attr:`stats`.
+
+    '''
+
+    # fields of each link in the circular recency list
+    PREV, NEXT, TABLE, KEY, VALUE = range(5)
+
+    def __init__(self, max_size, stats=None):
+        #: Maximum number of entries; 0 disables caching
+        self.max_size = max_size
+        #: :class:`~kvlayer._abstract_storage.CacheStats` for lookups
+        self.stats = stats if stats is not None else CacheStats()
+        # map of table name to map of key to link
+        self._tables = {}
+        # sentinel of the recency list; root[NEXT] is least recent
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def table_size(self, table_name):
+        '''Get the number of entries cached for `table_name`.'''
+        return len(self._tables.get(table_name, ()))
+
+    def get(self, table_name, key):
+        '''Get the cached value for `key`, or :const:`None`.'''
+        link = self._tables.get(table_name, {}).get(key)
+        if link is None:
+            self.stats.miss(table_name)
+            return None
+        self.stats.hit(table_name)
+        self._unlink(link)
+        self._append(link)
+        return link[self.VALUE]
+
+    def put(self, table_name, key, value):
+        '''Cache `value` for `key`, evicting old entries if needed.'''
+        if self.max_size <= 0:
+            return
+        links = self._tables.setdefault(table_name, {})
+        link = links.get(key)
+        if link is not None:
+            link[self.VALUE] = value
+            self._unlink(link)
+            self._append(link)
+            return
+        link = [None, None, table_name, key, value]
+        links[key] = link
+        self._append(link)
+        self._size += 1
+        while self._size > self.max_size:
+            oldest = self._root[self.NEXT]
+            self.stats.evict(oldest[self.TABLE])
+            self._remove(oldest)
+
+    def discard(self, table_name, key):
+        '''Drop `key` from the cache, if it is present.'''
+        link = self._tables.get(table_name, {}).get(key)
+        if link is not None:
+            self._remove(link)
+
+    def clear_table(self, table_name):
+        '''Drop every entry for `table_name`.'''
+        for link in self._tables.pop(table_name, {}).itervalues():
+            self._unlink(link)
+            self._size -= 1
+
+    def clear(self):
+        '''Drop every entry.'''
+        self._tables = {}
+        self._root[:] = [self._root, self._root, None, None, None]
+        self._size = 0
+
+    def _append(self, link):
+        last = self._root[self.PREV]
+        link[self.PREV] = last
+        link[self.NEXT] = self._root
+        last[self.NEXT] = link
+        self._root[self.PREV] = link
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+    def _remove(self, link):
+        self._unlink(link)
+        links = self._tables[link[self.TABLE]]
+        del links[link[self.KEY]]
+        if not links:
+            del self._tables[link[self.TABLE]]
+        self._size -= 1
+
+
 class AbstractLocalStorage(AbstractStorage):
     """Local in-memory storage for testing.
 
     This is a base class for storage implementations that use a
-    dictionary-like object for actually holding data.
+    dictionary-like object for actually holding data.  Subclasses
+    must provide `_data`, the dictionary-like object, and `_indexes`,
+    a plain dictionary shared exactly as widely as `_data` that holds
+    the :class:`SortedKeyIndex` for each table.
 
     """
 
@@ -35,11 +211,20 @@ class AbstractLocalStorage(AbstractStorage):
         super(AbstractLocalStorage, self).__init__(*args, **kwargs)
         self._connected = False
         self._raise_on_missing = self._config.get('raise_on_missing', True)
-        self._joined_key_cache = dict()
+        if self._log_stats is not None:
+            cache_stats = self._log_stats.cache('joined_key')
+        else:
+            cache_stats = None
+        self._joined_key_cache = JoinedKeyCache(
+            self._config.get('joined_key_cache_size', 100000), cache_stats)
 
     def setup_namespace(self, table_names, value_types={}):
+        old_key_specs = dict(self._table_names)
         super(AbstractLocalStorage, self).setup_namespace(
             table_names, value_types)
+        for table in table_names:
+            if old_key_specs.get(table) != self._table_names[table]:
+                self._joined_key_cache.clear_table(table)
 
         if self._app_name not in self._data:
             self._data[self._app_name] = {}
@@ -48,7 +233,7 @@ class AbstractLocalStorage(AbstractStorage):
 
         for table in table_names:
             if table not in self.data:
-                self.data[table] = dict()
+                self.data[table] = self._new_table(table)
 
         self._connected = True
 
@@ -59,6 +244,10 @@ class AbstractLocalStorage(AbstractStorage):
             if not self._data[self._app_name]:
                 # empty now? del that too.
                 del self._data[self._app_name]
+        self._joined_key_cache.clear()
+        for index_key in self._indexes.keys():
+            if index_key[:2] == (self._app_name, self._namespace):
+                del self._indexes[index_key]
 
     @property
     def data(self):
@@ -67,7 +256,40 @@ class AbstractLocalStorage(AbstractStorage):
 
     @_requires_connection
     def clear_table(self, table_name):
-        self.data[table_name] = dict()
+        self.data[table_name] = self._new_table(table_name)
+        self._joined_key_cache.clear_table(table_name)
+        self._indexes.pop((self._app_name, self._namespace, table_name),
+                          None)
+
+    def _new_table(self, table_name):
+        '''Create the dictionary-like object holding a single table.'''
+        return dict()
+
+    def _sorted_index(self, table_name, create=True):
+        '''Get the :class:`SortedKeyIndex` for `table_name`.
+
+        If there is no index yet, or the existing index was built
+        against a different table dictionary or encoder, build a new
+        one if `create` is true, or return :const:`None` otherwise.
+
+        '''
+        index_key = (self._app_name, self._namespace, table_name)
+        table = self.data[table_name]
+        index = self._indexes.get(index_key)
+        if ((index is not None and index.table is table and
+             index.encoder_name == self._encoder.config_name)):
+            return index
+        if not create:
+            self._indexes.pop(index_key, None)
+            return None
+        # serialize directly, rather than flushing the whole joined
+        # key cache through with every key in the table
+        key_spec = self._table_names[table_name]
+        index = SortedKeyIndex(table, self._encoder.config_name,
+                               ((self._encoder.serialize(key, key_spec), key)
+                                for key in table.iterkeys()))
+        self._indexes[index_key] = index
+        return index
 
     @_requires_connection
     def put(self, table_name, *keys_and_values, **kwargs):
@@ -75,14 +297,27 @@ class AbstractLocalStorage(AbstractStorage):
         keys_size = 0
         values_size = 0
         num_keys = 0
-        for key, val in keys_and_values:
-            key_spec = self._table_names[table_name]
-            self.check_put_key_value(key, val, table_name, key_spec)
-            self.data[table_name][key] = val
-            if self._log_stats is not None:
-                num_keys += 1
-                keys_size += len(self._encoder.serialize(key, key_spec))
-                values_size += len(str(val))
+        key_spec = self._table_names[table_name]
+        # Only maintain the sorted index if something has scanned
+        # this table already; otherwise the next scan builds it
+        index = self._sorted_index(table_name, create=False)
+        new_keys = []
+        try:
+            for key, val in keys_and_values:
+                self.check_put_key_value(key, val, table_name, key_spec)
+                if index is not None and key not in self.data[table_name]:
+                    new_keys.append((self._get_joined_key(table_name, key),
+                                     key))
+                self.data[table_name][key] = val
+                if self._log_stats is not None:
+                    num_keys += 1
+                    keys_size += len(self._encoder.serialize(key, key_spec))
+                    values_size += len(str(val))
+        finally:
+            # even if a bad pair stops the put part way, the index
+            # must cover every key already stored
+            if new_keys:
+                index.add(new_keys)
 
         end_time = time.time()
         num_values = num_keys
@@ -90,22 +325,22 @@ class AbstractLocalStorage(AbstractStorage):
         self.log_put(table_name, start_time, end_time, num_keys, keys_size,
                      num_values, values_size)
 
-    def _get_joined_key(self, key, key_spec):
+    def _get_joined_key(self, table_name, key):
         '''To ensure that this acts like big disk-bound DBs, we ensure that
         the sort order coming out of this in-memory mock matches the
         serialized sorted key order.  This requires serializing the
         key according to the key spec.  If an application does this
         frequently, then it can be expensive.  This caches the
-        serialized key strings for faster access.
+        serialized key strings for faster access, in a bounded cache
+        of ``joined_key_cache_size`` entries.
 
         '''
-        _key = (key, key_spec)
-        if _key in self._joined_key_cache:
-            return self._joined_key_cache[_key]
-        else:
-            joined_key = self._encoder.serialize(key, key_spec)
-            self._joined_key_cache[_key] = joined_key
-            return joined_key
+        joined_key = self._joined_key_cache.get(table_name, key)
+        if joined_key is None:
+            joined_key = self._encoder.serialize(
+                key, self._table_names[table_name])
+            self._joined_key_cache.put(table_name, key, joined_key)
+        return joined_key
 
     @_requires_connection
     def scan(self, table_name, *key_ranges, **kwargs):
@@ -119,22 +354,19 @@ class AbstractLocalStorage(AbstractStorage):
         key_ranges = list(key_ranges)
         if not key_ranges:
             key_ranges = [[None, None]]
+        # LocalStorage does get/put on the Python tuple as the key,
+        # but scans in serialized key order to match the real databases
+        index = self._sorted_index(table_name)
+        table = self.data[table_name]
         for start, finish in key_ranges:
-            total_count = 0
             start = self._encoder.make_start_key(start, key_spec)
             finish = self._encoder.make_end_key(finish, key_spec)
-            for key in sorted(self.data[table_name].iterkeys()):
-                # given a range, mimic the behavior of DBs that tell
-                # you if they failed to find a key
-                # LocalStorage does get/put on the Python tuple as the key,
-                # stringify for sort comparison
-                joined_key = self._get_joined_key(key, key_spec)
-                if (start is not None) and (start > joined_key):
+            for joined_key, key in index.range(start, finish):
+                try:
+                    val = table[key]
+                except KeyError:
+                    # deleted while we were yielding earlier results
                     continue
-                if (finish is not None) and (finish < joined_key):
-                    continue
-                total_count += 1
-                val = self.data[table_name][key]
                 yield key, val
 
                 if self._log_stats is not None:
@@ -179,12 +411,18 @@ class AbstractLocalStorage(AbstractStorage):
         num_keys = 0
         keys_size = 0
 
+        key_spec = self._table_names[table_name]
+        index = self._sorted_index(table_name, create=False)
+        table = self.data[table_name]
         for key in keys:
             if self._log_stats is not None:
-                key_spec = self._table_names[table_name]
                 num_keys += 1
                 keys_size += len(self._encoder.serialize(key, key_spec))
-            self.data[table_name].pop(key, None)
+            if key in table:
+                del table[key]
+                if index is not None:
+                    index.discard(self._get_joined_key(table_name, key))
+            self._joined_key_cache.discard(table_name, key)
 
         end_time = time.time()
         self.log_delete(table_name, start_time, end_time, num_keys, keys_size)
@@ -207,6 +445,7 @@ class LocalStorage(AbstractLocalStorage):
     """
 
     _data = {}
+    _indexes = {}
 
     def __init__(self, config=None, app_name=None, namespace=None,
                  *args, **kwargs):
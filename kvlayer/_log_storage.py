@@ -0,0 +1,393 @@
+'''Append-only log file backend for kvlayer.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+
+The :class:`LogFileStorage` backend keeps every write in an
+append-only log file, and keeps only the location of each value in
+memory.  Unlike :class:`~kvlayer._file_storage.FileStorage`, the cost
+of a write is proportional to the size of that write and not to the
+size of the whole store.  Old and deleted values are reclaimed by
+periodically rewriting the log with only the live records.
+
+.. autoclass:: LogFileStorage
+   :show-inheritance:
+
+.. autoclass:: LogFile
+
+'''
+from __future__ import absolute_import
+import cPickle
+import logging
+import os
+import struct
+import time
+import zlib
+
+from kvlayer._exceptions import ConfigurationError
+from kvlayer._local_memory import AbstractLocalStorage
+
+logger = logging.getLogger(__name__)
+
+#: Bytes at the start of every log file
+MAGIC = b'KVLLOG01'
+
+#: Record header: operation, CRC-32 of the body, path length, value length
+HEADER = struct.Struct('>BIII')
+
+#: Record operations
+PUT, DELETE, CLEAR_TABLE, DELETE_NAMESPACE = 1, 2, 3, 4
+
+
+class LogTable(object):
+    '''Dictionary-like view of a single table in a :class:`LogFile`.
+
+    Values are not held in memory; this maps each key to the location
+    of its value in the log, and reads values back on demand.
+
+    '''
+
+    def __init__(self, log, path):
+        self._log = log
+        #: ``(app_name, namespace, table_name)`` of this table
+        self.path = path
+        #: Map of key to (value offset, value length, record length)
+        self.offsets = {}
+        #: Total size of the live records for this table
+        self.live_bytes = 0
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def iterkeys(self):
+        return self.offsets.iterkeys()
+
+    def __getitem__(self, key):
+        offset, length, _ = self.offsets[key]
+        return cPickle.loads(self._log.read(offset, length))
+
+    def __setitem__(self, key, value):
+        self._forget(key)
+        self._remember(key, self._log.append(
+            PUT, self.path + (key,),
+            cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)))
+
+    def __delitem__(self, key):
+        if key not in self.offsets:
+            raise KeyError(key)
+        self._forget(key)
+        self._log.append(DELETE, self.path + (key,), b'')
+
+    def _remember(self, key, location):
+        self.offsets[key] = location
+        self.live_bytes += location[2]
+        self._log.live_bytes += location[2]
+
+    def _forget(self, key):
+        location = self.offsets.pop(key, None)
+        if location is not None:
+            self.live_bytes -= location[2]
+            self._log.live_bytes -= location[2]
+
+
+class LogFile(object):
+    '''Append-only log of kvlayer writes, with an in-memory index.
+
+    Records are buffered until :meth:`commit`, which writes all of
+    them with a single system call.  :func:`os.fsync` is only called
+    once `sync_ops` records or `sync_seconds` seconds have accumulated
+    since the last one, so many small commits share a single disk
+    flush.  If more than `compact_ratio` of the file is dead records,
+    and the file is at least `compact_min_bytes` long, :meth:`commit`
+    also rewrites the file with only the live records.
+
+    A record that was torn by a crash is detected by its checksum,
+    and the log is truncated just before it when it is next opened.
+
+    '''
+
+    def __init__(self, filename, sync_ops=1000, sync_seconds=1.0,
+                 compact_ratio=0.5, compact_min_bytes=2**20):
+        self.filename = filename
+        self.sync_ops = sync_ops
+        self.sync_seconds = sync_seconds
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        #: Nested dictionary of app name to namespace to table name
+        #: to :class:`LogTable`
+        self.data = {}
+        #: Sorted key indexes for :class:`LogFileStorage`
+        self.indexes = {}
+        #: Total size of records that are still needed
+        self.live_bytes = 0
+        #: Logical size of the log, including uncommitted records
+        self.size = 0
+        self._pending = []
+        self._written = 0
+        self._unsynced = 0
+        self._last_sync = time.time()
+        self._load()
+        self._open()
+
+    def table(self, app_name, namespace, table_name):
+        '''Get (or create) the :class:`LogTable` for a table.'''
+        tables = self.data.setdefault(app_name, {}).setdefault(namespace, {})
+        if table_name not in tables:
+            tables[table_name] = LogTable(
+                self, (app_name, namespace, table_name))
+        return tables[table_name]
+
+    def _record(self, op, path, value):
+        head = cPickle.dumps(path, cPickle.HIGHEST_PROTOCOL)
+        crc = zlib.crc32(value, zlib.crc32(head)) & 0xffffffff
+        return HEADER.pack(op, crc, len(head), len(value)) + head + value
+
+    def append(self, op, path, value):
+        '''Add a record to the end of the log.
+
+        The record is not written to the file until :meth:`commit`.
+
+        :param int op: record operation, such as :data:`PUT`
+        :param tuple path: app name, namespace, and possibly table
+          name and key this record affects
+        :param bytes value: serialized value, or empty string
+        :return: tuple of offset of `value`, length of `value`, and
+          length of the record
+
+        '''
+        record = self._record(op, path, value)
+        offset = self.size + len(record) - len(value)
+        self._pending.append(record)
+        self.size += len(record)
+        self._unsynced += 1
+        return (offset, len(value), len(record))
+
+    def read(self, offset, length):
+        '''Read `length` bytes from the log at `offset`.'''
+        if offset + length > self._written:
+            self.flush()
+        os.lseek(self._read_fd, offset, os.SEEK_SET)
+        data = os.read(self._read_fd, length)
+        while len(data) < length:
+            more = os.read(self._read_fd, length - len(data))
+            if not more:
+                raise IOError('short read from {0!r} at {1}'
+                              .format(self.filename, offset))
+            data += more
+        return data
+
+    def clear_table(self, table):
+        '''Record that every key in the :class:`LogTable` is gone.'''
+        self.live_bytes -= table.live_bytes
+        self.append(CLEAR_TABLE, table.path, b'')
+
+    def delete_namespace(self, app_name, namespace):
+        '''Record that every table in a namespace is gone.'''
+        for table in self.data.get(app_name, {}).get(namespace, {}) \
+                              .itervalues():
+            self.live_bytes -= table.live_bytes
+        self.append(DELETE_NAMESPACE, (app_name, namespace), b'')
+
+    def flush(self):
+        '''Write all pending records to the file, without syncing.'''
+        if self._pending:
+            data = b''.join(self._pending)
+            self._pending = []
+            while data:
+                n = os.write(self._write_fd, data)
+                data = data[n:]
+            self._written = self.size
+
+    def sync(self):
+        '''Write all pending records and force them to disk.'''
+        self.flush()
+        os.fsync(self._write_fd)
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def commit(self):
+        '''Finish a storage operation.
+
+        This writes out pending records, syncs the file if enough
+        records or time have accumulated, and compacts the log if
+        enough of it is dead.
+
+        '''
+        self.flush()
+        if (((self.sync_ops is not None and
+              self._unsynced >= self.sync_ops) or
+             (self.sync_seconds is not None and
+              time.time() - self._last_sync >= self.sync_seconds))):
+            self.sync()
+        if ((self.size >= self.compact_min_bytes and
+             self.size - self.live_bytes > self.size * self.compact_ratio)):
+            self.compact()
+
+    def compact(self):
+        '''Rewrite the log with only its live records.'''
+        self.flush()
+        tmpname = self.filename + '.compact'
+        new_offsets = []
+        with open(tmpname, 'wb') as f:
+            f.write(MAGIC)
+            position = len(MAGIC)
+            for namespaces in self.data.itervalues():
+                for tables in namespaces.itervalues():
+                    for table in tables.itervalues():
+                        offsets = {}
+                        for key, (offset, length, _) \
+                                in table.offsets.iteritems():
+                            value = self.read(offset, length)
+                            record = self._record(PUT, table.path + (key,),
+                                                  value)
+                            f.write(record)
+                            position += len(record)
+                            offsets[key] = (position - length, length,
+                                            len(record))
+                        new_offsets.append((table, offsets))
+            f.flush()
+            os.fsync(f.fileno())
+        logger.debug('compacted %s from %d to %d bytes',
+                     self.filename, self.size, position)
+        os.rename(tmpname, self.filename)
+        self.close()
+        self._open()
+        self.live_bytes = 0
+        for table, offsets in new_offsets:
+            table.offsets = offsets
+            table.live_bytes = sum(rl for (_, _, rl) in offsets.itervalues())
+            self.live_bytes += table.live_bytes
+        self.size = self._written = position
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def _open(self):
+        self._write_fd = os.open(self.filename,
+                                 os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        self._read_fd = os.open(self.filename, os.O_RDONLY)
+
+    def close(self):
+        '''Close the underlying file descriptors.'''
+        os.close(self._write_fd)
+        os.close(self._read_fd)
+
+    def _load(self):
+        '''Rebuild the in-memory index by replaying the file.'''
+        if not os.path.exists(self.filename) or \
+           os.path.getsize(self.filename) == 0:
+            with open(self.filename, 'wb') as f:
+                f.write(MAGIC)
+            self.size = self._written = len(MAGIC)
+            return
+        with open(self.filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ConfigurationError('{0!r} is not a kvlayer log file'
+                                         .format(self.filename))
+            position = len(MAGIC)
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                op, crc, head_len, value_len = HEADER.unpack(header)
+                head = f.read(head_len)
+                value = f.read(value_len)
+                if ((len(head) < head_len or len(value) < value_len or
+                     zlib.crc32(value, zlib.crc32(head)) & 0xffffffff != crc)):
+                    break
+                record_len = HEADER.size + head_len + value_len
+                self._replay(op, cPickle.loads(head),
+                             (position + record_len - value_len, value_len,
+                              record_len))
+                position += record_len
+        if position < os.path.getsize(self.filename):
+            logger.warn('truncating torn record at end of %s (offset %d)',
+                        self.filename, position)
+            with open(self.filename, 'r+b') as f:
+                f.truncate(position)
+        self.size = self._written = position
+
+    def _replay(self, op, path, location):
+        if op == PUT:
+            table = self.table(*path[:3])
+            table._forget(path[3])
+            table._remember(path[3], location)
+        elif op == DELETE:
+            self.table(*path[:3])._forget(path[3])
+        elif op == CLEAR_TABLE:
+            tables = self.data.get(path[0], {}).get(path[1], {})
+            table = tables.pop(path[2], None)
+            if table is not None:
+                self.live_bytes -= table.live_bytes
+        elif op == DELETE_NAMESPACE:
+            namespaces = self.data.get(path[0], {})
+            for table in namespaces.pop(path[1], {}).itervalues():
+                self.live_bytes -= table.live_bytes
+            if not namespaces:
+                self.data.pop(path[0], None)
+        else:
+            raise ConfigurationError('unknown record type {0} in {1!r}'
+                                     .format(op, self.filename))
+
+
+class LogFileStorage(AbstractLocalStorage):
+    '''Append-only log file storage.
+
+    All instances using the same file share the same underlying
+    :class:`LogFile`.  Only one process may write to a given file at
+    a time.
+
+    '''
+
+    _logs = {}
+
+    def __init__(self, *args, **kwargs):
+        super(LogFileStorage, self).__init__(*args, **kwargs)
+        filename = self._config['filename']
+        if filename not in self._logs:
+            self._logs[filename] = LogFile(
+                filename,
+                sync_ops=self._config.get('log_sync_ops', 1000),
+                sync_seconds=self._config.get('log_sync_seconds', 1.0),
+                compact_ratio=self._config.get('log_compact_ratio', 0.5),
+                compact_min_bytes=self._config.get('log_compact_min_bytes',
+                                                   2**20))
+        self._log = self._logs[filename]
+        self._data = self._log.data
+        self._indexes = self._log.indexes
+
+    def _new_table(self, table_name):
+        return LogTable(self._log,
+                        (self._app_name, self._namespace, table_name))
+
+    def delete_namespace(self):
+        self._log.delete_namespace(self._app_name, self._namespace)
+        super(LogFileStorage, self).delete_namespace()
+        self._log.commit()
+
+    def clear_table(self, table_name):
+        self._log.clear_table(self.data[table_name])
+        super(LogFileStorage, self).clear_table(table_name)
+        self._log.commit()
+
+    def put(self, table_name, *keys_and_values, **kwargs):
+        super(LogFileStorage, self).put(table_name, *keys_and_values,
+                                        **kwargs)
+        self._log.commit()
+
+    def delete(self, table_name, *keys):
+        super(LogFileStorage, self).delete(table_name, *keys)
+        self._log.commit()
+
+    def sync(self):
+        '''Force all writes so far to disk.'''
+        self._log.sync()
+
+    def close(self):
+        self._log.sync()
+        super(LogFileStorage, self).close()
@@ -14,7 +14,11 @@ Copyright 2012-2015 Diffeo, Inc.
 from __future__ import absolute_import
 import contextlib
 import logging
+import Queue
 import re
+import struct
+import threading
+import time
 
 import psycopg2
 import psycopg2.pool
@@ -84,16 +88,22 @@ _CLEAR_TABLE = '''DELETE FROM kv_{namespace} WHERE t = %s'''
 # use cursor.callproc() instead of SELECT query.
 # _PUT = '''SELECT upsert_{namespace} (%s, %s, %s);'''
 
+# PostgreSQL 9.5 and later can upsert a whole batch in one statement;
+# the keys within one batch must be distinct
+_PUT_MANY = ('''INSERT INTO kv_{namespace} (t, k, v) '''
+             '''SELECT %s, unnest(%s::bytea[]), unnest(%s::bytea[]) '''
+             '''ON CONFLICT (t, k) DO UPDATE SET v = EXCLUDED.v''')
+
 _GET_KV = 'SELECT k, v FROM kv_{namespace} WHERE t=%s'
 _GET_K = 'SELECT k FROM kv_{namespace} WHERE t=%s'
 
-_GET_EXACT = ' AND k=%s'
+_GET_ANY = ' AND k = ANY(%s::bytea[])'
 _GET_MIN = ' AND k>=%s'
 _GET_MAX = ' AND k<%s'
 _SCAN_ORDER = ' ORDER BY k ASC'
 _INNER_LIMIT = ' LIMIT %s'
 
-_GET = _GET_KV + _GET_EXACT
+_GET_MANY = _GET_KV + _GET_ANY
 
 _DELETE = '''DELETE FROM kv_{namespace} WHERE t = %s AND k = %s;'''
 
@@ -101,6 +111,16 @@ _DELETE = '''DELETE FROM kv_{namespace} WHERE t = %s AND k = %s;'''
 # _DELETE_RANGE = ('DELETE FROM kv_{namespace} WHERE t = %s AND k >= %s '
 #                  'AND K <= %s;''')
 
+# bulk_load() copies into a staging table, then merges it in; n
+# records the input order so the last copy of a repeated key wins
+_BULK_STAGE = ('''CREATE TEMPORARY TABLE kvlayer_bulk '''
+               '''(k bytea, v bytea, n bigserial) ON COMMIT DROP''')
+_BULK_COPY = '''COPY kvlayer_bulk (k, v) FROM STDIN WITH (FORMAT binary)'''
+_BULK_MERGE = ('''INSERT INTO kv_{namespace} (t, k, v) '''
+               '''SELECT DISTINCT ON (k) %s, k, v FROM kvlayer_bulk '''
+               '''ORDER BY k, n DESC '''
+               '''ON CONFLICT (t, k) DO UPDATE SET v = EXCLUDED.v''')
+
 # TODO: use this query to list available namespaces
 # select tablename from pg_catalog.pg_tables where tablename like 'kv_%';
 
@@ -108,6 +128,147 @@ _DELETE = '''DELETE FROM kv_{namespace} WHERE t = %s AND k = %s;'''
 MAX_BLOB_BYTES = 15000000
 
 
+class CopyBinaryReader(object):
+    '''File-like object producing PostgreSQL binary ``COPY`` data.
+
+    Pass this to :meth:`psycopg2.cursor.copy_expert`.  Rows are
+    pulled from `rows` only as the data is read, so only about one
+    read's worth of data is ever held in memory.
+
+    `encode_row` is called on each item of `rows` and must return a
+    tuple of byte strings in the binary format of the destination
+    columns, or :const:`None` for SQL ``NULL``.  The last field is
+    counted as the value and the others as the key in
+    :attr:`keys_size` and :attr:`values_size`.
+
+    If `max_rows` is given, the data ends after that many rows even
+    if `rows` has more; check :attr:`exhausted` to tell the
+    difference, and pass the same iterator to a new reader to
+    continue.
+
+    '''
+    HEADER = 'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+    TRAILER = struct.pack('>h', -1)
+
+    def __init__(self, rows, encode_row, max_rows=None):
+        self._rows = iter(rows)
+        self._encode_row = encode_row
+        self._max_rows = max_rows
+        self._parts = [self.HEADER]
+        self._size = len(self.HEADER)
+        self._done = False
+        #: number of rows produced so far
+        self.num_rows = 0
+        #: total size of all but the last field of each row
+        self.keys_size = 0
+        #: total size of the last field of each row
+        self.values_size = 0
+        #: true if `rows` ran out
+        self.exhausted = False
+
+    def _add_row(self, fields):
+        parts = [struct.pack('>h', len(fields))]
+        for field in fields:
+            if field is None:
+                parts.append(struct.pack('>i', -1))
+            else:
+                parts.append(struct.pack('>i', len(field)))
+                parts.append(field)
+        row = ''.join(parts)
+        self._parts.append(row)
+        self._size += len(row)
+        self.num_rows += 1
+        self.keys_size += sum(len(f) for f in fields[:-1] if f is not None)
+        if fields[-1] is not None:
+            self.values_size += len(fields[-1])
+
+    def _finish(self):
+        self._parts.append(self.TRAILER)
+        self._size += len(self.TRAILER)
+        self._done = True
+
+    def read(self, size=-1):
+        while not self._done and (size < 0 or self._size < size):
+            if self._max_rows is not None and self.num_rows >= self._max_rows:
+                self._finish()
+                break
+            try:
+                row = next(self._rows)
+            except StopIteration:
+                self.exhausted = True
+                self._finish()
+                break
+            self._add_row(self._encode_row(row))
+        data = ''.join(self._parts)
+        if size < 0 or size >= len(data):
+            self._parts = []
+        else:
+            self._parts = [data[size:]]
+            data = data[:size]
+        self._size -= len(data)
+        return data
+
+    readline = read
+
+
+class IdleCheckConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    '''Thread-safe connection pool that checks long-idle connections.
+
+    A connection that has been sitting in the pool for more than
+    `idle_check_seconds` is tested with ``SELECT 1`` when it is
+    checked out, and replaced if the test fails.  Recently used
+    connections are handed out without the extra round trip.  A
+    connection that breaks while in use is marked closed by
+    :mod:`psycopg2`, and is discarded rather than reused when it is
+    returned to the pool.
+
+    '''
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self.idle_check_seconds = kwargs.pop('idle_check_seconds', 30.0)
+        # id(conn) to time.time() when it was opened or last returned,
+        # for every open connection the pool knows about
+        self._last_used = {}
+        super(IdleCheckConnectionPool, self).__init__(minconn, maxconn,
+                                                      *args, **kwargs)
+
+    def _connect(self, key=None):
+        # also opens the first `minconn` connections at construction
+        conn = super(IdleCheckConnectionPool, self)._connect(key)
+        self._last_used[id(conn)] = time.time()
+        return conn
+
+    def getconn(self, key=None):
+        while True:
+            with self._lock:
+                conn = self._getconn(key)
+                last_used = self._last_used.get(id(conn))
+            if (last_used is not None and
+                    time.time() - last_used < self.idle_check_seconds):
+                return conn
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                conn.rollback()
+                return conn
+            except (psycopg2.DatabaseError, psycopg2.InterfaceError):
+                logger.warn('idle connection is gone, reconnecting',
+                            exc_info=True)
+                self.putconn(conn, key, close=True)
+
+    def putconn(self, conn=None, key=None, close=False):
+        with self._lock:
+            self._putconn(conn, key, close or conn.closed)
+            # the base pool closes connections beyond `minconn`
+            if any(pooled is conn for pooled in self._pool):
+                self._last_used[id(conn)] = time.time()
+            else:
+                self._last_used.pop(id(conn), None)
+
+    def closeall(self):
+        super(IdleCheckConnectionPool, self).closeall()
+        self._last_used.clear()
+
+
 def _cursor_check_namespace_table(cursor, namespace):
     cursor.execute('SELECT 1 FROM pg_tables WHERE tablename ILIKE %s',
                    ('kv_' + namespace,))
@@ -128,13 +289,25 @@ http://www.postgresql.org/docs/current/static/libpq-connect.html#LIBPQ-PARAMKEYW
         if not self.storage_addresses:
             raise ProgrammerError(
                 'postgres kvlayer needs config["storage_addresses"]')
-        self.connection_pool = psycopg2.pool.SimpleConnectionPool(
+        self.connection_pool = IdleCheckConnectionPool(
             self._config.get('min_connections', 2),
             self._config.get('max_connections', 16),
-            self.storage_addresses[0]
+            self.storage_addresses[0],
+            idle_check_seconds=float(
+                self._config.get('idle_check_seconds', 30.0))
         )
         self._scan_inner_limit = int(self._config.get('scan_inner_limit',
                                                       1000))
+        self._scan_keyset_pagination = self._config.get(
+            'scan_keyset_pagination', False)
+        self._scan_itersize = int(self._config.get('scan_itersize', 2000))
+        self._scan_prefetch = self._config.get('scan_prefetch', True)
+        self._put_batch_size = int(self._config.get('put_batch_size', 1000))
+        self._get_batch_size = int(self._config.get('get_batch_size', 1000))
+        self._bulk_load_batch_size = int(
+            self._config.get('bulk_load_batch_size', 1000000))
+        # None means decide from the server version on first use
+        self._upsert_on_conflict = self._config.get('upsert_on_conflict')
 
     @contextlib.contextmanager
     def _conn(self):
@@ -144,9 +317,8 @@ http://www.postgresql.org/docs/current/static/libpq-connect.html#LIBPQ-PARAMKEYW
         successful completion, the transaction is committed; if any
         exception is thrown, the transaction is aborted.
 
-        On successful completion the connection is returned to the
-        pool for reuse.  If any exception is thrown, the connection
-        is closed.
+        On completion the connection is returned to the pool for
+        reuse, unless it has failed, in which case the pool discards it.
 
         '''
         conn = self.connection_pool.getconn()
@@ -213,12 +385,90 @@ http://www.postgresql.org/docs/current/static/libpq-connect.html#LIBPQ-PARAMKEYW
 
     def _put(self, table_name, keys_and_values):
         with self._conn() as conn:
+            if self._upsert_on_conflict is None:
+                self._upsert_on_conflict = conn.server_version >= 90500
             with conn.cursor() as cursor:
+                if self._upsert_on_conflict:
+                    self._put_on_conflict(cursor, table_name,
+                                          keys_and_values)
+                    return
                 for (k, v) in keys_and_values:
                     cursor.callproc(
                         'upsert_{namespace}'.format(namespace=self._namespace),
                         (table_name, psycopg2.Binary(k), psycopg2.Binary(v)))
 
+    def _put_on_conflict(self, cursor, table_name, keys_and_values):
+        '''Write keys and values with one statement per batch.
+
+        ``INSERT ... ON CONFLICT`` refuses to update the same row
+        twice in one statement, so if a key repeats within a batch
+        only its last value is sent, as if the puts had been done in
+        order.
+
+        '''
+        cmd = _PUT_MANY.format(namespace=self._namespace)
+        batch = {}
+
+        def flush():
+            ks = batch.keys()
+            cursor.execute(cmd, (table_name,
+                                 [psycopg2.Binary(k) for k in ks],
+                                 [psycopg2.Binary(batch[k]) for k in ks]))
+            batch.clear()
+        for (k, v) in keys_and_values:
+            batch[k] = v
+            if len(batch) >= self._put_batch_size:
+                flush()
+        if batch:
+            flush()
+
+    def bulk_load(self, table_name, keys_and_values):
+        '''Write a large number of keys and values into a table.
+
+        This has the same effect as calling :meth:`put` on every
+        pair in `keys_and_values`, which may be any iterable,
+        including a generator.  It is read incrementally and streamed
+        to the server with binary ``COPY`` into a staging table, which
+        is then merged into the namespace table.  Every
+        ``bulk_load_batch_size`` rows are committed as a separate
+        transaction.  This needs PostgreSQL 9.5 or later.
+
+        :param str table_name: name of table to write
+        :param keys_and_values: iterable of (key, value) pairs
+        :return: number of pairs written
+
+        '''
+        key_spec = self._table_names[table_name]
+        value_type = self._value_types[table_name]
+
+        def encode_row(kv):
+            (k, v) = kv
+            self.check_put_key_value(k, v, table_name)
+            return (self._encoder.serialize(k, key_spec),
+                    self.value_to_str(v, value_type))
+        merge = _BULK_MERGE.format(namespace=self._namespace)
+        keys_and_values = iter(keys_and_values)
+        total = 0
+        while True:
+            start_time = time.time()
+            reader = CopyBinaryReader(keys_and_values, encode_row,
+                                      self._bulk_load_batch_size)
+            with self._conn() as conn:
+                if conn.server_version < 90500:
+                    raise ProgrammerError('bulk_load needs PostgreSQL 9.5')
+                with conn.cursor() as cursor:
+                    cursor.execute(_BULK_STAGE)
+                    cursor.copy_expert(_BULK_COPY, reader)
+                    if reader.num_rows:
+                        cursor.execute(merge, (table_name,))
+            if reader.num_rows:
+                self.log_bulk_load(table_name, start_time, time.time(),
+                                   reader.num_rows, reader.keys_size,
+                                   reader.num_rows, reader.values_size)
+            total += reader.num_rows
+            if reader.exhausted:
+                return total
+
     def _unmarshal_k(self, row, key_spec):
         '''Get the key tuple from a response row.'''
         keyraw = row[0]
@@ -239,23 +489,19 @@ http://www.postgresql.org/docs/current/static/libpq-connect.html#LIBPQ-PARAMKEYW
         return (key, val)
 
     def _get(self, table_name, keys):
-        cmd = _GET.format(namespace=self._namespace)
+        cmd = _GET_MANY.format(namespace=self._namespace)
         with self._conn() as conn:
-            for key in keys:
-                with conn.cursor(name='get') as cursor:
-                    cursor.execute(cmd, (table_name, psycopg2.Binary(key)))
-                    found = False
-                    for row in cursor:
-                        k = row[0]
-                        if k is not None:
-                            k = k[:]
-                        v = row[1]
+            with conn.cursor() as cursor:
+                for start in xrange(0, len(keys), self._get_batch_size):
+                    batch = keys[start:start + self._get_batch_size]
+                    cursor.execute(cmd, (table_name,
+                                         [psycopg2.Binary(k) for k in batch]))
+                    found = {}
+                    for (k, v) in cursor:
                         if v is not None:
-                            v = v[:]  # un-bufferify
-                            found = True
-                            yield (k, v)
-                    if not found:
-                        yield (key, None)
+                            found[k[:]] = v[:]  # un-bufferify
+                    for k in batch:
+                        yield (k, found.get(k))
 
     def _scan(self, table_name, key_ranges):
         for kmin, kmax in (key_ranges or [['', '']]):
@@ -270,10 +516,27 @@ http://www.postgresql.org/docs/current/static/libpq-connect.html#LIBPQ-PARAMKEYW
                     yield rkey
 
     def _scan_subscan_kminmax(self, table_name, kmin, kmax, with_values=True):
+        '''Scan one key range.
+
+        Normally this reads the entire range through a single
+        server-side cursor, which holds one transaction open for the
+        duration of the scan.  With ``scan_keyset_pagination``, this
+        instead runs a separate query and transaction for every
+        ``scan_inner_limit`` rows, each starting from the last key
+        of the previous one.
+
+        '''
+        if not self._scan_keyset_pagination:
+            return self._scan_kminmax(table_name, kmin, kmax, with_values,
+                                      limit=None)
+        return self._scan_keyset(table_name, kmin, kmax, with_values)
+
+    def _scan_keyset(self, table_name, kmin, kmax, with_values):
         prevkey = None
         while True:
             count = 0
-            for p in self._scan_kminmax(table_name, kmin, kmax, with_values):
+            for p in self._scan_kminmax(table_name, kmin, kmax, with_values,
+                                        limit=self._scan_inner_limit):
                 if with_values:
                     rkey = p[0]
                 else:
@@ -289,7 +552,8 @@ http://www.postgresql.org/docs/current/static/libpq-connect.html#LIBPQ-PARAMKEYW
             # else, we hit limit, we need to scan for more
             kmin = rkey
 
-    def _scan_kminmax(self, table_name, kmin, kmax, with_values=True):
+    def _scan_kminmax(self, table_name, kmin, kmax, with_values=True,
+                      limit=None):
         if with_values:
             query = _GET_KV
         else:
@@ -303,13 +567,14 @@ http://www.postgresql.org/docs/current/static/libpq-connect.html#LIBPQ-PARAMKEYW
             query += _GET_MAX
             args.append(psycopg2.Binary(kmax))
         query += _SCAN_ORDER
-        if self._scan_inner_limit:
+        if limit:
             query += _INNER_LIMIT
-            args.append(self._scan_inner_limit)
+            args.append(limit)
         with self._conn() as conn:
             with conn.cursor(name='scan') as cursor:
+                cursor.itersize = self._scan_itersize
                 cursor.execute(query, tuple(args))
-                for row in cursor:
+                for row in self._fetch_rows(cursor):
                     k = row[0]
                     if k is not None:
                         k = k[:]  # unbufferify
@@ -321,6 +586,57 @@ http://www.postgresql.org/docs/current/static/libpq-connect.html#LIBPQ-PARAMKEYW
                     else:
                         yield k
 
+    def _fetch_rows(self, cursor):
+        '''Yield rows from a server-side cursor.
+
+        Rows are fetched ``scan_itersize`` at a time.  With
+        ``scan_prefetch``, a background thread fetches the next batch
+        while the caller is working through the current one, so the
+        network transfer overlaps with the caller's processing.
+
+        '''
+        if not self._scan_prefetch:
+            for row in cursor:
+                yield row
+            return
+
+        batches = Queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def send(item):
+            # give up if the caller has stopped reading
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def fetch():
+            try:
+                rows = True
+                while rows and not stop.is_set():
+                    rows = cursor.fetchmany(self._scan_itersize)
+                    send(rows)
+            except Exception, exc:
+                send(exc)
+        fetcher = threading.Thread(target=fetch, name='kvlayer-pg-scan')
+        fetcher.daemon = True
+        fetcher.start()
+        try:
+            while True:
+                rows = batches.get()
+                if isinstance(rows, Exception):
+                    raise rows
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+        finally:
+            # the cursor cannot be closed until the fetcher is done
+            stop.set()
+            fetcher.join()
+
     def _delete(self, table_name, keys):
         with self._conn() as conn:
             with conn.cursor() as cursor:
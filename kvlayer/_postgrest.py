@@ -34,15 +34,22 @@ implementation.
 # For multi-row upsert, a pattern that works in many places is to
 # create a temporary table, populate it, then do the merge.
 # http://stackoverflow.com/questions/17267417/how-do-i-do-an-upsert-merge-insert-on-duplicate-update-in-postgresql
-# has a good example of doing this safely in PostgreSQL.  In practice
-# at least one minimal benchmark that does do multiple-value put()
-# does quite a bit better with this implementation.
+# has a good example of doing this safely in PostgreSQL, but it needs
+# an exclusive table lock, so every writer waits for every other.
+#
+# PostgreSQL 9.5 added INSERT ... ON CONFLICT, which does the merge
+# with row locks only.  put() passes each column as an array and
+# unnests them, so a batch is one statement with one parameter per
+# column.  On older servers put() falls back to the reference
+# UPDATE-then-INSERT loop, one row at a time, using a savepoint to
+# retry if a concurrent writer inserts the same key first.
 
 from __future__ import absolute_import
 import contextlib
 import logging
 import os
 import re
+import struct
 import time
 import uuid
 
@@ -53,11 +60,39 @@ import psycopg2.pool
 
 from kvlayer._abstract_storage import AbstractStorage, ACCUMULATOR, COUNTER
 from kvlayer._exceptions import ConfigurationError, ProgrammerError
+from kvlayer._postgres import CopyBinaryReader, IdleCheckConnectionPool
 
 logger = logging.getLogger(__name__)
 psycopg2.extras.register_uuid()
 
 
+def _numeric_binary(n):
+    '''Encode an integer in PostgreSQL's binary ``NUMERIC`` format.'''
+    sign = 0x4000 if n < 0 else 0
+    n = abs(n)
+    digits = []
+    while n:
+        (n, d) = divmod(n, 10000)
+        digits.append(d)
+    digits.reverse()
+    weight = max(len(digits) - 1, 0)
+    # trailing zero base-10000 digits are implied by the weight
+    while digits and digits[-1] == 0:
+        digits.pop()
+    return struct.pack('>hhHh{0}h'.format(len(digits)),
+                       len(digits), weight, sign, 0, *digits)
+
+
+# binary COPY encoders for the SQL types from _python_to_sql_type()
+_COPY_ENCODERS = {
+    'INTEGER': lambda x: struct.pack('>i', x),
+    'NUMERIC(1000,0)': _numeric_binary,
+    'UUID': lambda x: x.bytes,
+    'BYTEA': str,
+    'DOUBLE PRECISION': lambda x: struct.pack('>d', x),
+}
+
+
 class PostgresTableStorage(AbstractStorage):
     '''PostgreSQL kvlayer backend.
 
@@ -73,6 +108,10 @@ class PostgresTableStorage(AbstractStorage):
     default_config = {
         'min_connections': 2,
         'max_connections': 16,
+        'idle_check_seconds': 30.0,
+        'put_batch_size': 1000,
+        'get_batch_size': 1000,
+        'bulk_load_batch_size': 1000000,
     }
 
     @classmethod
@@ -129,10 +168,12 @@ class PostgresTableStorage(AbstractStorage):
                 raise ConfigurationError('no dbname for postgrest')
             connect_string += ' user={0} password={1} dbname={2}'.format(
                 user, password, dbname)
-        self.connection_pool = psycopg2.pool.SimpleConnectionPool(
+        self.connection_pool = IdleCheckConnectionPool(
             self._config.get('min_connections', 2),
             self._config.get('max_connections', 16),
-            connect_string
+            connect_string,
+            idle_check_seconds=float(
+                self._config.get('idle_check_seconds', 30.0))
         )
 
     @contextlib.contextmanager
@@ -143,31 +184,21 @@ class PostgresTableStorage(AbstractStorage):
         successful completion, the transaction is committed; if any
         exception is thrown, the transaction is aborted.
 
-        On successful completion the connection is returned to the
-        pool for reuse.  If any exception is thrown, the connection
-        is closed.
+        On completion the connection is returned to the pool for
+        reuse, unless it has failed, in which case the pool discards it.
+        Connections that have been idle a while are checked by the
+        pool before they are handed out here.
 
         '''
-        tries = 5
-        for _ in xrange(tries):
-            conn = self.connection_pool.getconn()
-            try:
-                try:
-                    with conn.cursor() as cursor:
-                        cursor.execute('SELECT 1')
-                except (psycopg2.DatabaseError, psycopg2.InterfaceError):
-                    logging.warn('connection is gone, maybe retrying...',
-                                 exc_info=True)
-                    time.sleep(0.5)
-                    continue
-                with conn:
-                    yield conn
-                    break
-            finally:
-                # This has logic to test whether the connection is closed
-                # and/or failed and correctly manages returning it to the
-                # pool (or not).
-                self.connection_pool.putconn(conn)
+        conn = self.connection_pool.getconn()
+        try:
+            with conn:
+                yield conn
+        finally:
+            # This has logic to test whether the connection is closed
+            # and/or failed and correctly manages returning it to the
+            # pool (or not).
+            self.connection_pool.putconn(conn)
 
     @contextlib.contextmanager
     def _cursor(self, name=None):
@@ -283,41 +314,149 @@ class PostgresTableStorage(AbstractStorage):
             return
         key_spec = self._table_names[table_name]
         value_type = self._value_types[table_name]
-        tn = self._table_name(table_name)
-        cnames = self._columns(key_spec)
-        cname = cnames[0]
-        keys_equal = ' AND '.join('{0}.{1}=put.{1}'.format(tn, col)
-                                  for col in cnames)
-        keys_value = ', '.join('put.{0}'.format(c) for c in cnames + ['v'])
-        if kwargs.get('is_increment', False):
-            new_value = '{0}.v+put.v'.format(tn)
-        else:
-            new_value = 'put.v'
+        is_increment = kwargs.get('is_increment', False)
         for k, v in keys_and_values:
             self.check_put_key_value(k, v, table_name, key_spec)
+        # ON CONFLICT refuses to touch one row twice in a statement,
+        # so combine repeated keys the way sequential puts would
+        merged = {}
+        for k, v in keys_and_values:
+            if is_increment and k in merged:
+                merged[k] += v
+            else:
+                merged[k] = v
+        # writing rows in key order keeps concurrent writers from
+        # deadlocking on each other's row locks
         kvps = [self._massage_key_tuple(key_spec, k) +
                 (self._massage_key_part(value_type, v),)
-                for (k, v) in keys_and_values]
-        with self._cursor() as cursor:
-            # DANGER WILL ROBINSON: we are manually constructing the
-            # query parameters, but at least we're relying on the
-            # library to do escaping for us
-            template = '(' + ','.join(['%s'] * (len(key_spec) + 1)) + ')'
-            values = ','.join(cursor.mogrify(template, row)
-                              for row in kvps)
-            # Now we get to do one massive multi-statement query
-            q = ('CREATE TEMPORARY TABLE put (LIKE {tn}) ON COMMIT DROP; '
-                 'INSERT INTO put VALUES {values}; '
-                 'LOCK TABLE {tn} IN EXCLUSIVE MODE; '
-                 'UPDATE {tn} SET v={new_value} FROM put WHERE {keys_equal}; '
-                 'INSERT INTO {tn}'
-                 ' SELECT {keys_value}'
-                 ' FROM put LEFT OUTER JOIN {tn} ON ({keys_equal})'
-                 ' WHERE {tn}.{cname} IS NULL').format(
-                     tn=tn, values=values, new_value=new_value,
-                     keys_equal=keys_equal, template=template,
-                     keys_value=keys_value, cname=cname)
-            cursor.execute(q)
+                for (k, v) in sorted(merged.iteritems())]
+        batch_size = int(self._config.get('put_batch_size', 1000))
+        with self._conn() as conn:
+            if conn.server_version >= 90500:
+                put_rows = self._put_on_conflict
+            else:
+                put_rows = self._put_row_by_row
+            with conn.cursor() as cursor:
+                for start in xrange(0, len(kvps), batch_size):
+                    put_rows(cursor, table_name, kvps[start:start + batch_size],
+                             is_increment)
+
+    def _put_on_conflict(self, cursor, table_name, kvps, is_increment):
+        '''Upsert rows with a single ``INSERT ... ON CONFLICT``.
+
+        The keys in `kvps` must be distinct.
+
+        '''
+        key_spec = self._table_names[table_name]
+        value_type = self._value_types[table_name]
+        cnames = ', '.join(self._columns(key_spec))
+        arrays = ', '.join('%s::{0}[]'.format(self._python_to_sql_type(t))
+                           for t in key_spec + (value_type,))
+        if is_increment:
+            new_value = 'cur.v + EXCLUDED.v'
+        else:
+            new_value = 'EXCLUDED.v'
+        sql = ('INSERT INTO {tn} AS cur ({cnames}, v) '
+               'SELECT * FROM unnest({arrays}) '
+               'ON CONFLICT ({cnames}) DO UPDATE SET v = {new_value}'
+               .format(tn=self._table_name(table_name), cnames=cnames,
+                       arrays=arrays, new_value=new_value))
+        cursor.execute(sql, [list(column) for column in zip(*kvps)])
+
+    def _put_row_by_row(self, cursor, table_name, kvps, is_increment):
+        '''Upsert rows one at a time, for servers before 9.5.'''
+        tn = self._table_name(table_name)
+        cnames = self._columns(self._table_names[table_name])
+        where = ' AND '.join('{0}=%s'.format(cn) for cn in cnames)
+        if is_increment:
+            new_value = 'v+%s'
+        else:
+            new_value = '%s'
+        update = 'UPDATE {0} SET v={1} WHERE {2}'.format(tn, new_value, where)
+        insert = ('INSERT INTO {0} ({1}, v) VALUES ({2})'
+                  .format(tn, ', '.join(cnames),
+                          ', '.join(['%s'] * (len(cnames) + 1))))
+        for row in kvps:
+            key = row[:-1]
+            value = row[-1]
+            while True:
+                cursor.execute(update, (value,) + key)
+                if cursor.rowcount > 0:
+                    break
+                # not there, so try to insert the key; if someone
+                # else inserts it concurrently, loop to update it
+                cursor.execute('SAVEPOINT kvlayer_put')
+                try:
+                    cursor.execute(insert, row)
+                except psycopg2.IntegrityError, exc:
+                    if exc.pgcode != psycopg2.errorcodes.UNIQUE_VIOLATION:
+                        raise
+                    cursor.execute('ROLLBACK TO SAVEPOINT kvlayer_put')
+                    continue
+                cursor.execute('RELEASE SAVEPOINT kvlayer_put')
+                break
+
+    def bulk_load(self, table_name, keys_and_values):
+        '''Write a large number of keys and values into a table.
+
+        This has the same effect as calling :meth:`put` on every
+        pair in `keys_and_values`, which may be any iterable,
+        including a generator.  It is read incrementally and streamed
+        to the server with binary ``COPY`` into a staging table, which
+        is then merged into the kvlayer table.  Every
+        ``bulk_load_batch_size`` rows are committed as a separate
+        transaction.  This needs PostgreSQL 9.5 or later.
+
+        :param str table_name: name of table to write
+        :param keys_and_values: iterable of (key, value) pairs
+        :return: number of pairs written
+
+        '''
+        key_spec = self._table_names[table_name]
+        value_type = self._value_types[table_name]
+        tn = self._table_name(table_name)
+        cnames = ', '.join(self._columns(key_spec))
+        encoders = [_COPY_ENCODERS[self._python_to_sql_type(typ)]
+                    for typ in key_spec + (value_type,)]
+
+        def encode_row(kv):
+            (k, v) = kv
+            self.check_put_key_value(k, v, table_name, key_spec)
+            return tuple(encode(x) for (encode, x) in zip(encoders, k + (v,)))
+        stage = ('CREATE TEMPORARY TABLE kvlayer_bulk (LIKE {tn}) '
+                 'ON COMMIT DROP; '
+                 'ALTER TABLE kvlayer_bulk ADD COLUMN n BIGSERIAL'
+                 .format(tn=tn))
+        copy = ('COPY kvlayer_bulk ({cnames}, v) FROM STDIN '
+                'WITH (FORMAT binary)'.format(cnames=cnames))
+        # n records the input order, so the last copy of a repeated
+        # key wins, as it would with put()
+        merge = ('INSERT INTO {tn} ({cnames}, v) '
+                 'SELECT DISTINCT ON ({cnames}) {cnames}, v '
+                 'FROM kvlayer_bulk ORDER BY {cnames}, n DESC '
+                 'ON CONFLICT ({cnames}) DO UPDATE SET v = EXCLUDED.v'
+                 .format(tn=tn, cnames=cnames))
+        batch_size = int(self._config.get('bulk_load_batch_size', 1000000))
+        keys_and_values = iter(keys_and_values)
+        total = 0
+        while True:
+            start_time = time.time()
+            reader = CopyBinaryReader(keys_and_values, encode_row, batch_size)
+            with self._conn() as conn:
+                if conn.server_version < 90500:
+                    raise ProgrammerError('bulk_load needs PostgreSQL 9.5')
+                with conn.cursor() as cursor:
+                    cursor.execute(stage)
+                    cursor.copy_expert(copy, reader)
+                    if reader.num_rows:
+                        cursor.execute(merge)
+            if reader.num_rows:
+                self.log_bulk_load(table_name, start_time, time.time(),
+                                   reader.num_rows, reader.keys_size,
+                                   reader.num_rows, reader.values_size)
+            total += reader.num_rows
+            if reader.exhausted:
+                return total
 
     def get(self, table_name, *keys, **kwargs):
         '''Get values out of the database.'''
@@ -325,20 +464,30 @@ class PostgresTableStorage(AbstractStorage):
         key_spec = self._table_names[table_name]
         value_type = self._value_types[table_name]
         cnames = self._columns(key_spec)
-        exprs = ['{0}=%s'.format(kn) for kn in cnames]
-        where = 'WHERE {0}'.format(' AND '.join(exprs))
-        sql = 'SELECT v FROM ' + tn + ' ' + where
+        # join the table against the requested keys, numbered so the
+        # results can be put back in request order
+        arrays = ', '.join('%s::{0}[]'.format(self._python_to_sql_type(t))
+                           for t in key_spec)
+        on = ' AND '.join('tbl.{0}=req.{0}'.format(cn) for cn in cnames)
+        sql = ('SELECT req.n, tbl.v '
+               'FROM unnest(%s::INTEGER[], {arrays}) AS req(n, {cnames}) '
+               'JOIN {tn} AS tbl ON {on}'
+               .format(arrays=arrays, cnames=', '.join(cnames), tn=tn, on=on))
+        batch_size = int(self._config.get('get_batch_size', 1000))
         with self._cursor() as cursor:
-            for k in keys:
-                pg_key = self._massage_key_tuple(key_spec, k)
-                cursor.execute(sql, pg_key)
-                found = False
-                for row in cursor:
-                    assert not found
-                    found = True
-                    yield k, self._massage_result_part(value_type, row[0])
-                if not found:
-                    yield k, None
+            for start in xrange(0, len(keys), batch_size):
+                batch = keys[start:start + batch_size]
+                columns = zip(*[self._massage_key_tuple(key_spec, k)
+                                for k in batch])
+                cursor.execute(sql, [range(len(batch))] +
+                               [list(column) for column in columns])
+                found = dict(cursor.fetchall())
+                for n, k in enumerate(batch):
+                    if n in found:
+                        yield k, self._massage_result_part(value_type,
+                                                           found[n])
+                    else:
+                        yield k, None
 
     def _scan_padded(self, key_spec, k):
         '''Add :const:`None` to the end of `k` so it's the right length'''
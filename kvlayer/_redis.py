@@ -18,23 +18,43 @@ This is a hash mapping kvlayer table names to redis row names.  A
 kvlayer "table" is stored in two rows: the mapped table name with no
 suffix is a hash mapping serialized UUID tuples to values, and the
 mapped table name plus "k" is a sorted set of key names (only, all
-with score 0, to support :meth:`RedisStorage.scan`).
+with score 0, to support :meth:`RedisStorage.scan`).  Scans page
+through the sorted set with ``ZRANGEBYLEX``, so this requires Redis
+2.8.9 or later.
+
+With ``redis_sharded: true``, table data is spread over all of the
+``storage_addresses`` by consistent hashing of the serialized keys.
+Every shard holds a hash and a sorted set for every table under the
+same redis key names, while the namespace row itself lives only on
+the first address.  Reads and writes are sent to each shard in its
+own pipeline, in parallel, and scans merge the sorted key streams
+from all of the shards.
 
 .. _redis: http://redis.io
 .. _rejester: https://github.com/diffeo/rejester
 
 .. autoclass:: RedisStorage
 
+.. autoclass:: HashRing
+
 """
 
 from __future__ import absolute_import
 
+import bisect
+import hashlib
+import heapq
 import logging
+from multiprocessing.pool import ThreadPool
+import struct
+import threading
+import time
 import uuid
 
 import redis
 
-from kvlayer._abstract_storage import StringKeyedStorage
+from kvlayer._abstract_storage import ACCUMULATOR, COUNTER, \
+    StringKeyedStorage
 from kvlayer._exceptions import BadKey, ProgrammerError
 
 logger = logging.getLogger(__name__)
@@ -46,6 +66,62 @@ then return redis.error_reply('no such kvlayer table') end
 '''
 verify_lua_failed = 'no such kvlayer table'
 
+# Add to fixed-width binary counters, matching
+# AbstractStorage.value_to_str() and str_to_value().
+# ARGV[1] is the struct format; then pairs of key and delta.
+increment_lua = verify_lua + '''
+for i = 2, #ARGV, 2 do
+  local old = redis.call('hget', KEYS[1], ARGV[i])
+  local value = 0
+  if old then
+    if #old == 8 then
+      value = struct.unpack('>i8', old)
+    else
+      value = struct.unpack(ARGV[1], old)
+    end
+  end
+  value = value + tonumber(ARGV[i+1])
+  redis.call('hset', KEYS[1], ARGV[i], struct.pack(ARGV[1], value))
+  redis.call('zadd', KEYS[2], 0, ARGV[i])
+end
+'''
+
+
+class HashRing(object):
+    """Consistent hash ring mapping keys to nodes.
+
+    Each node is placed on the ring at `replicas` points derived
+    from its name, and a key belongs to the first node point at or
+    after the key's own hash.  Adding or removing one node only
+    moves the keys adjacent to that node's points, and the mapping
+    does not depend on the order the nodes are listed in.
+
+    """
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        points = []
+        for i, node in enumerate(self.nodes):
+            for r in xrange(replicas):
+                points.append((self._hash('{0}-{1}'.format(node, r)), i))
+        points.sort()
+        self._points = [p for (p, i) in points]
+        self._indexes = [i for (p, i) in points]
+
+    @staticmethod
+    def _hash(s):
+        return struct.unpack('>I', hashlib.md5(s).digest()[:4])[0]
+
+    def index_for(self, key):
+        """Get the position in :attr:`nodes` of the node owning `key`."""
+        pos = bisect.bisect_left(self._points, self._hash(key))
+        if pos == len(self._points):
+            pos = 0
+        return self._indexes[pos]
+
+    def node_for(self, key):
+        """Get the node owning `key`."""
+        return self.nodes[self.index_for(key)]
+
 
 class RedisStorage(StringKeyedStorage):
     def __init__(self, *args, **kwargs):
@@ -69,7 +145,21 @@ class RedisStorage(StringKeyedStorage):
 
             storage_addresses: ["redis.example.com:6379"]
 
-        list of ``hostname:port`` pairs for redis (only first is used)
+        list of ``hostname:port`` pairs for redis (only first is used,
+        unless ``redis_sharded`` is set)
+
+        .. code-block:: yaml
+
+            redis_sharded: true
+
+        spread table data over all of `storage_addresses` (defaults
+        to false); the first address also holds the namespace row
+
+        .. code-block:: yaml
+
+            redis_shard_replicas: 100
+
+        points per shard on the consistent hash ring
 
         .. code-block:: yaml
 
@@ -77,29 +167,89 @@ class RedisStorage(StringKeyedStorage):
 
         Redis database number (defaults to 0)
 
+        .. code-block:: yaml
+
+            redis_scan_page_size: 1000
+
+        number of keys to fetch per round trip when scanning
+
         """
         super(RedisStorage, self).__init__(*args, **kwargs)
         storage_addresses = self._config.get('storage_addresses', [])
         db_num = self._config.get('redis_db_num', 0)
         if len(storage_addresses) == 0:
             raise ProgrammerError('config lacks storage_addresses')
-        if len(storage_addresses) > 1:
-            logger.warning('multiple storage_addresses, only first will be used')
-        address = storage_addresses[0]
-        if ':' in address:
-            (host, port) = address.split(':')
-            conn_kwargs = { 'host': host, 'port': int(port), 'db': db_num }
-        else:
-            conn_kwargs = { 'host': address, 'db': db_num }
-
-        logger.debug('will connect to redis {0!r}'.format(conn_kwargs))
-        self._pool = redis.ConnectionPool(**conn_kwargs)
+        if not self._config.get('redis_sharded', False):
+            if len(storage_addresses) > 1:
+                logger.warning('multiple storage_addresses, '
+                               'only first will be used')
+            storage_addresses = storage_addresses[:1]
+
+        self._shards = []
+        for address in storage_addresses:
+            if ':' in address:
+                (host, port) = address.split(':')
+                conn_kwargs = { 'host': host, 'port': int(port),
+                                'db': db_num }
+            else:
+                conn_kwargs = { 'host': address, 'db': db_num }
+            logger.debug('will connect to redis {0!r}'.format(conn_kwargs))
+            self._shards.append(redis.ConnectionPool(**conn_kwargs))
+        # the first shard also holds the namespace row
+        self._pool = self._shards[0]
+        self._ring = HashRing(storage_addresses,
+                              int(self._config.get('redis_shard_replicas',
+                                                   100)))
+        # started by the first multi-shard call; guarded by the lock
+        self._thread_pool = None
+        self._thread_pool_lock = threading.Lock()
         self._table_keys = {}
-        pass
+        self._scan_page_size = int(self._config.get('redis_scan_page_size',
+                                                    1000))
+
+    def _connection(self, shard=0):
+        """Get a connection to Redis.
+
+        :param int shard: index of the shard to connect to; shard 0
+          holds the namespace row
+
+        """
+        return redis.StrictRedis(connection_pool=self._shards[shard])
+
+    def _shard_keys(self, items, with_values=False):
+        """Group serialized keys by the shard that owns them.
+
+        :param items: serialized keys, or (key, value) pairs
+        :param bool with_values: `items` are (key, value) pairs
+        :return: dictionary mapping shard index to list of the
+          items belonging to it, in their original order
+
+        """
+        by_shard = {}
+        for item in items:
+            k = item[0] if with_values else item
+            by_shard.setdefault(self._ring.index_for(k), []).append(item)
+        return by_shard
+
+    def _fan_out(self, func, by_shard):
+        """Call `func(conn, items)` once per shard, in parallel.
 
-    def _connection(self):
-        """Get a connection to Redis."""
-        return redis.StrictRedis(connection_pool=self._pool)
+        :param by_shard: dictionary mapping shard index to items, as
+          returned by :meth:`_shard_keys`
+        :return: dictionary mapping shard index to `func`'s result
+
+        """
+        calls = [(self._connection(shard), items)
+                 for (shard, items) in by_shard.iteritems()]
+        if len(calls) == 1:
+            results = [func(*calls[0])]
+        else:
+            with self._thread_pool_lock:
+                if self._thread_pool is None:
+                    self._thread_pool = ThreadPool(len(self._shards))
+                thread_pool = self._thread_pool
+            results = thread_pool.map(lambda call: func(*call), calls)
+        return dict(zip(by_shard.iterkeys(), results))
 
     @property
     def _namespace_key(self):
@@ -166,6 +316,8 @@ class RedisStorage(StringKeyedStorage):
                     logger.debug("setup_namespace: table {0} uuid {1}"
                                  .format(table, key))
                     self._table_keys[table] = key
+                    for shard in xrange(1, len(self._shards)):
+                        self._connection(shard).hsetnx(key, '', '')
                     break
                 except redis.ResponseError, exc:
                     if tries == 0:
@@ -188,8 +340,10 @@ class RedisStorage(StringKeyedStorage):
         """)
         table_keys = script(keys=[self._namespace_key])
         if len(table_keys) > 0:
-            conn.delete(*table_keys)
-            conn.delete(*[k + 'k' for k in table_keys])
+            for shard in xrange(len(self._shards)):
+                conn = self._connection(shard)
+                conn.delete(*table_keys)
+                conn.delete(*[k + 'k' for k in table_keys])
         self._table_keys = {}
 
     def clear_table(self, table_name):
@@ -216,7 +370,8 @@ class RedisStorage(StringKeyedStorage):
         redis.call('hset', KEYS[1], '', '')
         ''')
         try:
-            script(keys=[key, key + 'k'])
+            for shard in xrange(len(self._shards)):
+                script(keys=[key, key + 'k'], client=self._connection(shard))
         except redis.ResponseError, exc:
             if str(exc) == verify_lua_failed:
                 raise BadKey(table_name)
@@ -229,76 +384,93 @@ class RedisStorage(StringKeyedStorage):
             raise BadKey(table_name)
         table_key_k = table_key + 'k'
 
-        pipeline = conn.pipeline(transaction=False)
-        for (k, v) in keys_and_values:
-            pipeline.hset(table_key, k, v)
-            pipeline.zadd(table_key_k, 0, k)
-        pipeline.execute()
+        def put_shard(conn, items):
+            pipeline = conn.pipeline(transaction=False)
+            for (k, v) in items:
+                pipeline.hset(table_key, k, v)
+                pipeline.zadd(table_key_k, 0, k)
+            pipeline.execute()
+        self._fan_out(put_shard, self._shard_keys(keys_and_values, True))
 
     def _scan(self, table_name, key_ranges):
         conn = self._connection()
         key = self._table_key(conn, table_name)
         if key is None:
             raise BadKey(table_name)
-        if len(key_ranges) == 0:
-            # scan the whole table
-            # just do this in one big call for simplicity
-            res = conn.hgetall(key)
-            return [(k, res[k]) for k in sorted(res.iterkeys()) if k != '']
-        for start, end in key_ranges:
-            find_first = '''
-            local first = redis.call('zrank', KEYS[2], ARGV[1])
-            if not first then
-              redis.call('zadd', KEYS[2], 0, ARGV[1])
-              first = redis.call('zrank', KEYS[2], ARGV[1])
-              redis.call('zrem', KEYS[2], ARGV[1])
-            end
-            '''
-            no_first = '''
-            local first = 0
-            '''
-            find_last = '''
-            local last = redis.call('zrank', KEYS[2], ARGV[2])
-            if not last then
-              redis.call('zadd', KEYS[2], 0, ARGV[2])
-              last = redis.call('zrank', KEYS[2], ARGV[2])
-              redis.call('zrem', KEYS[2], ARGV[2])
-              if last == 0 then return {} end
-              last = last - 1
-            end
-            '''
-            no_last = '''
-            local last = -1
-            '''
-            do_scan = '''
-            local keys = redis.call('zrange', KEYS[2], first, last)
-            local result = {}
-            for i = 1, #keys do
-              result[i*2-1] = keys[i]
-              result[i*2] = redis.call('hget', KEYS[1], keys[i])
-            end
-            return result
-            '''
-            script = verify_lua
-            if start:
-                script += find_first
-            else:
-                script += no_first
-            if end:
-                script += find_last
+        for start, end in (key_ranges or [(None, None)]):
+            for k, v in self._scan_shards(key, start, end, True):
+                yield k, v
+
+    def _scan_keys(self, table_name, key_ranges):
+        conn = self._connection()
+        key = self._table_key(conn, table_name)
+        if key is None:
+            raise BadKey(table_name)
+        for start, end in (key_ranges or [(None, None)]):
+            for k in self._scan_shards(key, start, end, False):
+                yield k
+
+    def _scan_shards(self, key, start, end, with_values):
+        """Scan one range of keys across all of the shards.
+
+        Each shard's keys come back in order from
+        :meth:`_scan_range`, and any one key lives on only one shard,
+        so merging the per-shard streams yields the whole range in
+        order.
+
+        """
+        if len(self._shards) == 1:
+            return self._scan_range(self._connection(), key, start, end,
+                                    with_values)
+        return heapq.merge(*[self._scan_range(self._connection(shard), key,
+                                              start, end, with_values)
+                             for shard in xrange(len(self._shards))])
+
+    def _scan_range(self, conn, key, start, end, with_values):
+        """Scan one range of keys from a table, a page at a time.
+
+        Each round trip fetches the values for one page of keys and,
+        in the same pipeline, the keys for the next page, so client
+        memory stays bounded by :attr:`_scan_page_size` and no single
+        command holds up the server for long.  Keys deleted while the
+        scan is in progress are skipped.
+
+        :param conn: Redis connection
+        :type conn: :class:`redis.StrictRedis`
+        :param str key: Redis key of the table hash
+        :param str start: first encoded key, or :const:`None`
+        :param str end: last encoded key, or :const:`None`
+        :param bool with_values: yield (key, value) pairs if true,
+          keys alone if false
+
+        """
+        zkey = key + 'k'
+        lo = '[' + start if start else '-'
+        hi = '[' + end if end else '+'
+        page_size = self._scan_page_size
+        keys = conn.zrangebylex(zkey, lo, hi, start=0, num=page_size)
+        while keys:
+            more = len(keys) == page_size
+            next_keys = []
+            if with_values:
+                pipeline = conn.pipeline(transaction=False)
+                pipeline.hmget(key, keys)
+                if more:
+                    pipeline.zrangebylex(zkey, '(' + keys[-1], hi,
+                                         start=0, num=page_size)
+                replies = pipeline.execute()
+                if more:
+                    next_keys = replies[1]
+                for k, v in zip(keys, replies[0]):
+                    if v is not None:
+                        yield k, v
             else:
-                script += no_last
-            script += do_scan
-            script = conn.register_script(script)
-            try:
-                res = script(keys=[key, key+'k'], args=[start, end])
-            except redis.ResponseError, exc:
-                if str(exc) == verify_lua_failed:
-                    raise BadKey(table_name)
-                raise
-            keys = res[0::2]
-            values = res[1::2]
-            return zip(keys, values)
+                for k in keys:
+                    yield k
+                if more:
+                    next_keys = conn.zrangebylex(zkey, '(' + keys[-1], hi,
+                                                 start=0, num=page_size)
+            keys = next_keys
 
     def _get(self, table_name, keys):
         # We can be sufficiently atomic without lua scripting here.
@@ -312,9 +484,14 @@ class RedisStorage(StringKeyedStorage):
         key = self._table_key(conn, table_name)
         if key is None:
             raise BadKey(key)
-        values = conn.hmget(key, *keys)
+        by_shard = self._shard_keys(keys)
+        replies = self._fan_out(lambda conn, ks: conn.hmget(key, *ks),
+                                by_shard)
+        found = {}
+        for shard, ks in by_shard.iteritems():
+            found.update(zip(ks, replies[shard]))
         # values may include None if the key isn't there; return it anyways
-        return zip(keys, values)
+        return [(k, found[k]) for k in keys]
 
     def _delete(self, table_name, keys):
         # Again blow off atomicity.  The worst that happens is that
@@ -335,12 +512,67 @@ class RedisStorage(StringKeyedStorage):
         end
         ''')
         try:
-            script(keys=[key, key+'k'], args=keys)
+            self._fan_out(lambda conn, ks: script(keys=[key, key+'k'],
+                                                  args=ks, client=conn),
+                          self._shard_keys(keys))
+        except redis.ResponseError, exc:
+            if str(exc) == verify_lua_failed:
+                raise BadKey(table_name)
+            raise
+
+    def increment(self, table_name, *keys_and_values):
+        """Add values to a counter-type table.
+
+        This runs as a single server-side script, so the entire call
+        takes one round trip and is atomic with respect to other
+        clients, including concurrent increments of the same keys.
+        When sharded, each shard runs the script on its own keys, so
+        the call is atomic per shard but not across shards.
+
+        """
+        value_type = self._value_types[table_name]
+        if value_type is COUNTER:
+            fmt = '>i4'
+        elif value_type is ACCUMULATOR:
+            fmt = '>f'
+        else:
+            raise ProgrammerError('table {0} is not a counter table'
+                                  .format(table_name))
+        if not keys_and_values:
+            return
+        start_time = time.time()
+        key_spec = self._table_names[table_name]
+        # repr() keeps full float precision, but adds 'L' to longs
+        deltas = [(self._encoder.serialize(k, key_spec),
+                   repr(v) if isinstance(v, float) else str(v))
+                  for (k, v) in keys_and_values]
+        conn = self._connection()
+        key = self._table_key(conn, table_name)
+        if key is None:
+            raise BadKey(table_name)
+        script = conn.register_script(increment_lua)
+
+        def increment_shard(conn, items):
+            args = [fmt]
+            for (k, v) in items:
+                args.extend((k, v))
+            script(keys=[key, key+'k'], args=args, client=conn)
+        try:
+            self._fan_out(increment_shard, self._shard_keys(deltas, True))
         except redis.ResponseError, exc:
             if str(exc) == verify_lua_failed:
                 raise BadKey(table_name)
             raise
+        self.log_put(table_name, start_time, time.time(),
+                     len(deltas), sum(len(k) for (k, v) in deltas),
+                     len(deltas), 4 * len(deltas))
 
     def close(self):
         """Close connections and end use of this storage client."""
-        self._pool.disconnect()
+        with self._thread_pool_lock:
+            thread_pool = self._thread_pool
+            self._thread_pool = None
+        if thread_pool is not None:
+            thread_pool.close()
+        for pool in self._shards:
+            pool.disconnect()
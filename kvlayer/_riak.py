@@ -5,13 +5,37 @@
 
 '''
 from __future__ import absolute_import
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
 
 import riak
 
 from kvlayer._abstract_storage import StringKeyedStorage
 
+logger = logging.getLogger(__name__)
+
+#: Bucket properties needed for blind writes
+BLIND_WRITE_PROPERTIES = {
+    'allow_mult': False,
+    'last_write_wins': True,
+}
+
 
 class RiakStorage(StringKeyedStorage):
+    '''Riak :mod:`kvlayer` backend.
+
+    By default writes and deletes are blind: they do not fetch the
+    object's vector clock first, so each costs one round trip.
+    :meth:`setup_namespace` sets ``last_write_wins`` on each bucket so
+    that these writes replace the old value rather than creating
+    siblings.  With ``vclock_reads``, every write and delete fetches
+    the object first, and bucket properties are left alone.
+
+    Puts and deletes of several keys are spread over a pool of
+    ``write_threads`` threads.
+
+    '''
     def __init__(self, *args, **kwargs):
         '''Create a new Riak client object.
 
@@ -30,12 +54,53 @@ class RiakStorage(StringKeyedStorage):
             protocol=self._config.get('protocol', 'pbc'),
             nodes=nodes)
         self.scan_limit = self._config.get('scan_limit', 100)
+        self._vclock_reads = self._config.get('vclock_reads', False)
+        self._write_threads = self._config.get('write_threads', 8)
+        # started by the first multi-key write; guarded by the lock
+        self._write_pool = None
+        self._write_pool_lock = threading.Lock()
 
     def _bucket(self, table):
         '''Riak bucket name for a kvlayer table.'''
         name = '{0}_{1}_{2}'.format(self._app_name, self._namespace, table)
         return self.connection.bucket(name)
 
+    def setup_namespace(self, table_names, value_types={}):
+        '''Set up tables, and their buckets for blind writes.
+
+        Unless ``vclock_reads`` is set, this sets ``allow_mult`` off
+        and ``last_write_wins`` on for each table's bucket, so that
+        writes without vector clocks resolve to the latest value.
+        This changes buckets that already exist too, for every client
+        that uses them, so each change is logged.
+
+        '''
+        super(RiakStorage, self).setup_namespace(table_names, value_types)
+        if not self._vclock_reads:
+            for table in table_names:
+                bucket = self._bucket(table)
+                props = bucket.get_properties()
+                changes = dict((k, v) for k, v
+                               in BLIND_WRITE_PROPERTIES.iteritems()
+                               if props.get(k) != v)
+                if changes:
+                    logger.info('setting properties of riak bucket %s '
+                                'for blind writes: %r', bucket.name, changes)
+                    bucket.set_properties(changes)
+
+    def _each(self, func, items):
+        '''Call `func` on each of `items`, concurrently if several.'''
+        items = list(items)
+        if self._write_threads <= 1 or len(items) <= 1:
+            for item in items:
+                func(item)
+            return
+        with self._write_pool_lock:
+            if self._write_pool is None:
+                self._write_pool = ThreadPool(self._write_threads)
+            write_pool = self._write_pool
+        write_pool.map(func, items)
+
     def delete_namespace(self):
         '''Deletes all data from the namespace.
 
@@ -66,22 +131,27 @@ class RiakStorage(StringKeyedStorage):
         '''Write some data to a table.
 
         Because of the way Riak works, each key/value pair is a separate
-        write operation.  This backend makes no distinction between one
-        write with multiple keys and multiple writes with one key.
+        write operation.  These are run concurrently on the writer pool.
 
         :param keys_and_values: data items to write
         :paramtype keys_and_values: pairs of (key, value)
 
         '''
         bucket = self._bucket(table_name)
-        for k, v in keys_and_values:
-            # Always do this with a read/write to maintain vector clock
-            # consistency...even though this means we're pushing objects
-            # around more than we need to
-            obj = bucket.get(k)
-            obj.encoded_data = v
-            obj.content_type = 'application/octet-stream'
-            obj.store()
+
+        def store((k, v)):
+            if self._vclock_reads:
+                # Do this with a read/write to maintain vector clock
+                # consistency...even though this means we're pushing
+                # objects around more than we need to
+                obj = bucket.get(k)
+                obj.encoded_data = v
+                obj.content_type = 'application/octet-stream'
+            else:
+                obj = bucket.new(k, encoded_data=v,
+                                 content_type='application/octet-stream')
+            obj.store(return_body=False)
+        self._each(store, keys_and_values)
 
     def _scan(self, table_name, key_ranges):
         '''Scan key/value ranges from a table.
@@ -168,12 +238,15 @@ class RiakStorage(StringKeyedStorage):
         '''Delete some specific keys.'''
         bucket = self._bucket(table_name)
 
-        for key in keys:
-            # Always do this with a read/write to maintain vector clock
-            # consistency...even though this means we're pushing objects
-            # around more than we need to
-            obj = bucket.get(key)
-            obj.delete()
+        def delete(key):
+            if self._vclock_reads:
+                # Do this with a read/write to maintain vector clock
+                # consistency...even though this means we're pushing
+                # objects around more than we need to
+                bucket.get(key).delete()
+            else:
+                bucket.delete(key)
+        self._each(delete, keys)
 
     def close(self):
         '''End use of this storage client.
@@ -184,4 +257,11 @@ class RiakStorage(StringKeyedStorage):
 
         '''
         super(RiakStorage, self).close()
+        with self._write_pool_lock:
+            write_pool = self._write_pool
+            self._write_pool = None
+        if write_pool is not None:
+            # let writes in progress finish, then stop the threads
+            write_pool.close()
+            write_pool.join()
         self.connection = None
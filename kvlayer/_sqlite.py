@@ -0,0 +1,226 @@
+'''
+Implementation of AbstractStorage using SQLite
+
+This uses the :mod:`sqlite3` module from the Python standard library,
+so it needs no server and no additional packages.  The database is
+put in write-ahead-log mode, so any number of processes on the same
+host can read it while one of them writes.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import contextlib
+import logging
+import re
+import sqlite3
+import threading
+
+from kvlayer._abstract_storage import StringKeyedStorage
+from kvlayer._exceptions import ProgrammerError
+
+
+logger = logging.getLogger(__name__)
+
+
+# SQL strings in this module use python3 style string.format() formatting
+# to substitute the table name into the command.
+
+
+_sqlite_identifier_re = re.compile(r'^[a-z_][a-z0-9_]*$', re.IGNORECASE)
+
+
+# kv_{app_name}_{namespace}
+# table, key, value
+_CREATE_TABLE = '''CREATE TABLE IF NOT EXISTS {table} (
+  t TEXT NOT NULL,
+  k BLOB NOT NULL,
+  v BLOB,
+  PRIMARY KEY (t, k)
+) WITHOUT ROWID'''
+
+_DROP_TABLE = 'DROP TABLE IF EXISTS {table}'
+
+_CLEAR_TABLE = 'DELETE FROM {table} WHERE t = ?'
+
+_PUT = 'INSERT OR REPLACE INTO {table} (t, k, v) VALUES (?, ?, ?)'
+
+_GET_MANY = 'SELECT k, v FROM {table} WHERE t = ? AND k IN ({params})'
+
+_GET_KV = 'SELECT k, v FROM {table} WHERE t = ?'
+_GET_K = 'SELECT k FROM {table} WHERE t = ?'
+_GET_MIN = ' AND k >= ?'
+_GET_MAX = ' AND k <= ?'
+_SCAN_ORDER = ' ORDER BY k ASC'
+
+_DELETE = 'DELETE FROM {table} WHERE t = ? AND k = ?'
+
+
+class SqliteStorage(StringKeyedStorage):
+    '''SQLite storage in a single local file.
+
+    Each thread gets its own connection to the database.  Writes run
+    in ``BEGIN IMMEDIATE`` transactions, so concurrent writers queue
+    up behind each other (for up to ``sqlite_timeout`` seconds) rather
+    than failing part way through.  Scans each run on a separate
+    connection from a pool, since a connection holding a scan's
+    snapshot open cannot write anything newer than that snapshot.
+
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(SqliteStorage, self).__init__(*args, **kwargs)
+        for name in (self._app_name, self._namespace):
+            if not _sqlite_identifier_re.match(name):
+                raise ProgrammerError('app_name and namespace must match '
+                                      're: %r' % (_sqlite_identifier_re
+                                                  .pattern,))
+        self._filename = self._config.get('filename')
+        if not self._filename:
+            raise ProgrammerError('sqlite kvlayer needs config["filename"]')
+        self._table = 'kv_{0}_{1}'.format(self._app_name, self._namespace)
+        self._timeout = float(self._config.get('sqlite_timeout', 30.0))
+        self._synchronous = self._config.get('sqlite_synchronous', 'NORMAL')
+        self._get_batch_size = int(self._config.get('sqlite_get_batch_size',
+                                                    500))
+        self._local = threading.local()
+        self._connections = []
+        self._scan_connections = []
+        self._connections_lock = threading.Lock()
+
+    def _connect(self):
+        # isolation_level=None leaves transactions to us, rather than
+        # having the sqlite3 module guess where they begin and end
+        conn = sqlite3.connect(self._filename, timeout=self._timeout,
+                               isolation_level=None,
+                               check_same_thread=False)
+        conn.text_factory = str
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous={0}'.format(self._synchronous))
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    def _conn(self):
+        '''Get this thread's connection to the database.'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _scan_conn(self):
+        '''Borrow an idle connection for the duration of a scan.'''
+        with self._connections_lock:
+            conn = (self._scan_connections.pop()
+                    if self._scan_connections else None)
+        if conn is None:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            with self._connections_lock:
+                if conn in self._connections:
+                    self._scan_connections.append(conn)
+
+    def _write(self, sql, params=None, many=False):
+        '''Run one statement in its own write transaction.'''
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if many:
+                conn.executemany(sql, params)
+            elif params is None:
+                conn.execute(sql)
+            else:
+                conn.execute(sql, params)
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def setup_namespace(self, table_names, value_types={}):
+        super(SqliteStorage, self).setup_namespace(table_names, value_types)
+        self._write(_CREATE_TABLE.format(table=self._table))
+
+    def delete_namespace(self):
+        self._write(_DROP_TABLE.format(table=self._table))
+
+    def clear_table(self, table_name):
+        self._write(_CLEAR_TABLE.format(table=self._table), (table_name,))
+
+    def _put(self, table_name, keys_and_values):
+        self._write(_PUT.format(table=self._table),
+                    ((table_name, sqlite3.Binary(k), sqlite3.Binary(v))
+                     for (k, v) in keys_and_values),
+                    many=True)
+
+    def _get(self, table_name, keys):
+        conn = self._conn()
+        for start in xrange(0, len(keys), self._get_batch_size):
+            batch = keys[start:start + self._get_batch_size]
+            query = _GET_MANY.format(table=self._table,
+                                     params=', '.join('?' * len(batch)))
+            found = dict((str(k), str(v)) for (k, v) in conn.execute(
+                query, [table_name] + [sqlite3.Binary(k) for k in batch]))
+            for k in batch:
+                yield (k, found.get(k))
+
+    def _scan(self, table_name, key_ranges):
+        for kmin, kmax in (key_ranges or [(None, None)]):
+            for k, v in self._scan_kminmax(table_name, kmin, kmax, True):
+                yield (str(k), str(v))
+
+    def _scan_keys(self, table_name, key_ranges):
+        for kmin, kmax in (key_ranges or [(None, None)]):
+            for (k,) in self._scan_kminmax(table_name, kmin, kmax, False):
+                yield str(k)
+
+    def _scan_kminmax(self, table_name, kmin, kmax, with_values):
+        '''Yield rows from one key range.
+
+        Rows are stepped through one at a time as the caller consumes
+        them, so the scan does not hold the whole range in memory.
+        In WAL mode the open cursor sees a consistent snapshot and
+        does not block writers.
+
+        '''
+        if with_values:
+            query = _GET_KV
+        else:
+            query = _GET_K
+        query = query.format(table=self._table)
+        args = [table_name]
+        if kmin:
+            query += _GET_MIN
+            args.append(sqlite3.Binary(kmin))
+        if kmax:
+            query += _GET_MAX
+            args.append(sqlite3.Binary(kmax))
+        query += _SCAN_ORDER
+        with self._scan_conn() as conn:
+            cursor = conn.execute(query, args)
+            try:
+                for row in cursor:
+                    yield row
+            finally:
+                cursor.close()
+
+    def _delete(self, table_name, keys):
+        self._write(_DELETE.format(table=self._table),
+                    [(table_name, sqlite3.Binary(k)) for k in keys],
+                    many=True)
+
+    def close(self):
+        '''
+        close connections and end use of this storage client
+        '''
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._scan_connections = []
+        self._local = threading.local()
+        super(SqliteStorage, self).close()
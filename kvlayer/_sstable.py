@@ -0,0 +1,493 @@
+"""Memory-mapped sorted string table kvlayer storage implementation.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2015 Diffeo, Inc.
+
+This is an implementation of :mod:`kvlayer` for read-mostly data that
+lives on the local disk, such as precomputed lookup tables shipped to
+workers.  Each kvlayer table is a directory of immutable files, each
+holding a sorted run of encoded keys and their values.  The files are
+memory-mapped, so many processes reading the same table share the
+same pages, and opening a file reads only its fixed-size footer.
+
+Writes are buffered in memory and written out as a new file when the
+buffer fills up, on :meth:`SSTableStorage.flush`, or on
+:meth:`SSTableStorage.close`.  Newer files take precedence over older
+ones; deleted keys are recorded as tombstones until the files are
+merged by :meth:`SSTableStorage.compact`.
+
+Each file is laid out as::
+
+    MAGIC
+    data blocks: (key length, value length, key, value) ...
+    block index: offset of each data block
+    bloom filter bits
+    footer
+
+A lookup binary searches the block index, comparing against the first
+key of each block, and then reads through a single block.  The bloom
+filter lets most lookups of absent keys skip the file entirely.
+
+.. autoclass:: SSTableStorage
+
+.. autoclass:: SSTable
+
+"""
+
+from __future__ import absolute_import
+import hashlib
+import heapq
+import logging
+import mmap
+import os
+import shutil
+import struct
+import threading
+
+from kvlayer._abstract_storage import StringKeyedStorage
+from kvlayer._exceptions import ConfigurationError
+
+logger = logging.getLogger(__name__)
+
+#: Bytes at the start and end of every file
+MAGIC = b'KVLSST01'
+
+#: Each data entry starts with key length and value length
+ENTRY = struct.Struct('>II')
+
+#: Value length marking a deleted key
+TOMBSTONE = 0xffffffff
+
+#: Each block index entry is the file offset of the block
+INDEX_ENTRY = struct.Struct('>Q')
+
+#: Index offset, block count, bloom offset, bloom bits, bloom hash
+#: count, entry count, magic
+FOOTER = struct.Struct('>QQQQQQ8s')
+
+
+def _bloom_hashes(key):
+    '''Get the two base hashes of `key` for the bloom filter.
+
+    This needs to be stable across processes and Python versions,
+    so it does not use :func:`hash`.
+
+    '''
+    return struct.unpack('>QQ', hashlib.md5(key).digest())
+
+
+def write_sstable(filename, items, block_size=4096, bloom_bits_per_key=10):
+    '''Write a new sorted string table file.
+
+    The file is written under a temporary name and renamed into place,
+    so readers never see a partial file.
+
+    :param str filename: name of the file to create
+    :param items: iterable of `(key, value)` pairs in key order;
+      `value` may be :const:`None` to record a deleted key
+    :param int block_size: approximate size of each data block
+    :param int bloom_bits_per_key: bloom filter size; 10 bits per key
+      gives about a 1% false positive rate
+
+    '''
+    tmpname = filename + '.tmp'
+    block_offsets = []
+    hashes = []
+    with open(tmpname, 'wb') as f:
+        f.write(MAGIC)
+        position = len(MAGIC)
+        block_start = None
+        for key, value in items:
+            if block_start is None or position - block_start >= block_size:
+                block_start = position
+                block_offsets.append(position)
+            if value is None:
+                f.write(ENTRY.pack(len(key), TOMBSTONE))
+                f.write(key)
+                position += ENTRY.size + len(key)
+            else:
+                f.write(ENTRY.pack(len(key), len(value)))
+                f.write(key)
+                f.write(value)
+                position += ENTRY.size + len(key) + len(value)
+            hashes.append(_bloom_hashes(key))
+
+        index_offset = position
+        for offset in block_offsets:
+            f.write(INDEX_ENTRY.pack(offset))
+        position += INDEX_ENTRY.size * len(block_offsets)
+
+        num_bits = max(64, len(hashes) * bloom_bits_per_key)
+        num_hashes = max(1, int(round(bloom_bits_per_key * 0.69)))
+        bits = bytearray((num_bits + 7) // 8)
+        for h1, h2 in hashes:
+            for i in xrange(num_hashes):
+                bit = (h1 + i * h2) % num_bits
+                bits[bit // 8] |= 1 << (bit % 8)
+        f.write(bits)
+
+        f.write(FOOTER.pack(index_offset, len(block_offsets), position,
+                            num_bits, num_hashes, len(hashes), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpname, filename)
+
+
+class SSTable(object):
+    '''Reader for a single memory-mapped sorted string table file.
+
+    Opening the file only reads its footer; the block index and bloom
+    filter are consulted in place through the memory map.
+
+    The memory map stays open until :meth:`close` has been called
+    and every :meth:`acquire` has been matched by a :meth:`release`,
+    so a scan that is still reading the file is not cut off when the
+    file is compacted away.
+
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        # the opener's reference, dropped by close()
+        self._refs = 1
+        self._refs_lock = threading.Lock()
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if ((len(self._mmap) < len(MAGIC) + FOOTER.size or
+             self._mmap[:len(MAGIC)] != MAGIC)):
+            raise ConfigurationError('{0!r} is not a kvlayer sstable'
+                                     .format(filename))
+        (self._index_offset, self._num_blocks, self._bloom_offset,
+         self._num_bits, self._num_hashes, self.num_entries, magic) = \
+            FOOTER.unpack_from(self._mmap, len(self._mmap) - FOOTER.size)
+        if magic != MAGIC:
+            raise ConfigurationError('{0!r} is not a kvlayer sstable'
+                                     .format(filename))
+
+    def acquire(self):
+        '''Keep the file mapped until a matching :meth:`release`.'''
+        with self._refs_lock:
+            self._refs += 1
+
+    def release(self):
+        '''Drop a reference, unmapping the file after the last one.'''
+        with self._refs_lock:
+            self._refs -= 1
+            last = self._refs == 0
+        if last:
+            self._mmap.close()
+
+    def close(self):
+        '''Drop the opener's reference to the file.'''
+        self.release()
+
+    def _block_offset(self, i):
+        return INDEX_ENTRY.unpack_from(
+            self._mmap, self._index_offset + INDEX_ENTRY.size * i)[0]
+
+    def _block_end(self, i):
+        if i + 1 < self._num_blocks:
+            return self._block_offset(i + 1)
+        return self._index_offset
+
+    def _entry(self, offset):
+        '''Read the entry at `offset`.
+
+        :return: triple of key, value (:const:`None` for a tombstone),
+          and offset of the next entry
+
+        '''
+        key_len, value_len = ENTRY.unpack_from(self._mmap, offset)
+        offset += ENTRY.size
+        key = self._mmap[offset:offset + key_len]
+        offset += key_len
+        if value_len == TOMBSTONE:
+            return key, None, offset
+        return key, self._mmap[offset:offset + value_len], offset + value_len
+
+    def _find_block(self, key):
+        '''Find the last block whose first key is at most `key`.'''
+        lo, hi = 0, self._num_blocks
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(self._block_offset(mid))[0] <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return max(lo - 1, 0)
+
+    def might_contain(self, key):
+        '''Check the bloom filter for `key`.
+
+        If this returns :const:`False` then `key` is definitely not in
+        this file.
+
+        '''
+        h1, h2 = _bloom_hashes(key)
+        for i in xrange(self._num_hashes):
+            bit = (h1 + i * h2) % self._num_bits
+            byte = ord(self._mmap[self._bloom_offset + bit // 8])
+            if not byte & (1 << (bit % 8)):
+                return False
+        return True
+
+    def get(self, key):
+        '''Look up a single key.
+
+        :return: pair of whether `key` is in this file at all, and
+          its value, which is :const:`None` if it was deleted
+
+        '''
+        if self._num_blocks == 0 or not self.might_contain(key):
+            return False, None
+        block = self._find_block(key)
+        offset = self._block_offset(block)
+        end = self._block_end(block)
+        while offset < end:
+            k, v, offset = self._entry(offset)
+            if k == key:
+                return True, v
+            if k > key:
+                break
+        return False, None
+
+    def scan(self, start, end):
+        '''Yield `(key, value)` pairs with `start` <= key <= `end`.
+
+        Either bound may be :const:`None` to scan from the start or
+        to the end of the file.  Deleted keys are yielded with a
+        value of :const:`None`.
+
+        '''
+        if self._num_blocks == 0:
+            return
+        if start is None:
+            offset = self._block_offset(0)
+        else:
+            offset = self._block_offset(self._find_block(start))
+        while offset < self._index_offset:
+            k, v, offset = self._entry(offset)
+            if start is not None and k < start:
+                continue
+            if end is not None and k > end:
+                break
+            yield k, v
+
+
+def _merge_runs(runs):
+    '''Merge sorted runs of `(key, value)`, preferring earlier runs.
+
+    Yields every key once, with the value from the first run that
+    has it, including tombstones.
+
+    '''
+    def tag(run, priority):
+        for k, v in run:
+            yield k, priority, v
+    previous = None
+    for k, priority, v in heapq.merge(*[tag(run, priority)
+                                        for priority, run
+                                        in enumerate(runs)]):
+        if k == previous:
+            continue
+        previous = k
+        yield k, v
+
+
+class SSTableStorage(StringKeyedStorage):
+    '''Memory-mapped sorted string table storage.
+
+    Only one process should write to a given table at a time, though
+    any number may read it.  Readers see the files that existed when
+    they called :meth:`setup_namespace`, plus any they write themselves.
+
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(SSTableStorage, self).__init__(*args, **kwargs)
+        base_dir = self._config.get('sstable_dir')
+        if not base_dir:
+            raise ConfigurationError('sstable storage requires sstable_dir')
+        self._namespace_dir = os.path.join(base_dir, self._app_name,
+                                           self._namespace)
+        self._block_size = self._config.get('sstable_block_size', 4096)
+        self._bloom_bits_per_key = self._config.get(
+            'sstable_bloom_bits_per_key', 10)
+        self._memtable_size = self._config.get('sstable_memtable_size',
+                                               100000)
+        self._max_files = self._config.get('sstable_max_files', 8)
+        # map of table name to list of SSTable, newest first
+        self._sstables = {}
+        # guards replacing SSTables against readers acquiring them
+        self._sstables_lock = threading.Lock()
+        # map of table name to dict of key to value or None
+        self._memtables = {}
+
+    def _table_dir(self, table_name):
+        return os.path.join(self._namespace_dir, table_name)
+
+    def _open_table(self, table_name):
+        table_dir = self._table_dir(table_name)
+        if not os.path.isdir(table_dir):
+            os.makedirs(table_dir)
+        names = sorted((name for name in os.listdir(table_dir)
+                        if name.endswith('.sst')), reverse=True)
+        sstables = [SSTable(os.path.join(table_dir, name)) for name in names]
+        with self._sstables_lock:
+            self._sstables[table_name] = sstables
+        self._memtables.setdefault(table_name, {})
+
+    def _close_table(self, table_name):
+        with self._sstables_lock:
+            sstables = self._sstables.pop(table_name, [])
+        for sstable in sstables:
+            sstable.close()
+        self._memtables.pop(table_name, None)
+
+    def _acquire_sstables(self, table_name):
+        '''Get a table's files, newest first, for reading.
+
+        Each file stays mapped, even if it is compacted away, until
+        the caller calls :meth:`SSTable.release` on it.
+
+        '''
+        with self._sstables_lock:
+            sstables = list(self._sstables[table_name])
+            for sstable in sstables:
+                sstable.acquire()
+        return sstables
+
+    def _next_filename(self, table_name):
+        sstables = self._sstables[table_name]
+        if sstables:
+            last = os.path.basename(sstables[0].filename)
+            number = int(last[:-len('.sst')]) + 1
+        else:
+            number = 0
+        return os.path.join(self._table_dir(table_name),
+                            '{0:020d}.sst'.format(number))
+
+    def setup_namespace(self, table_names, value_types={}):
+        super(SSTableStorage, self).setup_namespace(table_names, value_types)
+        for table_name in table_names:
+            if table_name not in self._sstables:
+                self._open_table(table_name)
+
+    def delete_namespace(self):
+        for table_name in self._sstables.keys():
+            self._close_table(table_name)
+        if os.path.isdir(self._namespace_dir):
+            shutil.rmtree(self._namespace_dir)
+
+    def clear_table(self, table_name):
+        self._close_table(table_name)
+        shutil.rmtree(self._table_dir(table_name), ignore_errors=True)
+        self._open_table(table_name)
+
+    def flush(self, table_name=None):
+        '''Write buffered changes out to new files.
+
+        :param str table_name: only flush this table; by default
+          flush every table
+
+        '''
+        if table_name is None:
+            table_names = self._memtables.keys()
+        else:
+            table_names = [table_name]
+        for table_name in table_names:
+            memtable = self._memtables[table_name]
+            if not memtable:
+                continue
+            filename = self._next_filename(table_name)
+            write_sstable(filename, sorted(memtable.iteritems()),
+                          block_size=self._block_size,
+                          bloom_bits_per_key=self._bloom_bits_per_key)
+            sstable = SSTable(filename)
+            with self._sstables_lock:
+                self._sstables[table_name].insert(0, sstable)
+            self._memtables[table_name] = {}
+            if len(self._sstables[table_name]) > self._max_files:
+                self.compact(table_name)
+
+    def compact(self, table_name):
+        '''Merge all of the files for a table into one.
+
+        This also discards tombstones, since there is nothing older
+        left for them to hide.  The old files are deleted straight
+        away, but scans already reading them keep their memory maps
+        until they finish.
+
+        '''
+        self.flush(table_name)
+        old = self._sstables[table_name]
+        if len(old) < 2:
+            return
+        filename = self._next_filename(table_name)
+        merged = _merge_runs([sstable.scan(None, None) for sstable in old])
+        write_sstable(filename, ((k, v) for (k, v) in merged if v is not None),
+                      block_size=self._block_size,
+                      bloom_bits_per_key=self._bloom_bits_per_key)
+        compacted = SSTable(filename)
+        with self._sstables_lock:
+            self._sstables[table_name] = [compacted]
+        for sstable in old:
+            # unlinking a mapped file leaves the mapping readable
+            os.remove(sstable.filename)
+            sstable.close()
+
+    def _put(self, table_name, keys_and_values):
+        memtable = self._memtables[table_name]
+        memtable.update(keys_and_values)
+        if len(memtable) >= self._memtable_size:
+            self.flush(table_name)
+
+    def _delete(self, table_name, keys):
+        memtable = self._memtables[table_name]
+        for k in keys:
+            memtable[k] = None
+        if len(memtable) >= self._memtable_size:
+            self.flush(table_name)
+
+    def _get(self, table_name, keys):
+        memtable = self._memtables[table_name]
+        sstables = self._acquire_sstables(table_name)
+        try:
+            for k in keys:
+                if k in memtable:
+                    yield k, memtable[k]
+                    continue
+                v = None
+                for sstable in sstables:
+                    found, v = sstable.get(k)
+                    if found:
+                        break
+                yield k, v
+        finally:
+            for sstable in sstables:
+                sstable.release()
+
+    def _scan(self, table_name, key_ranges):
+        memtable = self._memtables[table_name]
+        sstables = self._acquire_sstables(table_name)
+        if not key_ranges:
+            key_ranges = [(None, None)]
+        try:
+            for start, end in key_ranges:
+                buffered = sorted((k, v) for (k, v) in memtable.iteritems()
+                                  if ((start is None or k >= start) and
+                                      (end is None or k <= end)))
+                runs = [buffered] + [sstable.scan(start, end)
+                                     for sstable in sstables]
+                for k, v in _merge_runs(runs):
+                    if v is not None:
+                        yield k, v
+        finally:
+            for sstable in sstables:
+                sstable.release()
+
+    def close(self):
+        self.flush()
+        for table_name in self._sstables.keys():
+            self._close_table(table_name)
+        super(SSTableStorage, self).close()
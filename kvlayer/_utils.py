@@ -6,8 +6,12 @@ Your use of this software is governed by your license agreement.
 Copyright 2012-2015 Diffeo, Inc.
 '''
 
-import uuid
 import itertools
+import Queue
+import sys
+import threading
+import uuid
+
 from kvlayer._exceptions import StorageClosed, BadKey, SerializationError
 
 
@@ -68,3 +72,98 @@ class batches(object):
                 batch = []
         if batch:
             yield batch
+
+
+def parallel_scan(scan_piece, pieces, num_threads, ordered=True,
+                  batch_size=100):
+    '''Scan several pieces of a table concurrently.
+
+    Calls ``scan_piece(piece)`` for each of `pieces`, each returning
+    an iterator of results, on up to `num_threads` threads.  If
+    `ordered`, yields all of the results of the first piece, then
+    all of the second, and so on, so that results come back in key
+    order if `pieces` are in key order; otherwise yields results as
+    soon as any thread produces them.  Threads only read a couple of
+    batches of `batch_size` results ahead of the caller.  If a
+    thread fails, its exception is raised in the caller with the
+    thread's traceback.
+
+    '''
+    pieces = list(pieces)
+    if num_threads <= 1 or len(pieces) <= 1:
+        for piece in pieces:
+            for item in scan_piece(piece):
+                yield item
+        return
+
+    stop = threading.Event()
+    if ordered:
+        outputs = [Queue.Queue(maxsize=2) for _ in pieces]
+    else:
+        shared = Queue.Queue(maxsize=2 * num_threads)
+        outputs = [shared] * len(pieces)
+    todo = Queue.Queue()
+    for n in xrange(len(pieces)):
+        todo.put(n)
+
+    def send(output, item):
+        # give up if the caller has stopped reading
+        while not stop.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def work():
+        while not stop.is_set():
+            try:
+                n = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                for batch in batches(scan_piece(pieces[n]), batch_size):
+                    send(outputs[n], batch)
+                    if stop.is_set():
+                        return
+                send(outputs[n], None)
+            except Exception:
+                # a tuple, where batches are lists
+                send(outputs[n], sys.exc_info())
+
+    threads = [threading.Thread(target=work, name='kvlayer-scan-%d' % n)
+               for n in xrange(min(num_threads, len(pieces)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        # each piece ends with None; in unordered mode they all
+        # share one queue, which then ends with len(pieces) Nones
+        for output in outputs:
+            while True:
+                batch = output.get()
+                if batch is None:
+                    break
+                if isinstance(batch, tuple):
+                    exc_type, exc_value, exc_tb = batch
+                    raise exc_type, exc_value, exc_tb
+                for item in batch:
+                    yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def split_key_range(start, stop, boundaries):
+    '''Split a range of string keys at sorted `boundaries`.
+
+    Returns a list of ``(start, stop)`` pairs covering the range
+    from `start` to `stop` in order, where an empty string means
+    the range is unbounded on that end, and each boundary strictly
+    inside the range starts a new piece.
+
+    '''
+    inside = [b for b in boundaries
+              if b and b > start and (not stop or b < stop)]
+    return zip([start] + inside, inside + [stop])
@@ -367,12 +367,7 @@ def perftest_throughput_insert_random(num_workers=4,
     if client is None:
         client = kvlayer.client()
     if client._config.get('storage_type') == 'accumulo':
-        import struct
-        client.setup_namespace(dict(t1=2))
-        step = ((0x7fffffff // 20) * 2) + 1
-        splits = [struct.pack('>I', i) for i in xrange(step, 0x0ffffffff, step)]
-        logger.info('accumulo splits=%r', splits)
-        client.conn.client.addSplits(client.conn.login, client._ns('t1'), splits)
+        client.setup_namespace(dict(t1=2), num_splits=20)
 
     num_inserts = num_items_per_batch * num_batches
     total_inserts = num_workers * num_inserts
@@ -97,6 +97,18 @@ def test_clear_table(client, direct):
         assert False
 
 
+def test_clear_table_keeps_splits(client, direct):
+    client.setup_namespace({'table1': (uuid.UUID,)}, num_splits=4)
+    splits = sorted(direct.client.getSplits(
+        direct.login, client._test_ns('table1'), 10))
+    assert len(splits) == 3
+    client.put('table1', ((uuid.uuid4(),), 'value'))
+    client.clear_table('table1')
+    assert list(client.scan('table1')) == []
+    assert sorted(direct.client.getSplits(
+        direct.login, client._test_ns('table1'), 10)) == splits
+
+
 def test_put_get(client, direct):
     client.setup_namespace({'table1': 1, 'table2': 1})
     kv_dict = dict([((uuid.uuid4(),), 'value' + str(x)) for x in xrange(10)])
@@ -145,6 +157,15 @@ def test_delete(client, direct):
         assert list(client.scan('table1', (key, key))) == []
 
 
+def test_delete_then_put(client):
+    client.setup_namespace({'table1': 1})
+    key = (uuid.uuid4(),)
+    client.put('table1', (key, 'old'))
+    client.delete('table1', key)
+    client.put('table1', (key, 'new'))
+    assert list(client.get('table1', key)) == [(key, 'new')]
+
+
 def test_close(client):
     conn = client.conn
     assert conn
@@ -0,0 +1,148 @@
+'''Tests for the cborproxy backend against the in-memory stand-in server.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import threading
+import time
+import uuid
+
+import pytest
+
+from kvlayer._abstract_storage import COUNTER
+
+try:
+    from kvlayer._cbor_proxy import CborProxyStorage
+    from kvlayer._cbor_proxy_server import CborProxyServer
+    cbor_missing = 'False'
+except ImportError:
+    cbor_missing = 'True'
+
+
+@pytest.yield_fixture
+def server():
+    server = CborProxyServer(page_size=7)
+    server.start()
+    yield server
+    server.stop()
+
+
+def make_client(server, namespace_string, **config):
+    config.update({
+        'app_name': 'kvlayer',
+        'namespace': namespace_string,
+        'zk_addresses': ['zk.example.com'],
+        'proxy_addresses': ['%s:%d' % server.address],
+        'username': 'test',
+        'password': 'test',
+        'instance_name': 'test',
+    })
+    return CborProxyStorage(config)
+
+
+@pytest.yield_fixture(params=[0, 2])
+def client(request, server, namespace_string):
+    client = make_client(server, namespace_string, get_batch_size=3,
+                         put_batch_size=4, scan_prefetch_pages=request.param)
+    client.setup_namespace({'t': 1, 'c': 1}, {'c': COUNTER})
+    yield client
+    client.delete_namespace()
+
+
+@pytest.mark.skipif(cbor_missing)
+def test_put_get_delete(client):
+    keys = [(uuid.uuid4(),) for _ in xrange(10)]
+    client.put('t', *[(k, str(k[0])) for k in keys])
+    missing = (uuid.uuid4(),)
+    assert (list(client.get('t', missing, *keys)) ==
+            [(missing, None)] + [(k, str(k[0])) for k in keys])
+    client.delete('t', *keys[:5])
+    assert (list(client.get('t', *keys)) ==
+            [(k, None) for k in keys[:5]] + [(k, str(k[0])) for k in keys[5:]])
+
+
+@pytest.mark.skipif(cbor_missing)
+def test_scan_pages(client):
+    keys = sorted((uuid.UUID(int=n),) for n in xrange(30))
+    client.put('t', *[(k, str(k[0].int)) for k in keys])
+    assert list(client.scan('t')) == [(k, str(k[0].int)) for k in keys]
+    assert list(client.scan_keys('t')) == keys
+    ranges = [(keys[2], keys[12]), (keys[20], keys[29])]
+    assert (list(client.scan_keys('t', *ranges)) ==
+            keys[2:13] + keys[20:30])
+    # stopping part way through is fine
+    for k in client.scan_keys('t'):
+        break
+    assert list(client.scan_keys('t', (keys[29], ()))) == keys[29:]
+
+
+@pytest.mark.skipif(cbor_missing)
+def test_increment(client):
+    k = (uuid.uuid4(),)
+    client.increment('c', (k, 2))
+    client.increment('c', (k, 3))
+    assert list(client.get('c', k)) == [(k, 5)]
+
+
+@pytest.mark.skipif(cbor_missing)
+def test_pipelined_gets(server, namespace_string):
+    '''Concurrent requests overlap on a few shared connections.'''
+    server.latency_seconds = 0.05
+    client = make_client(server, namespace_string, get_batch_size=1,
+                         proxy_connections=2)
+    client.setup_namespace({'t': 1})
+    keys = [(uuid.uuid4(),) for _ in xrange(20)]
+    start = time.time()
+    assert list(client.get('t', *keys)) == [(k, None) for k in keys]
+    # 20 requests, one after another, would take a whole second
+    assert time.time() - start < 0.5
+
+    results = []
+
+    def get_all():
+        results.append(list(client.get('t', *keys)))
+    threads = [threading.Thread(target=get_all) for _ in xrange(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [[(k, None) for k in keys]] * 5
+    client.delete_namespace()
+
+
+@pytest.mark.skipif(cbor_missing)
+def test_sequential_large_batches(namespace_string):
+    '''Big requests and responses cross on one connection.
+
+    A server that handles one request at a time stops reading
+    requests while it is blocked sending a response, so the client
+    must keep reading responses while it is blocked sending.
+
+    '''
+    server = CborProxyServer(sequential=True)
+    server.start()
+    client = make_client(server, namespace_string, get_batch_size=4,
+                         put_batch_size=4, proxy_connections=1)
+    client.setup_namespace({'t': 1})
+    value = b'x' * 2 ** 20
+    keys = [(uuid.UUID(int=n),) for n in xrange(48)]
+    client.put('t', *[(k, value) for k in keys])
+    results = []
+
+    def get_all():
+        results.append(list(client.get('t', *keys)))
+
+    def put_all():
+        client.put('t', *[(k, value) for k in keys])
+    threads = ([threading.Thread(target=get_all) for _ in xrange(2)] +
+               [threading.Thread(target=put_all) for _ in xrange(2)])
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+        assert not thread.is_alive(), 'deadlocked'
+    assert results == [[(k, value) for k in keys]] * 2
+    client.delete_namespace()
+    server.stop()
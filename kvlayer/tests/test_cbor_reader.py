@@ -0,0 +1,128 @@
+'''Tests and a microbenchmark for the CBOR proxy socket reader.
+
+Run this module directly to measure how fast CBOR responses of
+several value sizes decode from a socket::
+
+    python -m kvlayer.tests.test_cbor_reader --value-size 100 1000000
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import, division
+import argparse
+import socket
+import threading
+import time
+
+import pytest
+
+try:
+    import cbor
+    from kvlayer._cbor_proxy import SocketReader
+    cbor_missing = 'False'
+except ImportError:
+    cbor_missing = 'True'
+
+
+class RecvSocketReader(object):
+    '''The old unbuffered reader, for comparison.
+
+    Calls ``recv`` for every read and builds up the result by string
+    concatenation.
+
+    '''
+    def __init__(self, sock):
+        self.socket = sock
+
+    def read(self, num):
+        data = self.socket.recv(num)
+        while data and len(data) < num:
+            ndat = self.socket.recv(num - len(data))
+            if not ndat:
+                break
+            data += ndat
+        return data
+
+
+def send_in_background(sock, data, chunk_size=None):
+    '''Write `data` to `sock` from another thread, then close it.'''
+    def send():
+        if chunk_size:
+            for start in xrange(0, len(data), chunk_size):
+                sock.sendall(data[start:start + chunk_size])
+                time.sleep(0.001)
+        else:
+            sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+    thread = threading.Thread(target=send)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def make_response(num_values, value_size, msgid=1):
+    return {'id': msgid,
+            'result': [['key%08d' % n, b'x' * value_size]
+                       for n in xrange(num_values)]}
+
+
+@pytest.mark.skipif(cbor_missing)
+@pytest.mark.parametrize('value_size', [0, 10, 70000, 300000])
+def test_read_responses(value_size):
+    responses = [make_response(5, value_size, msgid) for msgid in xrange(5)]
+    rsock, wsock = socket.socketpair()
+    send_in_background(wsock, ''.join(cbor.dumps(r) for r in responses),
+                       chunk_size=40961)
+    reader = SocketReader(rsock, buffer_size=4096)
+    for response in responses:
+        assert cbor.load(reader) == response
+    with pytest.raises(EOFError):
+        cbor.load(reader)
+
+
+@pytest.mark.skipif(cbor_missing)
+def test_read_short():
+    rsock, wsock = socket.socketpair()
+    send_in_background(wsock, 'abcdefghij').join()
+    reader = SocketReader(rsock, buffer_size=4)
+    assert reader.read(3) == 'abc'
+    assert reader.read(2) == 'de'
+    assert reader.read(10) == 'fghij'
+    assert reader.read(1) == ''
+
+
+def reader_throughput(reader_class, value_size, total_bytes=2 ** 26):
+    '''Decode responses from a socket; return the MB/second.'''
+    num_values = max(1, min(1000, 2 ** 20 // (value_size + 1)))
+    data = cbor.dumps(make_response(num_values, value_size))
+    count = max(1, total_bytes // len(data))
+    rsock, wsock = socket.socketpair()
+    sender = send_in_background(wsock, data * count)
+    reader = reader_class(rsock)
+    start_time = time.time()
+    for _ in xrange(count):
+        cbor.load(reader)
+    elapsed = time.time() - start_time
+    sender.join()
+    rsock.close()
+    wsock.close()
+    return len(data) * count / elapsed / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='measure CBOR response decoding speed')
+    parser.add_argument('--value-size', nargs='+', type=int,
+                        default=[10, 1000, 100000, 10000000])
+    parser.add_argument('--total-mb', type=int, default=64)
+    args = parser.parse_args()
+    for value_size in args.value_size:
+        for reader_class in (RecvSocketReader, SocketReader):
+            rate = reader_throughput(reader_class, value_size,
+                                     args.total_mb * 2 ** 20)
+            print('%-16s value_size=%-9d %8.1f MB/sec' %
+                  (reader_class.__name__, value_size, rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+'''Tests specific to the HBase backend.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import threading
+import uuid
+
+import pytest
+
+import kvlayer
+import yakonfig
+
+try:
+    import happybase
+    happybase_missing = 'False'
+except ImportError:
+    happybase_missing = 'True'
+
+
+@pytest.yield_fixture
+def client(request, namespace_string):
+    config_path = str(request.fspath.dirpath('config_hbase.yaml'))
+    with yakonfig.defaulted_config([kvlayer], filename=config_path,
+                                   params={'app_name': 'kvlayer',
+                                           'namespace': namespace_string,
+                                           'pool_size': 2}):
+        client = kvlayer.client()
+        client.setup_namespace({'t1': 1, 't2': 1})
+        yield client
+        client.delete_namespace()
+        client.close()
+
+
+@pytest.mark.skipif(happybase_missing)
+def test_write_during_parallel_scan(client):
+    '''Writing while reading a parallel scan does not deadlock.'''
+    keys = sorted((uuid.UUID(int=n),) for n in xrange(4000))
+    client.put('t1', *[(k, str(k[0].int)) for k in keys])
+    # every key range is its own piece, each too big to be queued
+    # up entirely, so both scan threads stay busy
+    ranges = [(keys[n], keys[n + 999]) for n in xrange(0, 4000, 1000)]
+    copied = []
+
+    def copy():
+        for k, v in client.scan('t1', *ranges, parallel=True):
+            client.put('t2', (k, v))
+            assert list(client.get('t2', k)) == [(k, v)]
+            copied.append(k)
+    thread = threading.Thread(target=copy)
+    thread.daemon = True
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), 'deadlocked'
+    assert copied == keys
+    assert list(client.scan_keys('t2')) == keys
@@ -17,6 +17,7 @@ import yaml
 from pytest_diffeo import redis_address
 import kvlayer
 from kvlayer import BadKey
+from kvlayer._abstract_storage import ACCUMULATOR
 from kvlayer._client import STORAGE_CLIENTS, load_entry_point_kvlayer_impls
 import yakonfig
 
@@ -83,7 +84,7 @@ def client(backend, request, tmpdir, namespace_string):
     )
 
     # this is hacky but must go somewhere
-    if backend == 'filestorage':
+    if backend in ('filestorage', 'logfile', 'sqlite'):
         local = tmpdir.join('local')
         with local.open('w') as f:
             pass
@@ -92,6 +93,9 @@ def client(backend, request, tmpdir, namespace_string):
     if backend == 'redis':
         params['storage_addresses'] = [redis_address(request)]
 
+    if backend == 'sstable':
+        file_config['kvlayer']['sstable_dir'] = str(tmpdir.join('sstable'))
+
     with yakonfig.defaulted_config(
             [kvlayer],
             config=file_config,
@@ -589,6 +593,15 @@ def test_partial_scan(client):
     assert next(s2, None) is None
 
 
+def test_scan_multiple_ranges(client):
+    client.setup_namespace({'t1': (int,)})
+    client.put('t1', *[((i,), str(i)) for i in xrange(20)])
+    assert list(client.scan_keys('t1', ((2,), (4,)), ((10,), (11,)))) == \
+        [(2,), (3,), (4,), (10,), (11,)]
+    assert list(client.scan('t1', ((18,), ()), ((), (0,)))) == \
+        [((18,), '18'), ((19,), '19'), ((0,), '0')]
+
+
 def test_partial_scan_keys(client):
     '''Test that reading part of a table, then starting a new scan,
     doesn't break.'''
@@ -704,3 +717,11 @@ def test_counter_put(client):
 
     client.increment('t', (('k',), -20))
     assert list(client.get('t', ('k',))) == [(('k',), -3)]
+
+
+def test_accumulator_batch(client):
+    client.setup_namespace({'t': (str,)}, {'t': ACCUMULATOR})
+    client.increment('t', (('a',), 0.5), (('b',), 2.0))
+    client.increment('t', (('a',), 1.25), (('c',), -1.0))
+    assert list(client.scan('t')) == \
+        [(('a',), 1.75), (('b',), 2.0), (('c',), -1.0)]
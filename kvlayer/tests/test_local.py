@@ -5,7 +5,8 @@ import sys
 import pytest
 
 import kvlayer
-from kvlayer._local_memory import LocalStorage
+from kvlayer._exceptions import BadKey, ProgrammerError
+from kvlayer._local_memory import JoinedKeyCache, LocalStorage
 import yakonfig
 
 @pytest.yield_fixture
@@ -112,3 +113,88 @@ def test_negative_int_scan(local_storage):
     assert list(local_storage.scan('meta', (s, e))) == []
     # This should be:
     # assert list(local_storage.scan('meta', (s, e))) == [(k, '1')]
+
+
+def test_scan_after_put_and_delete(local_storage):
+    local_storage.setup_namespace({'meta': (int,)})
+    local_storage.put('meta', *[((i,), str(i)) for i in xrange(0, 10, 2)])
+    assert [k for k, v in local_storage.scan('meta')] == \
+        [(0,), (2,), (4,), (6,), (8,)]
+
+    # the sorted index built by the scan should see these changes
+    local_storage.put('meta', ((5,), '5'), ((2,), 'two'))
+    local_storage.delete('meta', (4,))
+    assert list(local_storage.scan('meta', ((1,), (6,)))) == \
+        [((2,), 'two'), ((5,), '5'), ((6,), '6')]
+
+    local_storage.clear_table('meta')
+    assert list(local_storage.scan('meta')) == []
+
+
+def test_scan_after_bad_put(local_storage):
+    local_storage.setup_namespace({'meta': (int,)})
+    local_storage.put('meta', ((0,), '0'))
+    assert list(local_storage.scan_keys('meta')) == [(0,)]
+
+    # the keys stored before the bad one must still be scanned
+    with pytest.raises(BadKey):
+        local_storage.put('meta', ((1,), '1'), ((2,), '2'), (('x',), 'x'),
+                          ((3,), '3'))
+    assert list(local_storage.scan_keys('meta')) == [(0,), (1,), (2,)]
+    local_storage.put('meta', ((1,), '1'), ((3,), '3'))
+    assert list(local_storage.scan_keys('meta')) == [(0,), (1,), (2,), (3,)]
+
+
+def test_joined_key_cache_bounded():
+    cache = JoinedKeyCache(3)
+    for i in xrange(3):
+        cache.put('a', (i,), str(i))
+    assert cache.get('a', (0,)) == '0'
+    cache.put('b', (9,), '9')
+    # (1,) was least recently used
+    assert len(cache) == 3
+    assert cache.get('a', (1,)) is None
+    assert cache.get('a', (2,)) == '2'
+    assert cache.table_size('a') == 2
+    assert cache.table_size('b') == 1
+
+    cache.discard('a', (2,))
+    assert cache.get('a', (2,)) is None
+    cache.clear_table('a')
+    assert len(cache) == 1
+    assert cache.get('b', (9,)) == '9'
+
+    stats = cache.stats.by_table
+    assert (stats['a'].hits, stats['a'].misses, stats['a'].evictions) == \
+        (2, 2, 1)
+    assert (stats['b'].hits, stats['b'].misses) == (1, 0)
+
+
+def test_joined_key_cache_invalidated(local_storage):
+    local_storage.setup_namespace({'meta': (int,)})
+    list(local_storage.scan('meta'))
+    local_storage.put('meta', ((1,), '1'), ((2,), '2'))
+    assert local_storage._joined_key_cache.table_size('meta') == 2
+    local_storage.delete('meta', (1,))
+    assert local_storage._joined_key_cache.table_size('meta') == 1
+    local_storage.clear_table('meta')
+    assert local_storage._joined_key_cache.table_size('meta') == 0
+
+
+def test_split_points(local_storage):
+    local_storage.setup_namespace({'u': 2, 'i': (int,), 's': (str,)})
+    splits = local_storage._split_points('u', 4)
+    assert splits == [local_storage._encoder.make_start_key(
+        (uuid.UUID(int=i << 126),), (uuid.UUID, uuid.UUID))
+        for i in xrange(1, 4)]
+
+    splits = local_storage._split_points('i', 2)
+    assert splits == [local_storage._encoder.serialize((0,), (int,))]
+
+    samples = [(c,) for c in 'abcdefgh']
+    splits = local_storage._split_points('s', 4, samples)
+    assert splits == [local_storage._encoder.serialize((c,), (str,))
+                      for c in 'ceg']
+    with pytest.raises(ProgrammerError):
+        local_storage._split_points('s', 4)
+    assert local_storage._split_points('s', 1) == []
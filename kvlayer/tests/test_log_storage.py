@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+import os
+import uuid
+
+from kvlayer._log_storage import LogFileStorage
+
+
+def make_storage(filename, namespace_string, **config):
+    LogFileStorage._logs.pop(filename, None)
+    config['filename'] = filename
+    storage = LogFileStorage(config=config, app_name='kvlayer',
+                             namespace=namespace_string)
+    storage.setup_namespace({'table1': 1, 'table2': (str,)})
+    return storage
+
+
+def test_persistence(tmpdir, namespace_string):
+    filename = str(tmpdir.join('log'))
+    u1, u2 = uuid.uuid4(), uuid.uuid4()
+
+    storage = make_storage(filename, namespace_string)
+    storage.put('table1', ((u1,), b'one'), ((u2,), b'two'))
+    storage.put('table2', (('a',), b'a'), (('b',), b'b'))
+    storage.put('table1', ((u1,), b'uno'))
+    storage.delete('table1', (u2,))
+    storage.clear_table('table2')
+    storage.put('table2', (('c',), b'c'))
+    storage.close()
+
+    storage = make_storage(filename, namespace_string)
+    assert list(storage.scan('table1')) == [((u1,), b'uno')]
+    assert list(storage.get('table1', (u2,))) == [((u2,), None)]
+    assert list(storage.scan('table2')) == [(('c',), b'c')]
+
+    storage.delete_namespace()
+    storage.close()
+    storage = make_storage(filename, namespace_string)
+    assert list(storage.scan('table1')) == []
+    assert list(storage.scan('table2')) == []
+
+
+def test_torn_record(tmpdir, namespace_string):
+    filename = str(tmpdir.join('log'))
+    storage = make_storage(filename, namespace_string)
+    storage.put('table2', (('a',), b'a'))
+    storage.put('table2', (('b',), b'b'))
+    storage.close()
+
+    # lose the last few bytes of the last record
+    with open(filename, 'r+b') as f:
+        f.truncate(os.path.getsize(filename) - 3)
+
+    storage = make_storage(filename, namespace_string)
+    assert list(storage.scan('table2')) == [(('a',), b'a')]
+    storage.put('table2', (('c',), b'c'))
+    storage.close()
+
+    storage = make_storage(filename, namespace_string)
+    assert list(storage.scan('table2')) == [(('a',), b'a'), (('c',), b'c')]
+
+
+def test_compaction(tmpdir, namespace_string):
+    filename = str(tmpdir.join('log'))
+    storage = make_storage(filename, namespace_string,
+                           log_compact_min_bytes=4096)
+    for i in xrange(100):
+        storage.put('table2', (('k',), b'x' * 100), (('i',), str(i)))
+    assert os.path.getsize(filename) < 4096 * 2
+    assert list(storage.scan('table2')) == \
+        [(('i',), b'99'), (('k',), b'x' * 100)]
+    storage.close()
+
+    storage = make_storage(filename, namespace_string)
+    assert list(storage.scan('table2')) == \
+        [(('i',), b'99'), (('k',), b'x' * 100)]
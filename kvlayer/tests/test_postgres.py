@@ -34,3 +34,283 @@ def test_illegal_namespaces(badnamespace):
     ['_ok', 'Aok', 'aok'])
 def test_legal_namespaces(namespace):
     assert _valid_namespace(namespace)
+
+
+@pytest.mark.skipif(postgres_missing)
+def test_copy_binary_reader():
+    from kvlayer._postgres import CopyBinaryReader
+    rows = iter([('a', 'one'), ('bb', None), ('c', 'three')])
+    reader = CopyBinaryReader(rows, lambda kv: kv, max_rows=2)
+    data = ''
+    while True:
+        chunk = reader.read(5)
+        if not chunk:
+            break
+        assert len(chunk) <= 5
+        data += chunk
+    assert data == (CopyBinaryReader.HEADER +
+                    '\x00\x02' '\x00\x00\x00\x01a' '\x00\x00\x00\x03one' +
+                    '\x00\x02' '\x00\x00\x00\x02bb' '\xff\xff\xff\xff' +
+                    CopyBinaryReader.TRAILER)
+    assert reader.num_rows == 2
+    assert reader.keys_size == 3
+    assert reader.values_size == 3
+    assert not reader.exhausted
+
+    # the rest of the rows go to the next reader
+    reader = CopyBinaryReader(rows, lambda kv: kv, max_rows=2)
+    reader.read()
+    assert reader.num_rows == 1
+    assert reader.exhausted
+
+
+class FakeCursor(object):
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.name = name
+        self.rowcount = -1
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __iter__(self):
+        while self.rows:
+            yield self.rows.pop(0)
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append(sql)
+        self.conn.params.append(params)
+        if self.conn.broken:
+            import psycopg2
+            raise psycopg2.OperationalError('server closed the connection')
+        self.rowcount = -1
+        self.rows = list(self.conn.respond(self, sql, params) or [])
+
+    def executemany(self, sql, seq_of_params):
+        for params in seq_of_params:
+            self.execute(sql, params)
+
+    def callproc(self, procname, params=None):
+        self.execute(procname, params)
+
+    def fetchmany(self, size):
+        rows = self.rows[:size]
+        del self.rows[:size]
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+
+class FakeConnection(object):
+    '''Just enough of a psycopg2 connection for the storage code.
+
+    Every statement run on a cursor is recorded in `executed`, with
+    its parameters in `params`.  The rows it returns come from
+    calling `respond` with the cursor, statement, and parameters.
+
+    '''
+    server_version = 90500
+
+    def __init__(self, *args, **kwargs):
+        self.closed = 0
+        self.broken = False
+        self.executed = []
+        self.params = []
+        self.respond = lambda cursor, sql, params: []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def cursor(self, name=None):
+        return FakeCursor(self, name=name)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+    def get_transaction_status(self):
+        import psycopg2.extensions
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.yield_fixture
+def idle_pool(monkeypatch):
+    from kvlayer._postgres import IdleCheckConnectionPool
+    clock = FakeClock()
+    monkeypatch.setattr('psycopg2.connect', FakeConnection)
+    monkeypatch.setattr('kvlayer._postgres.time', clock)
+    pool = IdleCheckConnectionPool(1, 4, 'dsn', idle_check_seconds=30)
+    pool.clock = clock
+    yield pool
+    pool.closeall()
+
+
+@pytest.mark.skipif(postgres_missing)
+def test_idle_pool_no_check_when_recent(idle_pool):
+    idle_pool.clock.now += 10
+    conn = idle_pool.getconn()
+    assert conn.executed == []
+    idle_pool.putconn(conn)
+    idle_pool.clock.now += 10
+    assert idle_pool.getconn() is conn
+    assert conn.executed == []
+
+
+@pytest.mark.skipif(postgres_missing)
+def test_idle_pool_checks_after_idle(idle_pool):
+    # this includes the connection opened when the pool was made
+    idle_pool.clock.now += 60
+    conn = idle_pool.getconn()
+    assert conn.executed == ['SELECT 1']
+    idle_pool.putconn(conn)
+    idle_pool.clock.now += 60
+    assert idle_pool.getconn() is conn
+    assert conn.executed == ['SELECT 1', 'SELECT 1']
+
+
+@pytest.mark.skipif(postgres_missing)
+def test_idle_pool_replaces_dead_connection(idle_pool):
+    conn = idle_pool.getconn()
+    idle_pool.putconn(conn)
+    conn.broken = True
+    idle_pool.clock.now += 60
+    new_conn = idle_pool.getconn()
+    assert new_conn is not conn
+    assert conn.closed
+    # a new connection needs no check
+    assert new_conn.executed == []
+    assert id(conn) not in idle_pool._last_used
+
+
+@pytest.mark.skipif(postgres_missing)
+def test_idle_pool_discards_closed_connection(idle_pool):
+    conn = idle_pool.getconn()
+    conn.closed = 2
+    idle_pool.putconn(conn)
+    assert id(conn) not in idle_pool._last_used
+    assert idle_pool.getconn() is not conn
+
+
+@pytest.mark.skipif(postgres_missing)
+def test_idle_pool_forgets_surplus_connection(idle_pool):
+    # minconn is 1, so the second connection returned is closed
+    conns = [idle_pool.getconn(), idle_pool.getconn()]
+    for conn in conns:
+        idle_pool.putconn(conn)
+    assert not conns[0].closed
+    assert conns[1].closed
+    assert idle_pool._last_used.keys() == [id(conns[0])]
+
+
+def unbinary(values):
+    '''Get the strings back out of a list of :func:`psycopg2.Binary`.'''
+    return [b.adapted for b in values]
+
+
+@pytest.yield_fixture
+def fake_storage(monkeypatch):
+    monkeypatch.setattr('psycopg2.connect', FakeConnection)
+    config = dict(config_postgres)
+    config.update({
+        'min_connections': 1,
+        'max_connections': 1,
+        'put_batch_size': 2,
+        'get_batch_size': 2,
+        'scan_itersize': 2,
+    })
+    storage = PGStorage(config, app_name='kvlayer')
+    conn = storage.connection_pool.getconn()
+    storage.connection_pool.putconn(conn)
+    storage.conn = conn
+    yield storage
+    storage.close()
+
+
+@pytest.mark.skipif(postgres_missing)
+def test_put_on_conflict_batches(fake_storage):
+    from kvlayer._postgres import _PUT_MANY
+    conn = fake_storage.conn
+    fake_storage._put('t1', [('a', '1'), ('a', '2'), ('b', '3'), ('c', '4')])
+    put_many = _PUT_MANY.format(namespace='test')
+    assert conn.executed == [put_many, put_many]
+    batches = [sorted(zip(unbinary(ks), unbinary(vs)))
+               for (t, ks, vs) in conn.params]
+    # a repeated key keeps its last value
+    assert batches == [[('a', '2'), ('b', '3')], [('c', '4')]]
+    assert [p[0] for p in conn.params] == ['t1', 't1']
+
+
+@pytest.mark.skipif(postgres_missing)
+def test_put_old_server_uses_procedure(fake_storage):
+    conn = fake_storage.conn
+    conn.server_version = 90400
+    fake_storage._put('t1', [('a', '1'), ('b', '2')])
+    assert conn.executed == ['upsert_test', 'upsert_test']
+    assert [(t, k.adapted, v.adapted) for (t, k, v) in conn.params] == \
+        [('t1', 'a', '1'), ('t1', 'b', '2')]
+
+
+@pytest.mark.skipif(postgres_missing)
+def test_get_batches(fake_storage):
+    from kvlayer._postgres import _GET_MANY
+    conn = fake_storage.conn
+    stored = {'a': '1', 'c': '3', 'd': '4'}
+
+    def respond(cursor, sql, params):
+        # the server returns rows in whatever order it likes
+        return reversed([(buffer(k), buffer(stored[k]))
+                         for k in unbinary(params[1]) if k in stored])
+    conn.respond = respond
+    keys = ['a', 'b', 'c', 'd', 'e']
+    assert list(fake_storage._get('t1', keys)) == \
+        [('a', '1'), ('b', None), ('c', '3'), ('d', '4'), ('e', None)]
+    assert conn.executed == [_GET_MANY.format(namespace='test')] * 3
+    assert [unbinary(p[1]) for p in conn.params] == \
+        [['a', 'b'], ['c', 'd'], ['e']]
+
+
+def scan_threads():
+    import threading
+    return [t for t in threading.enumerate() if t.name == 'kvlayer-pg-scan']
+
+
+@pytest.mark.skipif(postgres_missing)
+def test_scan_prefetch_reads_all_rows(fake_storage):
+    conn = fake_storage.conn
+    rows = [(buffer(k), buffer(k.upper())) for k in 'abcde']
+    conn.respond = lambda cursor, sql, params: rows
+    assert list(fake_storage._scan('t1', None)) == \
+        [(k, k.upper()) for k in 'abcde']
+    assert scan_threads() == []
+
+
+@pytest.mark.skipif(postgres_missing)
+def test_scan_prefetch_stops_when_closed(fake_storage):
+    conn = fake_storage.conn
+    rows = [(buffer(k), buffer(k.upper())) for k in 'abcdefghij']
+    conn.respond = lambda cursor, sql, params: rows
+    scan = fake_storage._scan('t1', None)
+    assert next(scan) == ('a', 'A')
+    assert scan_threads() != []
+    scan.close()
+    assert scan_threads() == []
+    # the connection went back to the pool
+    assert fake_storage.connection_pool.getconn() is conn
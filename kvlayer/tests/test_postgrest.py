@@ -0,0 +1,146 @@
+'''Tests for the PostgresTableStorage backend that need no server.
+
+The fake psycopg2 connection here comes from the PGStorage tests.
+
+'''
+from __future__ import absolute_import
+
+import pytest
+
+try:
+    import psycopg2
+    from kvlayer._postgrest import PostgresTableStorage
+    postgrest_missing = 'False'
+except ImportError:
+    postgrest_missing = 'True'
+
+from kvlayer.tests.test_postgres import FakeConnection, unbinary
+
+
+@pytest.yield_fixture
+def fake_storage(monkeypatch):
+    monkeypatch.setattr('psycopg2.connect', FakeConnection)
+    config = {
+        'storage_addresses': ['host=test-postgres.diffeo.com dbname=test'],
+        'min_connections': 1,
+        'max_connections': 1,
+        'put_batch_size': 2,
+        'get_batch_size': 2,
+    }
+    storage = PostgresTableStorage(config, app_name='kvlayer',
+                                   namespace='test')
+    storage.setup_namespace({'t1': (str,)})
+    conn = storage.connection_pool.getconn()
+    storage.connection_pool.putconn(conn)
+    del conn.executed[:]
+    del conn.params[:]
+    storage.conn = conn
+    yield storage
+    storage.close()
+
+
+@pytest.mark.skipif(postgrest_missing)
+def test_put_on_conflict_batches(fake_storage):
+    conn = fake_storage.conn
+    fake_storage.put('t1', (('c',), '1'), (('a',), '2'), (('b',), '3'),
+                     (('c',), '4'))
+    assert len(conn.executed) == 2
+    assert all(sql.startswith('INSERT INTO kvlayer_test.t1 ')
+               for sql in conn.executed)
+    assert all('SET v = EXCLUDED.v' in sql for sql in conn.executed)
+    # rows go in key order, and a repeated key keeps its last value
+    assert [(unbinary(ks), unbinary(vs)) for (ks, vs) in conn.params] == \
+        [(['a', 'b'], ['2', '3']), (['c'], ['4'])]
+
+
+def integrity_error(pgcode, message):
+    '''Make a :class:`psycopg2.IntegrityError` with a given `pgcode`.'''
+    class PGCodeError(psycopg2.IntegrityError):
+        pass
+    PGCodeError.pgcode = pgcode
+    return PGCodeError(message)
+
+
+def concurrent_insert(present, raced, log):
+    '''Respond as a table where another writer inserts the keys `raced`.
+
+    The first attempt to insert one of those keys fails as though
+    the other writer got there first.  Each statement is added to
+    `log` along with the key it touches.
+
+    '''
+    def respond(cursor, sql, params):
+        command = sql.split(' ')[0]
+        if command == 'UPDATE':
+            key = params[1].adapted
+            cursor.rowcount = int(key in present)
+            log.append('UPDATE ' + key)
+        elif command == 'INSERT':
+            key = params[0].adapted
+            log.append('INSERT ' + key)
+            present.add(key)
+            if key in raced:
+                raced.remove(key)
+                raise integrity_error(psycopg2.errorcodes.UNIQUE_VIOLATION,
+                                      'duplicate key value')
+        else:
+            log.append(command)
+    return respond
+
+
+@pytest.mark.skipif(postgrest_missing)
+def test_put_row_by_row_retries_after_race(fake_storage):
+    conn = fake_storage.conn
+    conn.server_version = 90400
+    present = set(['c'])
+    log = []
+    conn.respond = concurrent_insert(present, set(['a']), log)
+    fake_storage.put('t1', (('a',), '1'), (('b',), '2'), (('c',), '3'))
+    assert present == set(['a', 'b', 'c'])
+    assert log == [
+        # someone else inserts a first, so update it instead
+        'UPDATE a', 'SAVEPOINT', 'INSERT a', 'ROLLBACK', 'UPDATE a',
+        'UPDATE b', 'SAVEPOINT', 'INSERT b', 'RELEASE',
+        'UPDATE c',
+    ]
+
+
+@pytest.mark.skipif(postgrest_missing)
+def test_put_row_by_row_raises_other_errors(fake_storage):
+    conn = fake_storage.conn
+    conn.server_version = 90400
+
+    def respond(cursor, sql, params):
+        if sql.startswith('UPDATE'):
+            cursor.rowcount = 0
+        elif sql.startswith('INSERT'):
+            raise integrity_error(psycopg2.errorcodes.NOT_NULL_VIOLATION,
+                                  'null value')
+    conn.respond = respond
+    with pytest.raises(psycopg2.IntegrityError) as excinfo:
+        fake_storage.put('t1', (('a',), '1'))
+    assert excinfo.value.pgcode == psycopg2.errorcodes.NOT_NULL_VIOLATION
+    assert 'ROLLBACK TO SAVEPOINT kvlayer_put' not in conn.executed
+
+
+@pytest.mark.skipif(postgrest_missing)
+def test_get_batches(fake_storage):
+    conn = fake_storage.conn
+    stored = {'a': '1', 'c': '3', 'd': '4'}
+
+    def respond(cursor, sql, params):
+        # rows are numbered by their place in the batch, and the
+        # server returns them in whatever order it likes
+        ns, ks = params
+        return reversed([(n, buffer(stored[k]))
+                         for n, k in zip(ns, unbinary(ks)) if k in stored])
+    conn.respond = respond
+    keys = [('a',), ('b',), ('c',), ('d',), ('e',)]
+    assert list(fake_storage.get('t1', *keys)) == \
+        [(('a',), '1'), (('b',), None), (('c',), '3'), (('d',), '4'),
+         (('e',), None)]
+    assert len(conn.executed) == 3
+    assert all(sql.startswith('SELECT req.n, tbl.v FROM unnest(')
+               for sql in conn.executed)
+    assert [(ns, unbinary(ks)) for (ns, ks) in conn.params] == \
+        [([0, 1], ['a', 'b']), ([0, 1], ['c', 'd']), ([0], ['e'])]
@@ -0,0 +1,154 @@
+from __future__ import absolute_import
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+import uuid
+
+from kvlayer._redis import HashRing, RedisStorage
+
+
+def test_hash_ring_balance():
+    ring = HashRing(['a:6379', 'b:6379', 'c:6379'])
+    counts = [0, 0, 0]
+    for i in xrange(30000):
+        counts[ring.index_for('key%d' % i)] += 1
+    assert all(8000 < c < 12000 for c in counts)
+
+
+def test_hash_ring_node_order():
+    ring = HashRing(['a:6379', 'b:6379', 'c:6379'])
+    other = HashRing(['c:6379', 'a:6379', 'b:6379'])
+    for i in xrange(1000):
+        assert ring.node_for('key%d' % i) == other.node_for('key%d' % i)
+
+
+def test_hash_ring_add_node():
+    ring = HashRing(['a:6379', 'b:6379', 'c:6379'])
+    bigger = HashRing(['a:6379', 'b:6379', 'c:6379', 'd:6379'])
+    for i in xrange(1000):
+        node = bigger.node_for('key%d' % i)
+        # keys only ever move to the new node
+        assert node == 'd:6379' or node == ring.node_for('key%d' % i)
+
+
+class FakeRedis(object):
+    '''Just enough of :class:`redis.StrictRedis` to hold one shard.'''
+    def __init__(self):
+        self.hashes = {}
+        self.zsets = {}
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value
+
+    def hmget(self, key, *fields):
+        if len(fields) == 1 and isinstance(fields[0], list):
+            fields = fields[0]
+        return [self.hget(key, f) for f in fields]
+
+    def zadd(self, key, score, member):
+        self.zsets.setdefault(key, set()).add(member)
+
+    def zrangebylex(self, key, lo, hi, start=None, num=None):
+        members = sorted(self.zsets.get(key, ()))
+        if lo != '-':
+            members = [m for m in members
+                       if m > lo[1:] or (lo[0] == '[' and m == lo[1:])]
+        if hi != '+':
+            members = [m for m in members
+                       if m < hi[1:] or (hi[0] == '[' and m == hi[1:])]
+        return members[start:start + num]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((getattr(self.conn, name), args, kwargs))
+        return call
+
+    def execute(self):
+        return [f(*args, **kwargs) for (f, args, kwargs) in self.calls]
+
+
+def sharded_storage(addresses, shards):
+    '''Make a sharded RedisStorage talking to `shards` in memory.'''
+    storage = RedisStorage({'app_name': 'kvlayer', 'namespace': 'test',
+                            'storage_addresses': addresses,
+                            'redis_sharded': True,
+                            'redis_scan_page_size': 7})
+    storage._connection = lambda shard=0: shards[addresses[shard]]
+    storage._table_keys['t'] = 'kvlayer_test_t'
+    return storage
+
+
+ADDRESSES = ['a:6379', 'b:6379', 'c:6379']
+
+
+def test_sharded_keys_stay_put():
+    shards = dict((address, FakeRedis()) for address in ADDRESSES)
+    storage = sharded_storage(ADDRESSES, shards)
+    items = [('key%03d' % i, 'value%d' % i) for i in xrange(300)]
+    storage._put('t', items)
+    storage._put('t', items[:100])
+    # the same client, and one listing the shards in another order,
+    # both find every key on one shard, chosen by the hash ring
+    other = sharded_storage(list(reversed(ADDRESSES)), shards)
+    for k, v in items:
+        owner = storage._ring.node_for(k)
+        assert other._ring.node_for(k) == owner
+        for address, shard in shards.iteritems():
+            expected = v if address == owner else None
+            assert shard.hget('kvlayer_test_t', k) == expected
+    assert all(shard.hashes['kvlayer_test_t'] for shard in shards.values())
+    keys = [k for k, v in reversed(items)]
+    assert list(storage._get('t', keys)) == list(reversed(items))
+    assert list(other._get('t', keys)) == list(reversed(items))
+    storage.close()
+    other.close()
+
+
+def test_sharded_scan_order():
+    shards = dict((address, FakeRedis()) for address in ADDRESSES)
+    storage = sharded_storage(ADDRESSES, shards)
+    items = sorted((uuid.uuid4().bytes, str(i)) for i in xrange(200))
+    storage._put('t', items)
+    assert list(storage._scan('t', [])) == items
+    assert list(storage._scan_keys('t', [])) == [k for k, v in items]
+    assert (list(storage._scan('t', [(items[10][0], items[150][0]),
+                                     (items[190][0], None)])) ==
+            items[10:151] + items[190:])
+    storage.close()
+
+
+def test_sharded_thread_pool(monkeypatch):
+    shards = dict((address, FakeRedis()) for address in ADDRESSES)
+    storage = sharded_storage(ADDRESSES, shards)
+    storage._put('t', [('key%03d' % i, 'v') for i in xrange(30)])
+    pools = []
+
+    def make_pool(*args):
+        # give other threads every chance to race for the pool
+        time.sleep(0.05)
+        pools.append(ThreadPool(*args))
+        return pools[-1]
+    storage.close()
+    monkeypatch.setattr('kvlayer._redis.ThreadPool', make_pool)
+
+    def get_all():
+        list(storage._get('t', ['key%03d' % i for i in xrange(30)]))
+    threads = [threading.Thread(target=get_all) for _ in xrange(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(pools) == 1
+    storage.close()
@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+import multiprocessing
+
+import pytest
+
+from kvlayer._sqlite import SqliteStorage
+
+
+def make_storage(filename, namespace_string, **config):
+    config['filename'] = filename
+    config['encoder'] = 'packed'
+    storage = SqliteStorage(config, app_name='kvlayer',
+                            namespace=namespace_string)
+    storage.setup_namespace({'t': (int,)})
+    return storage
+
+
+@pytest.yield_fixture
+def storage(tmpdir, namespace_string):
+    storage = make_storage(str(tmpdir.join('kvlayer.db')), namespace_string)
+    yield storage
+    storage.delete_namespace()
+    storage.close()
+
+
+def test_batched_get(storage):
+    storage._get_batch_size = 3
+    storage.put('t', *[((i,), str(i)) for i in xrange(0, 20, 2)])
+    keys = [(i,) for i in xrange(10, -1, -1)]
+    assert list(storage.get('t', *keys)) == \
+        [(k, str(k[0]) if k[0] % 2 == 0 else None) for k in keys]
+
+
+def test_write_during_scan(storage, tmpdir, namespace_string):
+    storage.put('t', *[((i,), str(i)) for i in xrange(10)])
+    # a short timeout: without WAL the writer would wait for the reader
+    writer = make_storage(str(tmpdir.join('kvlayer.db')), namespace_string,
+                          sqlite_timeout=0.5)
+    scanned = []
+    for k, v in storage.scan('t'):
+        scanned.append(k)
+        writer.put('t', ((100 + k[0],), 'new'))
+        storage.delete('t', k)
+    assert scanned == [(i,) for i in xrange(10)]
+    assert list(storage.scan_keys('t')) == [(100 + i,) for i in xrange(10)]
+    writer.close()
+
+
+def _count_rows(filename, namespace_string, queue):
+    reader = make_storage(filename, namespace_string)
+    queue.put(len(list(reader.scan_keys('t'))))
+    reader.close()
+
+
+def test_reader_process(storage, tmpdir, namespace_string):
+    storage.put('t', *[((i,), str(i)) for i in xrange(10)])
+    queue = multiprocessing.Queue()
+    readers = [multiprocessing.Process(
+        target=_count_rows,
+        args=(str(tmpdir.join('kvlayer.db')), namespace_string, queue))
+        for _ in xrange(3)]
+    for reader in readers:
+        reader.start()
+    counts = [queue.get(timeout=30) for _ in readers]
+    for reader in readers:
+        reader.join()
+    assert counts == [10, 10, 10]
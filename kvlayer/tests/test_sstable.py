@@ -0,0 +1,98 @@
+from __future__ import absolute_import
+import os
+
+import pytest
+
+from kvlayer._sstable import SSTable, SSTableStorage, write_sstable
+
+
+@pytest.yield_fixture
+def storage(tmpdir, namespace_string):
+    config = {
+        'sstable_dir': str(tmpdir),
+        'sstable_memtable_size': 10,
+        'sstable_block_size': 64,
+        'sstable_max_files': 4,
+        'encoder': 'packed',
+    }
+    storage = SSTableStorage(config, app_name='kvlayer',
+                             namespace=namespace_string)
+    storage.setup_namespace({'t': (int,)})
+    yield storage
+    storage.delete_namespace()
+
+
+def test_sstable_file(tmpdir):
+    filename = str(tmpdir.join('test.sst'))
+    items = [('k%04d' % i, 'v%d' % i) for i in xrange(0, 1000, 2)]
+    items.append(('k9999', None))
+    write_sstable(filename, items, block_size=128)
+    sstable = SSTable(filename)
+    assert sstable.num_entries == len(items)
+
+    assert sstable.get('k0010') == (True, 'v10')
+    assert sstable.get('k0011') == (False, None)
+    assert sstable.get('a') == (False, None)
+    assert sstable.get('k9999') == (True, None)
+    assert list(sstable.scan('k0009', 'k0014')) == \
+        [('k0010', 'v10'), ('k0012', 'v12'), ('k0014', 'v14')]
+    assert list(sstable.scan(None, 'k0002')) == \
+        [('k0000', 'v0'), ('k0002', 'v2')]
+    assert len(list(sstable.scan(None, None))) == len(items)
+
+    # the bloom filter rejects most keys that aren't present
+    misses = sum(1 for i in xrange(1, 1000, 2)
+                 if sstable.might_contain('k%04d' % i))
+    assert misses < 50
+    sstable.close()
+
+
+def test_newer_files_win(storage):
+    storage.put('t', *[((i,), 'old') for i in xrange(25)])
+    storage.delete('t', *[(i,) for i in xrange(0, 25, 5)])
+    storage.put('t', ((1,), 'new'))
+    storage.flush()
+    assert len(storage._sstables['t']) > 1
+
+    expected = dict(((i,), 'old') for i in xrange(25) if i % 5 != 0)
+    expected[(1,)] = 'new'
+    assert dict(storage.scan('t')) == expected
+    assert list(storage.get('t', (1,), (5,))) == [((1,), 'new'), ((5,), None)]
+
+    storage.compact('t')
+    assert len(storage._sstables['t']) == 1
+    assert dict(storage.scan('t')) == expected
+    assert list(storage.scan('t', ((2,), (4,)))) == \
+        [((2,), 'old'), ((3,), 'old'), ((4,), 'old')]
+
+
+def test_reopen(storage, tmpdir, namespace_string):
+    storage.put('t', ((1,), 'one'), ((2,), 'two'))
+    storage.close()
+    assert len(os.listdir(storage._table_dir('t'))) == 1
+
+    reader = SSTableStorage(storage._config, app_name='kvlayer',
+                            namespace=namespace_string)
+    reader.setup_namespace({'t': (int,)})
+    assert list(reader.scan('t')) == [((1,), 'one'), ((2,), 'two')]
+    reader.close()
+
+
+def test_compact_during_scan(storage):
+    for n in xrange(0, 40, 10):
+        storage.put('t', *[((i,), 'v%d' % i) for i in xrange(n, n + 10)])
+    assert len(storage._sstables['t']) == 4
+    old_files = list(storage._sstables['t'])
+
+    scan = storage.scan('t')
+    assert [next(scan) for _ in xrange(10)] == \
+        [((i,), 'v%d' % i) for i in xrange(10)]
+    storage.compact('t')
+    assert len(storage._sstables['t']) == 1
+    for sstable in old_files:
+        assert not os.path.exists(sstable.filename)
+    # the scan keeps reading the files it started with
+    assert list(scan) == [((i,), 'v%d' % i) for i in xrange(10, 40)]
+    # and then lets them go
+    for sstable in old_files:
+        assert sstable._refs == 0
@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+import time
+
+import pytest
+
+from kvlayer._utils import parallel_scan, split_key_range
+
+
+def test_split_key_range():
+    assert split_key_range('', '', ['c', 'f']) == \
+        [('', 'c'), ('c', 'f'), ('f', '')]
+    assert split_key_range('d', 'g', ['', 'c', 'f']) == \
+        [('d', 'f'), ('f', 'g')]
+    assert split_key_range('c', 'f', ['c', 'f']) == [('c', 'f')]
+
+
+def scan_numbers((start, stop)):
+    for n in xrange(start, stop):
+        if n % 7 == 0:
+            # let other threads get ahead
+            time.sleep(0.001)
+        yield n
+
+
+@pytest.mark.parametrize('num_threads', [1, 4])
+def test_parallel_scan_ordered(num_threads):
+    pieces = [(n, n + 250) for n in xrange(0, 2000, 250)]
+    assert (list(parallel_scan(scan_numbers, pieces, num_threads,
+                               batch_size=10)) ==
+            range(2000))
+
+
+def test_parallel_scan_unordered():
+    pieces = [(n, n + 250) for n in xrange(0, 2000, 250)]
+    assert (sorted(parallel_scan(scan_numbers, pieces, 4, ordered=False,
+                                 batch_size=10)) ==
+            range(2000))
+
+
+def failing_scan_piece(n):
+    if n == 3:
+        raise ValueError(n)
+    return [n]
+
+
+def test_parallel_scan_error():
+    with pytest.raises(ValueError) as excinfo:
+        list(parallel_scan(failing_scan_piece, range(6), 3))
+    # the traceback reaches into the worker thread
+    assert excinfo.traceback[-1].name == 'failing_scan_piece'
+
+
+def test_parallel_scan_stop_early():
+    pieces = [(n, n + 250) for n in xrange(0, 2000, 250)]
+    results = parallel_scan(scan_numbers, pieces, 4, batch_size=10)
+    assert [next(results) for _ in xrange(5)] == range(5)
+    # closing the generator stops the threads
+    results.close()